@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Benchmark script for the line counting engine
+"""
+
+import os
+import re
+import sys
+import time
+import tracemalloc
+
+from main import LANGUAGES, CountingPool, count_lines_from_content, count_raw_content
+
+def legacy_count_lines(content, language):
+    """Per-line re.match counter that count_lines_from_content replaced"""
+    lines = content.split('\n')
+    total_lines = len(lines)
+    code_lines = 0
+    comment_lines = 0
+    empty_lines = 0
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            empty_lines += 1
+        elif re.match(language['comment_regex'], line):
+            comment_lines += 1
+        else:
+            code_lines += 1
+
+    return (total_lines, code_lines, comment_lines, empty_lines)
+
+# Blocks the generated corpora repeat: a comment block, a docstring or
+# declaration, a line comment, code and an empty line
+C_BLOCK = (
+    "/*\n"
+    " * Generated accessor\n"
+    " */\n"
+    "static int value_%d(struct item *item) {\n"
+    "    // read the cached value\n"
+    "    return item->values[%d] + item->offset;\n"
+    "}\n"
+    "\n"
+)
+PYTHON_BLOCK = (
+    "#\n"
+    "# Generated accessor\n"
+    "#\n"
+    "def value_%d(item):\n"
+    '    """Return the cached value of item."""\n'
+    "    # read the cached value\n"
+    "    return item.values[%d] + item.offset\n"
+    "\n"
+)
+# Speedup over legacy_count_lines each corpus must reach
+MIN_SPEEDUP = 5
+
+def generate_source(size_mb, block=C_BLOCK):
+    """Build a synthetic source file of roughly size_mb megabytes from block"""
+    chunks = []
+    size = 0
+    index = 0
+    while size < size_mb * 1024 * 1024:
+        chunk = block % (index, index)
+        chunks.append(chunk)
+        size += len(chunk)
+        index += 1
+    return ''.join(chunks)
+
+def measure(funcs, repeat=5):
+    """Best wall time of each (func, args) over repeat interleaved runs, plus its peak traced memory
+
+    Runs alternate between the functions so that a slow spell of the
+    machine does not skew one side of the comparison.
+    """
+    results = [None] * len(funcs)
+    elapsed = [None] * len(funcs)
+    for _ in range(repeat):
+        for index, (func, args) in enumerate(funcs):
+            start = time.perf_counter()
+            results[index] = func(*args)
+            run_time = time.perf_counter() - start
+            elapsed[index] = run_time if elapsed[index] is None else min(elapsed[index], run_time)
+
+    peaks = []
+    for func, args in funcs:
+        tracemalloc.start()
+        func(*args)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return list(zip(results, elapsed, peaks))
+
+def benchmark_line_counting(size_mb=50, key='c', block=C_BLOCK):
+    language = LANGUAGES[key]
+    print("="*60)
+    print(f"Line counting on a {size_mb} MB generated {language['name']} file")
+    print("="*60)
+
+    content = generate_source(size_mb, block)
+    raw = content.encode('utf-8')
+    mb = len(raw) / (1024 * 1024)
+
+    (legacy, legacy_time, legacy_peak), (engine, engine_time, engine_peak) = measure([
+        (legacy_count_lines, (content, language)), (count_lines_from_content, (raw, language))])
+    speedup = legacy_time / engine_time
+
+    print(f"\n{'Counter':<12} {'Seconds':>10} {'MB/s':>10} {'Peak MB':>10}")
+    print("-"*60)
+    print(f"{'legacy':<12} {legacy_time:>10.2f} {mb / legacy_time:>10.1f} {legacy_peak / 1048576:>10.1f}")
+    print(f"{'engine':<12} {engine_time:>10.2f} {mb / engine_time:>10.1f} {engine_peak / 1048576:>10.1f}")
+    print("-"*60)
+    print(f"Speedup: {speedup:.1f}x")
+    print(f"Legacy (total, code, comment, empty): {legacy}")
+    print(f"Engine (total, code, comment, empty): {engine}")
+    print("  (the engine also counts lines inside block comments and docstrings as comments)\n")
+    return speedup
+
+def count_corpus(corpus, language, workers):
+    """Count every file of corpus, on the calling thread or on a CountingPool"""
+    if not workers:
+        start = time.perf_counter()
+        results = [count_raw_content(raw, language) for raw in corpus]
+        return results, time.perf_counter() - start
+
+    pool = CountingPool(workers)
+    try:
+        # Start the worker processes before the clock runs
+        warmup = [pool.submit(b'', language) for _ in range(workers * pool.batch_files)]
+        for future in warmup:
+            pool.result(future)
+
+        start = time.perf_counter()
+        futures = [pool.submit(raw, language) for raw in corpus]
+        results = [pool.result(future) for future in futures]
+        return results, time.perf_counter() - start
+    finally:
+        pool.shutdown()
+
+def benchmark_counting_pool(files=2000, file_kb=64):
+    print("="*60)
+    print(f"Counting pool on {files} generated C files of {file_kb} KB")
+    print("="*60)
+
+    language = LANGUAGES['c']
+    raw = generate_source(file_kb / 1024).encode('utf-8')
+    corpus = [raw] * files
+
+    expected, inline_time = count_corpus(corpus, language, 0)
+
+    worker_counts = [1, 2, 4, 8, 16]
+    worker_counts = [n for n in worker_counts if n <= (os.cpu_count() or 1)] or [1]
+
+    print(f"\n{'Workers':<12} {'Seconds':>10} {'Files/s':>10} {'Speedup':>10}")
+    print("-"*60)
+    print(f"{'inline':<12} {inline_time:>10.2f} {files / inline_time:>10.0f} {1:>9.1f}x")
+    for workers in worker_counts:
+        results, elapsed = count_corpus(corpus, language, workers)
+        assert results == expected
+        print(f"{workers:<12} {elapsed:>10.2f} {files / elapsed:>10.0f} {inline_time / elapsed:>9.1f}x")
+    print("-"*60)
+    print(f"{os.cpu_count()} CPUs; inline counts on one thread like COUNT_WORKERS=0")
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--pool':
+        files = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+        benchmark_counting_pool(files)
+    else:
+        size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+        speedups = {
+            'C': benchmark_line_counting(size_mb, 'c', C_BLOCK),
+            'Python': benchmark_line_counting(size_mb, 'python', PYTHON_BLOCK),
+        }
+        slow = [f"{name} {speedup:.1f}x" for name, speedup in speedups.items() if speedup < MIN_SPEEDUP]
+        assert not slow, f"Speedup below {MIN_SPEEDUP}x: {', '.join(slow)}"
+        print(f"✓ Both corpora count at least {MIN_SPEEDUP}x faster")
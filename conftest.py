@@ -0,0 +1,45 @@
+# coding:utf-8
+"""
+Shared test setup: the app runs on a throwaway SQLite file, without the
+scheduler or counting processes
+"""
+
+import os
+import tempfile
+
+import pytest
+
+# main reads these at import, so they are set before any test module imports it.
+# The read bind opens its own connection, so the database has to be a file
+DATABASE = os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{DATABASE}'
+os.environ['SCHEDULER_ENABLED'] = '0'
+os.environ['COUNT_WORKERS'] = '0'
+
+@pytest.fixture
+def database():
+    """Migrated, empty database inside an app context"""
+    from main import app, db, migrate_database
+    with app.app_context():
+        migrate_database()
+        yield db
+        db.session.remove()
+        db.metadata.drop_all(db.engine)
+
+@pytest.fixture
+def user(database):
+    from main import User
+    user = User(username='octocat', email='octocat@example.com')
+    user.set_password('secret')
+    database.session.add(user)
+    database.session.commit()
+    return user
+
+@pytest.fixture
+def client(user, monkeypatch):
+    from main import app, invalidate_response_caches, scan_workers
+    # Tests run scan jobs themselves; worker threads would outlive the database
+    monkeypatch.setattr(scan_workers, 'start', lambda: None)
+    # Ids start over with every database, so drop what earlier tests cached
+    invalidate_response_caches(user.id)
+    return app.test_client()
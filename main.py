@@ -1,33 +1,177 @@
 #!/usr/bin/env python
 # coding:utf-8
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_file, flash
+from flask import (Flask, render_template, request, jsonify, session, redirect, url_for, send_file, flash,
+                   Response, stream_with_context, g)
 from flask_sqlalchemy import SQLAlchemy
 from flask_apscheduler import APScheduler
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta, date
-from github import Github
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm import Session
+from github import Github, GithubException
 import gitlab
 import requests
 import re
 import json
 import os
+import sqlite3
 import hashlib
-from functools import wraps
+import codecs
+import click
+from functools import lru_cache, wraps
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 import io
-import base64
 import time
+import random
+import itertools
 import threading
-from collections import defaultdict
+import queue
+import asyncio
+import contextvars
+from collections import OrderedDict, defaultdict, deque, namedtuple
+import multiprocessing
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import urlparse, quote
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-change-this-to-something-secure'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///code_stats.db'
+# DATABASE_URL selects the database; pages and read-only APIs go through the
+# 'read' bind, which is DATABASE_READ_URL (e.g. a replica) when set and the
+# same database otherwise. Every process keeps a pool of DB_POOL_SIZE
+# connections plus up to DB_POOL_OVERFLOW more under load. SQLite runs in WAL
+# mode so pages keep reading while a scan writes, and a writer waits up to
+# DB_BUSY_TIMEOUT seconds for the lock instead of failing with "database is locked"
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///code_stats.db')
+app.config['SQLALCHEMY_BINDS'] = {'read': os.environ.get('DATABASE_READ_URL') or app.config['SQLALCHEMY_DATABASE_URI']}
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 10))
+app.config['DB_POOL_OVERFLOW'] = int(os.environ.get('DB_POOL_OVERFLOW', 20))
+app.config['DB_BUSY_TIMEOUT'] = float(os.environ.get('DB_BUSY_TIMEOUT', 30))
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_pre_ping': True}
+# An in-memory SQLite database lives on a single shared connection
+if make_url(app.config['SQLALCHEMY_DATABASE_URI']).database not in (None, '', ':memory:'):
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=app.config['DB_POOL_SIZE'],
+                                                   max_overflow=app.config['DB_POOL_OVERFLOW'],
+                                                   pool_recycle=3600)
+# 'tree' lists a GitHub repository with one recursive Git Trees request,
+# 'contents' walks it one directory at a time
+app.config['GITHUB_SCAN_MODE'] = os.environ.get('GITHUB_SCAN_MODE', 'tree')
+# File downloads run on a worker pool; at most FETCH_PER_HOST_LIMIT of them
+# hit the same host at once, process-wide
+app.config['FETCH_WORKERS'] = int(os.environ.get('FETCH_WORKERS', 8))
+app.config['FETCH_QUEUE_SIZE'] = int(os.environ.get('FETCH_QUEUE_SIZE', 32))
+app.config['FETCH_PER_HOST_LIMIT'] = int(os.environ.get('FETCH_PER_HOST_LIMIT', 8))
+app.config['FILE_CACHE_BATCH_SIZE'] = int(os.environ.get('FILE_CACHE_BATCH_SIZE', 500))
+# Files larger than MAX_FILE_SIZE bytes are skipped. Downloads are read in
+# chunks; once a file passes STREAM_FILE_SIZE it is counted as it arrives
+# instead of being buffered for the counting pool, so a fetch worker holds at
+# most about STREAM_FILE_SIZE bytes of any file
+app.config['MAX_FILE_SIZE'] = int(os.environ.get('MAX_FILE_SIZE', 100 * 1024 * 1024))
+app.config['STREAM_FILE_SIZE'] = int(os.environ.get('STREAM_FILE_SIZE', 1024 * 1024))
+# Vendored dependencies, minified bundles, lockfiles and generated code are
+# skipped before download by linguist-style path rules; users add their own
+# globs with 'exclude_paths' settings
+app.config['SKIP_VENDORED'] = os.environ.get('SKIP_VENDORED', '1') not in ('0', 'false', 'no')
+# A repository whose head moved is rescanned from the commit diff when at most
+# this many files changed, and from its full tree otherwise
+app.config['INCREMENTAL_MAX_FILES'] = int(os.environ.get('INCREMENTAL_MAX_FILES', 250))
+# 'threaded' uses PyGithub/python-gitlab with the fetch pool above, 'async'
+# uses the aiohttp engine; users can override it with a 'scan_engine' setting
+app.config['SCAN_ENGINE'] = os.environ.get('SCAN_ENGINE', 'threaded')
+app.config['ASYNC_CONCURRENCY'] = int(os.environ.get('ASYNC_CONCURRENCY', 16))
+# Downloaded files are counted on COUNT_WORKERS processes (0 counts them on
+# the fetch threads instead), sent over in batches of up to COUNT_BATCH_FILES
+# files or COUNT_BATCH_BYTES bytes; a partial batch waits at most
+# COUNT_BATCH_DELAY seconds for more files. The default uses every CPU; on a
+# single CPU the extra process would only add copying
+app.config['COUNT_WORKERS'] = int(os.environ.get('COUNT_WORKERS', os.cpu_count() if (os.cpu_count() or 1) > 1 else 0))
+app.config['COUNT_BATCH_FILES'] = int(os.environ.get('COUNT_BATCH_FILES', 64))
+app.config['COUNT_BATCH_BYTES'] = int(os.environ.get('COUNT_BATCH_BYTES', 8 * 1024 * 1024))
+app.config['COUNT_BATCH_DELAY'] = float(os.environ.get('COUNT_BATCH_DELAY', 0.02))
+# Every API request is paced by a per-credential, per-host RateLimiter. Once
+# fewer than RATE_LIMIT_RESERVE of the quota are left, requests are spread
+# evenly over the rest of the window; work that would have to wait longer
+# than RATE_LIMIT_MAX_WAIT seconds is deferred to the next sync instead
+app.config['RATE_LIMIT_RESERVE'] = float(os.environ.get('RATE_LIMIT_RESERVE', 0.1))
+app.config['RATE_LIMIT_MAX_WAIT'] = float(os.environ.get('RATE_LIMIT_MAX_WAIT', 120))
+app.config['RATE_LIMIT_RETRIES'] = int(os.environ.get('RATE_LIMIT_RETRIES', 5))
+# Account scans are ScanJob rows run by SCAN_WORKERS threads per process. A
+# running job whose heartbeat is older than SCAN_JOB_STALE_AFTER seconds was
+# left behind by a crashed process and is queued again; it resumes after the
+# last repository it finished. Failing jobs are retried SCAN_JOB_MAX_ATTEMPTS times
+app.config['SCAN_WORKERS'] = int(os.environ.get('SCAN_WORKERS', 4))
+app.config['SCAN_POLL_INTERVAL'] = float(os.environ.get('SCAN_POLL_INTERVAL', 5))
+app.config['SCAN_JOB_STALE_AFTER'] = int(os.environ.get('SCAN_JOB_STALE_AFTER', 120))
+app.config['SCAN_JOB_MAX_ATTEMPTS'] = int(os.environ.get('SCAN_JOB_MAX_ATTEMPTS', 3))
+app.config['SCAN_JOB_RETENTION_DAYS'] = int(os.environ.get('SCAN_JOB_RETENTION_DAYS', 7))
+# Accounts on different hosts have separate rate limits, so their scans run
+# side by side: at most SCAN_ACCOUNTS_PER_HOST running jobs per API host across
+# all processes (0 = no cap). Inside an account, the threaded scanner works on
+# SCAN_REPO_CONCURRENCY repositories at once, and on at most
+# SCAN_REPOS_PER_HOST repositories per host across the process
+app.config['SCAN_ACCOUNTS_PER_HOST'] = int(os.environ.get('SCAN_ACCOUNTS_PER_HOST', 2))
+app.config['SCAN_REPO_CONCURRENCY'] = int(os.environ.get('SCAN_REPO_CONCURRENCY', 4))
+app.config['SCAN_REPOS_PER_HOST'] = int(os.environ.get('SCAN_REPOS_PER_HOST', 8))
+# Scan progress is published to PROGRESS_BACKEND ('database' is shared by
+# every process, 'memory' only works with a single process) every
+# PROGRESS_INTERVAL seconds and streamed to the dashboard over Server-Sent
+# Events. Each open stream holds a worker thread for up to
+# PROGRESS_STREAM_TIMEOUT seconds, after which the browser reconnects, and
+# reads the progress store every PROGRESS_STREAM_INTERVAL seconds; with
+# PROGRESS_STREAM=0 the dashboard polls /api/scanning_progress instead
+app.config['PROGRESS_BACKEND'] = os.environ.get('PROGRESS_BACKEND', 'database')
+app.config['PROGRESS_INTERVAL'] = float(os.environ.get('PROGRESS_INTERVAL', 1))
+app.config['PROGRESS_STREAM'] = os.environ.get('PROGRESS_STREAM', '1') not in ('0', 'false', 'no')
+app.config['PROGRESS_STREAM_TIMEOUT'] = int(os.environ.get('PROGRESS_STREAM_TIMEOUT', 300))
+app.config['PROGRESS_STREAM_INTERVAL'] = float(os.environ.get('PROGRESS_STREAM_INTERVAL', 1))
+# Every user with an active account is synced every auto_update_interval hours
+# (SYNC_DEFAULT_INTERVAL without the setting). Each user runs at a fixed phase
+# of the interval derived from their id, so users on the same interval are
+# spread evenly over it, plus up to SYNC_JITTER seconds of random delay.
+# Schedules are re-planned from the settings every SYNC_PLAN_INTERVAL seconds;
+# set SCHEDULER_ENABLED=0 on processes that should not run syncs
+app.config['SCHEDULER_ENABLED'] = os.environ.get('SCHEDULER_ENABLED', '1') not in ('0', 'false', 'no')
+app.config['SCHEDULER_TIMEZONE'] = 'UTC'
+app.config['SYNC_DEFAULT_INTERVAL'] = int(os.environ.get('SYNC_DEFAULT_INTERVAL', 24))
+app.config['SYNC_JITTER'] = int(os.environ.get('SYNC_JITTER', 300))
+app.config['SYNC_PLAN_INTERVAL'] = int(os.environ.get('SYNC_PLAN_INTERVAL', 300))
+# Rendered badges are cached per (user, type, language, color) in up to
+# BADGE_CACHE_BYTES per process. A user's badges are dropped when their
+# statistics are saved, and after BADGE_CACHE_TTL seconds so they catch up
+# with scans run by other processes. Browsers, CDNs and GitHub's camo proxy
+# may reuse a badge for BADGE_MAX_AGE seconds and then revalidate its ETag
+app.config['BADGE_CACHE_BYTES'] = int(os.environ.get('BADGE_CACHE_BYTES', 8 * 1024 * 1024))
+app.config['BADGE_CACHE_TTL'] = int(os.environ.get('BADGE_CACHE_TTL', 300))
+app.config['BADGE_MAX_AGE'] = int(os.environ.get('BADGE_MAX_AGE', 300))
+# Custom endpoint results are cached per (endpoint, parameters) in up to
+# ENDPOINT_CACHE_BYTES per process for ENDPOINT_CACHE_TTL seconds, and dropped
+# when the owner's statistics are saved or their endpoints change
+app.config['ENDPOINT_CACHE_BYTES'] = int(os.environ.get('ENDPOINT_CACHE_BYTES', 16 * 1024 * 1024))
+app.config['ENDPOINT_CACHE_TTL'] = int(os.environ.get('ENDPOINT_CACHE_TTL', 60))
+# A custom endpoint cannot be saved when its query reads all of a table of
+# more than ENDPOINT_SCAN_MAX_ROWS rows. A call is interrupted after
+# ENDPOINT_TIMEOUT seconds and returns at most ENDPOINT_MAX_ROWS rows; results
+# longer than ENDPOINT_STREAM_ROWS rows are streamed instead of cached
+app.config['ENDPOINT_SCAN_MAX_ROWS'] = int(os.environ.get('ENDPOINT_SCAN_MAX_ROWS', 10000))
+app.config['ENDPOINT_TIMEOUT'] = float(os.environ.get('ENDPOINT_TIMEOUT', 5))
+app.config['ENDPOINT_MAX_ROWS'] = int(os.environ.get('ENDPOINT_MAX_ROWS', 10000))
+app.config['ENDPOINT_STREAM_ROWS'] = int(os.environ.get('ENDPOINT_STREAM_ROWS', 500))
 
 db = SQLAlchemy(app)
 scheduler = APScheduler()
+scheduler.init_app(app)
+scheduler_lock = threading.Lock()
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -74,11 +218,18 @@ class Repository(db.Model):
     repo_name = db.Column(db.String(200), nullable=False)
     repo_id = db.Column(db.String(100), nullable=False)
     repo_hash = db.Column(db.String(64))  # Repository commit hash for change detection
+    head_etag = db.Column(db.String(200))  # ETag of the head lookup that returned repo_hash
     is_private = db.Column(db.Boolean, default=False)
     last_updated = db.Column(db.DateTime)
     last_commit_date = db.Column(db.DateTime)
     
     files = db.relationship('FileCache', backref='repository', lazy=True, cascade='all, delete-orphan')
+    language_stats = db.relationship('RepositoryLanguageStats', backref='repository', lazy=True,
+                                     cascade='all, delete-orphan')
+    
+    __table_args__ = (
+        db.Index('uq_repository_account_repo', 'account_id', 'repo_id', unique=True),
+    )
     
 class FileCache(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -92,6 +243,25 @@ class FileCache(db.Model):
     empty_lines = db.Column(db.Integer, default=0)
     last_modified = db.Column(db.DateTime)
     cached_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('uq_file_cache_repo_path', 'repo_id', 'file_path', unique=True),
+    )
+
+class RepositoryLanguageStats(db.Model):
+    """Per-language totals of a repository's FileCache rows, kept current by FileCacheStore"""
+    id = db.Column(db.Integer, primary_key=True)
+    repo_id = db.Column(db.Integer, db.ForeignKey('repository.id'), nullable=False)
+    language = db.Column(db.String(50), nullable=False)
+    files = db.Column(db.Integer, default=0)
+    total_lines = db.Column(db.Integer, default=0)
+    code_lines = db.Column(db.Integer, default=0)
+    comment_lines = db.Column(db.Integer, default=0)
+    empty_lines = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('uq_repository_language_stats', 'repo_id', 'language', unique=True),
+    )
 
 class Statistics(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -106,6 +276,13 @@ class Statistics(db.Model):
     empty_lines = db.Column(db.Integer, default=0)
     
     user = db.relationship('User', backref='statistics')
+    
+    __table_args__ = (
+        # save_statistics replaces one (user, account, date) snapshot at a time
+        db.Index('uq_statistics_snapshot', 'user_id', 'account_id', 'date', 'language', unique=True),
+        # Dashboard, API and badge reads filter by user and date range, sometimes by language
+        db.Index('ix_statistics_user_date', 'user_id', 'date', 'language'),
+    )
 
 class DailyActivity(db.Model):
     """Store daily coding activity for charts"""
@@ -118,12 +295,52 @@ class DailyActivity(db.Model):
     languages_used = db.Column(db.Integer, default=0)
     
     user = db.relationship('User', backref='daily_activities')
+    
+    __table_args__ = (
+        db.Index('uq_daily_activity_user_date', 'user_id', 'date', unique=True),
+    )
+
+class CurrentStatistics(db.Model):
+    """Per-language sums of the latest Statistics snapshot of each of a user's accounts"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    language = db.Column(db.String(50), nullable=False)
+    files = db.Column(db.Integer, default=0)
+    total_lines = db.Column(db.Integer, default=0)
+    code_lines = db.Column(db.Integer, default=0)
+    comment_lines = db.Column(db.Integer, default=0)
+    empty_lines = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('uq_current_statistics_user_language', 'user_id', 'language', unique=True),
+    )
+
+class StatisticsRollup(db.Model):
+    """Per-language sums of a user's Statistics rows over one day, week or month"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    period = db.Column(db.String(10), nullable=False)  # day, week (from Monday) or month
+    start = db.Column(db.Date, nullable=False)
+    language = db.Column(db.String(50), nullable=False)
+    files = db.Column(db.Integer, default=0)
+    total_lines = db.Column(db.Integer, default=0)
+    code_lines = db.Column(db.Integer, default=0)
+    comment_lines = db.Column(db.Integer, default=0)
+    empty_lines = db.Column(db.Integer, default=0)
+    
+    __table_args__ = (
+        db.Index('uq_statistics_rollup', 'user_id', 'period', 'start', 'language', unique=True),
+    )
 
 class Settings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     key = db.Column(db.String(50), nullable=False)
-    value = db.Column(db.String(200))
+    value = db.Column(db.Text)  # exclude_paths lists outgrow a short string
+    
+    __table_args__ = (
+        db.Index('uq_settings_user_key', 'user_id', 'key', unique=True),
+    )
 
 class CustomEndpoint(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -138,446 +355,2713 @@ class CustomEndpoint(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     user = db.relationship('User', backref='custom_endpoints')
+    
+    __table_args__ = (
+        db.Index('uq_custom_endpoint_user_path', 'user_id', 'path', unique=True),
+    )
 
-# Load language definitions
-with open('languages.json', 'r') as f:
-    LANGUAGES = json.load(f)
+# ScanJob priorities, lowest first
+SCAN_PRIORITY_MANUAL = 0
+SCAN_PRIORITY_SCHEDULED = 10
 
-# Global variable to track scanning progress per user
-scanning_progress = {}
+# A queued or running job holds its account, so the account is never queued twice
+SCAN_JOB_ACTIVE = ('queued', 'running')
 
-@login_manager.user_loader
-def load_user(user_id):
-    return db.session.get(User, int(user_id))
+class ScanJob(db.Model):
+    """One account scan in the persistent queue run by ScanWorkerPool"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    account_id = db.Column(db.Integer, db.ForeignKey('account.id'), nullable=False)
+    host = db.Column(db.String(200))  # account_host() of the account, for per-host caps
+    priority = db.Column(db.Integer, nullable=False, default=SCAN_PRIORITY_MANUAL)
+    force = db.Column(db.Boolean, default=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, deferred, failed
+    attempts = db.Column(db.Integer, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    __table_args__ = (
+        db.Index('uq_scan_job_active_account', 'account_id', unique=True,
+                 sqlite_where=status.in_(SCAN_JOB_ACTIVE), postgresql_where=status.in_(SCAN_JOB_ACTIVE)),
+        # claim_scan_job takes the first queued job by priority, then age
+        db.Index('ix_scan_job_queue', 'status', 'priority', 'id'),
+        db.Index('ix_scan_job_user_status', 'user_id', 'status'),
+    )
 
-# Helper Functions
-def get_language(filepath):
-    for language in LANGUAGES.values():
-        for extension in language['extensions']:
-            if filepath.endswith(extension):
-                return language
-    return None
+class ScanProgress(db.Model):
+    """Published scan progress: a 'summary' record per user and a 'job-<id>' record per ScanJob"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    key = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.Text, nullable=False)  # JSON
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('uq_scan_progress_user_key', 'user_id', 'key', unique=True),
+    )
 
-def count_lines_from_content(content, language):
-    try:
-        lines = content.split('\n')
-        total_lines = len(lines)
-        code_lines = 0
-        comment_lines = 0
-        empty_lines = 0
-        
-        for line in lines:
-            line = line.strip()
-            if not line:
-                empty_lines += 1
-            elif re.match(language['comment_regex'], line):
-                comment_lines += 1
-            else:
-                code_lines += 1
-        
-        return (total_lines, code_lines, comment_lines, empty_lines)
-    except Exception as e:
-        print(f"Error counting lines: {e}")
-        return (0, 0, 0, 0)
+class ScanJobRepository(db.Model):
+    """A repository a ScanJob already finished, skipped when the job is resumed"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('scan_job.id'), nullable=False)
+    repo_id = db.Column(db.String(100), nullable=False)
+    
+    __table_args__ = (
+        db.Index('uq_scan_job_repository', 'job_id', 'repo_id', unique=True),
+    )
 
-def get_file_hash(content):
-    return hashlib.sha256(content.encode('utf-8', errors='ignore')).hexdigest()
+class SchemaVersion(db.Model):
+    """Schema migrations already applied to this database"""
+    version = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-def is_binary_content(content):
-    try:
-        if isinstance(content, bytes):
-            content = content.decode('utf-8', errors='strict')
-        else:
-            content.encode('utf-8', errors='strict')
-        return '\x00' in content
-    except:
-        return True
+# Schema migrations as (version, function(connection)), applied in version order
+MIGRATIONS = []
+
+def migration(version):
+    def register(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return func
+    return register
 
-def decode_content(content):
-    """Safely decode content with multiple encoding attempts"""
-    if isinstance(content, str):
-        return content
+def migrate_database(engine=None):
+    """Create missing tables, then upgrade existing ones in place
     
-    encodings = ['utf-8', 'latin-1', 'cp1252', 'iso-8859-1', 'ascii']
+    create_all() only creates tables that do not exist yet, so indexes and
+    columns added to existing tables come from migrations. Each migration
+    runs in its own transaction together with its SchemaVersion row.
+    """
+    engine = engine or db.engine
+    db.metadata.create_all(engine)
     
-    for encoding in encodings:
-        try:
-            return content.decode(encoding)
-        except (UnicodeDecodeError, AttributeError):
-            continue
+    with engine.connect() as connection:
+        applied = set(connection.scalars(db.select(SchemaVersion.version)))
     
-    try:
-        return content.decode('utf-8', errors='ignore')
-    except:
-        return ""
+    for version, func in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            func(connection)
+            connection.execute(db.insert(SchemaVersion).values(
+                version=version, name=func.__name__, applied_at=datetime.utcnow()))
+        print(f"Applied schema migration {version}: {func.__name__}")
 
-def get_repo_hash(repo, platform='github'):
-    """Get repository hash to detect changes"""
-    try:
-        if platform == 'github':
-            # Get latest commit SHA
-            commits = repo.get_commits()
-            if commits.totalCount > 0:
-                return commits[0].sha
-        elif platform == 'gitlab':
-            # Get latest commit SHA
-            commits = repo.commits.list(per_page=1)
-            if commits:
-                return commits[0].id
-    except:
-        pass
-    return None
+def add_column(connection, model, name):
+    """ALTER TABLE ... ADD COLUMN for a model column the table does not have yet"""
+    table = model.__table__
+    if name in {column['name'] for column in db.inspect(connection).get_columns(table.name)}:
+        return
+    column_type = table.c[name].type.compile(dialect=connection.dialect)
+    connection.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}')
 
-def fetch_github_repos(account):
-    g = Github(account.access_token)
-    repos_data = []
-    
-    try:
-        for repo in g.get_user().get_repos(affiliation='owner'):
-            repos_data.append({
-                'name': repo.name,
-                'id': str(repo.id),
-                'private': repo.private,
-                'url': repo.html_url,
-                'default_branch': repo.default_branch or 'main',
-                'repo_obj': repo
-            })
-    except Exception as e:
-        print(f"Error fetching repos: {e}")
-    
-    return repos_data
+def create_indexes(connection, *models):
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(connection, checkfirst=True)
 
-def fetch_gitlab_repos(account):
-    try:
-        if account.base_url:
-            gl = gitlab.Gitlab(account.base_url, private_token=account.access_token)
-        else:
-            gl = gitlab.Gitlab('https://gitlab.com', private_token=account.access_token)
-        
-        gl.auth()
-        repos_data = []
-        
-        for project in gl.projects.list(owned=True, all=True):
-            repos_data.append({
-                'name': project.name,
-                'id': str(project.id),
-                'private': project.visibility == 'private',
-                'url': project.web_url,
-                'default_branch': project.default_branch or 'main',
-                'repo_obj': project
-            })
-        
-        return repos_data
-    except Exception as e:
-        print(f"Error fetching GitLab repos: {e}")
-        return []
+def drop_duplicate_rows(connection, model, columns):
+    """Keep only the newest row per key so a unique index can be created"""
+    table = model.__table__
+    newest = db.select(db.func.max(table.c.id)).group_by(*(table.c[column] for column in columns))
+    result = connection.execute(db.delete(table).where(table.c.id.not_in(newest)))
+    if result.rowcount:
+        print(f"  Removed {result.rowcount} duplicate {table.name} rows")
 
-def analyze_github_repo(account, repo_info, force=False):
-    """Analyze GitHub repository with smart caching"""
-    g = Github(account.access_token)
-    repo = repo_info.get('repo_obj') or g.get_repo(f"{account.username}/{repo_info['name']}")
-    
-    db_repo = db.session.query(Repository).filter_by(
-        account_id=account.id,
-        repo_id=repo_info['id']
-    ).first()
-    
-    # Check if repository has changed
-    current_hash = get_repo_hash(repo, 'github')
-    
-    if not db_repo:
-        db_repo = Repository(
-            account_id=account.id,
-            repo_name=repo_info['name'],
-            repo_id=repo_info['id'],
-            is_private=repo_info['private'],
-            repo_hash=current_hash
-        )
-        db.session.add(db_repo)
-        db.session.commit()
-    elif not force and db_repo.repo_hash == current_hash:
-        # Repository hasn't changed, use cached data
-        print(f"  ⚡ Using cached data for {repo_info['name']} (no changes)")
-        stats = {}
-        for cached_file in db_repo.files:
-            lang_name = cached_file.language
-            if lang_name not in stats:
-                stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
-            stats[lang_name]['files'] += 1
-            stats[lang_name]['total'] += cached_file.total_lines
-            stats[lang_name]['code'] += cached_file.code_lines
-            stats[lang_name]['comment'] += cached_file.comment_lines
-            stats[lang_name]['empty'] += cached_file.empty_lines
-        return stats
-    
-    # Repository has changed, update it
-    print(f"  🔄 Repository changed, updating {repo_info['name']}")
-    db_repo.repo_hash = current_hash
+@migration(1)
+def add_composite_indexes(connection):
+    models = (Repository, FileCache, Statistics, DailyActivity, Settings, CustomEndpoint)
+    for model in models:
+        for index in model.__table__.indexes:
+            if index.unique:
+                drop_duplicate_rows(connection, model, [column.name for column in index.columns])
     
-    stats = {}
+    # Cache rows that belonged to a dropped duplicate repository
+    connection.execute(db.delete(FileCache).where(FileCache.repo_id.not_in(db.select(Repository.id))))
+    create_indexes(connection, *models)
+
+@migration(2)
+def backfill_repository_language_stats(connection):
+    connection.execute(db.delete(RepositoryLanguageStats))
+    connection.execute(db.insert(RepositoryLanguageStats).from_select(
+        ['repo_id', 'language', 'files', 'total_lines', 'code_lines', 'comment_lines', 'empty_lines'],
+        db.select(
+            FileCache.repo_id,
+            FileCache.language,
+            db.func.count(),
+            db.func.sum(FileCache.total_lines),
+            db.func.sum(FileCache.code_lines),
+            db.func.sum(FileCache.comment_lines),
+            db.func.sum(FileCache.empty_lines)
+        ).where(FileCache.language.is_not(None)).group_by(FileCache.repo_id, FileCache.language)
+    ))
+
+@migration(3)
+def add_repository_head_etag(connection):
+    add_column(connection, Repository, 'head_etag')
+
+@migration(4)
+def add_scan_job_host(connection):
+    add_column(connection, ScanJob, 'host')
+    # Jobs queued before the column existed are held to the per-host cap too
+    accounts = connection.execute(db.select(Account.id, Account.platform, Account.base_url).where(
+        Account.id.in_(db.select(ScanJob.account_id).where(ScanJob.host.is_(None))))).all()
+    for account in accounts:
+        connection.execute(db.update(ScanJob).where(ScanJob.account_id == account.id, ScanJob.host.is_(None))
+                           .values(host=account_host(account)))
+
+@migration(5)
+def backfill_statistics_rollups(connection):
+    rebuild_statistics_rollups(connection)
+
+@migration(6)
+def backfill_current_statistics(connection):
+    refresh_current_statistics(connection)
+
+@migration(7)
+def rescan_with_path_filter(connection):
+    # Cached rows of vendored and generated files are only pruned by a full
+    # tree scan; unchanged files still come from FileCache
+    connection.execute(db.update(Repository).values(repo_hash=None))
+
+@migration(8)
+def widen_settings_value(connection):
+    # SQLite does not enforce VARCHAR lengths, other databases need the column altered
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql('ALTER TABLE settings ALTER COLUMN value TYPE TEXT')
+    elif connection.dialect.name in ('mysql', 'mariadb'):
+        connection.exec_driver_sql('ALTER TABLE settings MODIFY value TEXT')
+
+# Load language definitions
+with open('languages.json', 'r') as f:
+    LANGUAGES = json.load(f)
+
+class LanguageRegistry:
+    """Hash index over language definitions for constant-time path lookups"""
     
-    try:
-        branches_to_try = [repo_info.get('default_branch', 'main'), 'master', 'main']
-        contents = None
+    def __init__(self, languages):
+        self.languages = languages
+        self.by_suffix = {}
+        self.by_filename = {}
+        self.by_name = {}
+        self.max_suffix_dots = 1
         
-        for branch in branches_to_try:
-            try:
-                contents = repo.get_contents("", ref=branch)
-                break
-            except:
-                continue
+        # First definition wins when several languages share a suffix,
+        # matching the order get_language used to scan LANGUAGES in
+        for language in languages.values():
+            for extension in language.get('extensions', []):
+                self.by_suffix.setdefault(extension, language)
+                self.max_suffix_dots = max(self.max_suffix_dots, extension.count('.'))
+            for filename in language.get('filenames', []):
+                self.by_filename.setdefault(filename, language)
+            self.by_name.setdefault(language['name'], language)
         
-        if not contents:
-            print(f"Could not access any branch for {repo_info['name']}")
-            return stats
+        self.classifiers = {}
+        for language in languages.values():
+            self.classifiers.setdefault(language['name'], LineClassifier(language))
+    
+    def lookup(self, filepath):
+        basename = filepath.rsplit('/', 1)[-1]
         
-        while contents:
-            file_content = contents.pop(0)
-            if file_content.type == "dir":
-                try:
-                    contents.extend(repo.get_contents(file_content.path, ref=branch))
-                except:
-                    continue
-            else:
-                process_github_file(db_repo, repo, file_content, stats, branch)
-                
-    except Exception as e:
-        print(f"Error processing repo {repo_info['name']}: {e}")
+        language = self.by_filename.get(basename)
+        if language:
+            return language
+        
+        # Try the longest known suffix first so '.d.ts' beats '.ts'
+        dots = [i for i, char in enumerate(basename) if char == '.']
+        for index in dots[-self.max_suffix_dots:]:
+            language = self.by_suffix.get(basename[index:])
+            if language:
+                return language
+        return None
     
-    db_repo.last_updated = datetime.utcnow()
-    db.session.commit()
+    def get_classifier(self, language):
+        classifier = self.classifiers.get(language['name'])
+        if not classifier:
+            classifier = self.classifiers[language['name']] = LineClassifier(language)
+        return classifier
     
-    return stats
+    def classify_paths(self, paths):
+        """Classify a whole tree listing at once, returning {path: language} for known files"""
+        lookup = self.lookup
+        classified = {}
+        for path in paths:
+            language = lookup(path)
+            if language:
+                classified[path] = language
+        return classified
 
-def process_github_file(db_repo, repo, file_content, stats, branch='main'):
-    language = get_language(file_content.path)
-    if not language:
-        return
-    
-    cached_file = db.session.query(FileCache).filter_by(
-        repo_id=db_repo.id,
-        file_path=file_content.path
-    ).first()
+# Multi-line token syntax: scan finds it in a window, token matches it from
+# its opener and tail from inside, with group 1 set when it closes
+TokenKind = namedtuple('TokenKind', ['opener', 'closer', 'role', 'escapes', 'scan', 'token', 'tail'])
+
+class LineClassifier:
+    """Compiled comment and string syntax for one language, derived from its comment_regex
     
-    file_sha = file_content.sha
+    Lines are first classified by how they start once whitespace is gone:
+    empty, a comment marker, or code. correct() then fixes the lines covered
+    by tokens spanning several lines or following code: block comments,
+    'docstrings' (multi-line strings that count as comments when a statement
+    starts with them, like Python's triple quotes), 'multiline_strings' that
+    stay code (JavaScript's template literals) and 'raw_strings', multi-line
+    strings without backslash escapes (Go's backquoted strings). 'strings',
+    '"' and "'" by default, end on their line and only hide the markers in
+    them.
+    """
     
-    if cached_file and cached_file.file_hash == file_sha:
-        lang_name = language['name'].upper()
-        if lang_name not in stats:
-            stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
-        
-        stats[lang_name]['files'] += 1
-        stats[lang_name]['total'] += cached_file.total_lines
-        stats[lang_name]['code'] += cached_file.code_lines
-        stats[lang_name]['comment'] += cached_file.comment_lines
-        stats[lang_name]['empty'] += cached_file.empty_lines
-        return
+    WHITESPACE = b' \t\r\f\v'
+    # A string opening a line after one of these continues an expression, so it is no docstring
+    CONTINUATION = b'([{,=+%\\'
+    # Prefixes a docstring may carry, e.g. r"""...""" for one with backslashes
+    DOCSTRING_PREFIXES = b'rRuU'
+    NEWLINE_RUN = re.compile(b'\n\n\n+')
     
-    try:
-        file_obj = repo.get_contents(file_content.path, ref=branch)
-        
-        if file_obj.size > 10 * 1024 * 1024:
-            print(f"Skipping large file (>{file_obj.size} bytes): {file_content.path}")
-            return
-        
-        content = None
-        
-        try:
-            if hasattr(file_obj, 'decoded_content') and file_obj.decoded_content:
-                content = decode_content(file_obj.decoded_content)
-            elif file_obj.encoding == 'none' or not content:
-                raw_url = file_obj.download_url
-                if raw_url:
-                    response = requests.get(raw_url, timeout=30)
-                    if response.status_code == 200:
-                        content = decode_content(response.content)
-            elif file_obj.content:
-                raw_content = base64.b64decode(file_obj.content)
-                content = decode_content(raw_content)
-                
-        except Exception as e:
-            print(f"Could not decode {file_content.path}: {e}")
-            return
-        
-        if not content or is_binary_content(content):
-            return
+    def __init__(self, language):
+        line_prefixes, block_pairs = self.parse_comment_regex(language.get('comment_regex', ''))
+        line_prefixes += language.get('line_comments', [])
+        block_pairs += [tuple(pair) for pair in language.get('block_comments', [])]
         
-        total, code, comment, empty = count_lines_from_content(content, language)
+        closers = {}
+        for opener, closer in block_pairs:
+            closers.setdefault(opener.encode('utf-8'), closer.encode('utf-8'))
+        prefixes = sorted({prefix.encode('utf-8') for prefix in line_prefixes}, key=len, reverse=True)
+        docstrings = self._delimiters(language, 'docstrings')
+        multiline = self._delimiters(language, 'multiline_strings')
+        raw = self._delimiters(language, 'raw_strings')
+        # Comments come first, so a delimiter that also opens a comment (VBScript's ') is a comment
+        strings = sorted(self._delimiters(language, 'strings', ['"', "'"]) - docstrings - multiline - raw
+                         - set(prefixes), key=len, reverse=True)
         
-        if cached_file:
-            cached_file.file_hash = file_sha
-            cached_file.total_lines = total
-            cached_file.code_lines = code
-            cached_file.comment_lines = comment
-            cached_file.empty_lines = empty
-            cached_file.last_modified = datetime.utcnow()
-            cached_file.cached_at = datetime.utcnow()
-        else:
-            cached_file = FileCache(
-                repo_id=db_repo.id,
-                file_path=file_content.path,
-                file_hash=file_sha,
-                language=language['name'].upper(),
-                total_lines=total,
-                code_lines=code,
-                comment_lines=comment,
-                empty_lines=empty,
-                last_modified=datetime.utcnow()
-            )
-            db.session.add(cached_file)
+        # A line starting with a line comment marker is a comment line until
+        # correct() says otherwise. No marker starts with another, so each
+        # line matches one at most.
+        starts = set(prefixes)
+        self.starts = tuple(start for start in starts
+                            if not any(other != start and start.startswith(other) for other in starts))
+        self.line_markers = [b'\n' + start for start in self.starts]
         
-        lang_name = language['name'].upper()
-        if lang_name not in stats:
-            stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
+        # What may follow a comment on a comment line
+        self.no_code = rb'(?:\n|\Z' + b''.join(b'|' + re.escape(prefix) for prefix in prefixes) + b')'
+        self.no_code_re = re.compile(self.no_code)
         
-        stats[lang_name]['files'] += 1
-        stats[lang_name]['total'] += total
-        stats[lang_name]['code'] += code
-        stats[lang_name]['comment'] += comment
-        stats[lang_name]['empty'] += empty
+        # Code ahead of a token opened after code on its line: no line
+        # comment and no unclosed string. Every alternative starts with a
+        # different byte, so a fullmatch() that fails does not backtrack.
+        specials = sorted({token[:1] for token in strings + prefixes})
+        parts = [b'[^' + b''.join(map(re.escape, specials)) + b']' if specials else rb'[\s\S]']
+        parts += [self._closed_string(delimiter) for delimiter in strings]
+        for special in specials:
+            if special not in prefixes and not any(delimiter.startswith(special) for delimiter in strings):
+                rests = [re.escape(prefix[1:]) for prefix in prefixes if prefix.startswith(special)]
+                parts.append(re.escape(special) + b'(?!' + b'|'.join(rests) + b')')
+        self.code_re = re.compile(b'(?:' + b'|'.join(parts) + b')*')
         
-        db.session.commit()
+        kinds = [self._kind(opener, closer, 'comment', False) for opener, closer in closers.items()]
+        kinds += [self._kind(delimiter, delimiter, 'docstring', True) for delimiter in docstrings]
+        kinds += [self._kind(delimiter, delimiter, 'string', True) for delimiter in multiline]
+        kinds += [self._kind(delimiter, delimiter, 'string', False) for delimiter in raw]
+        # Longer openers first when one is a prefix of another
+        self.kinds = sorted(kinds, key=lambda kind: len(kind.opener), reverse=True)
+        # Literals that send a window from _correct_scan() to _correct_tokens()
+        # when scanned tokens hold them: the opener of another kind, which may
+        # be inside a token, and an escaped closer
+        self.openers = {kind.opener: re.compile(re.escape(kind.opener)) for kind in self.kinds}
+        self.escaped = {kind.opener: re.compile(re.escape(b'\\' + kind.closer[:1])) for kind in self.kinds if kind.escapes}
+    
+    @staticmethod
+    def _delimiters(language, key, default=()):
+        return {delimiter.encode('utf-8') for delimiter in language.get(key, default)}
+    
+    def _kind(self, opener, closer, role, escapes):
+        r"""TokenKind of a block comment or multi-line string
         
-    except Exception as e:
-        print(f"Error processing file {file_content.path}: {e}")
-
-def analyze_gitlab_repo(account, repo_info, force=False):
-    """Analyze GitLab repository with smart caching"""
-    try:
-        if account.base_url:
-            gl = gitlab.Gitlab(account.base_url, private_token=account.access_token)
+        scan is a findall() pattern for correct()'s fast path, used when
+        every token kind in a window is a comment or docstring. It matches a token opening its
+        line (and, for a docstring, a statement) up to the first byte of any
+        code after it, and just the opener anywhere else. Its body ignores
+        escapes and uses negated single-byte classes, which sre runs much
+        faster than a lazy [\s\S]*? or a class of two bytes.
+        """
+        head = re.escape(closer[:1])
+        guard = b'(?!' + re.escape(closer[1:]) + b')' if len(closer) > 1 else b''
+        body = b'[^' + head + b']*' + (b'(?:' + head + guard + b'[^' + head + b']*)*' if guard else b'')
+        if escapes:
+            other = b'[^' + head + rb'\\]*'
+            escape = rb'\\[\s\S]' + (b'|' + head + guard if guard else b'')
+            tail = other + b'(?:(?:' + escape + b')' + other + b')*(?:(' + re.escape(closer) + rb')|\\?\Z)'
         else:
-            gl = gitlab.Gitlab('https://gitlab.com', private_token=account.access_token)
-        
-        gl.auth()
-        project = repo_info.get('repo_obj') or gl.projects.get(repo_info['id'])
-        
-        db_repo = db.session.query(Repository).filter_by(
-            account_id=account.id,
-            repo_id=repo_info['id']
-        ).first()
-        
-        # Check if repository has changed
-        current_hash = get_repo_hash(project, 'gitlab')
-        
-        if not db_repo:
-            db_repo = Repository(
-                account_id=account.id,
-                repo_name=repo_info['name'],
-                repo_id=repo_info['id'],
-                is_private=repo_info['private'],
-                repo_hash=current_hash
-            )
-            db.session.add(db_repo)
-            db.session.commit()
-        elif not force and db_repo.repo_hash == current_hash:
-            # Repository hasn't changed, use cached data
-            print(f"  ⚡ Using cached data for {repo_info['name']} (no changes)")
-            stats = {}
-            for cached_file in db_repo.files:
-                lang_name = cached_file.language
-                if lang_name not in stats:
-                    stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
-                stats[lang_name]['files'] += 1
-                stats[lang_name]['total'] += cached_file.total_lines
-                stats[lang_name]['code'] += cached_file.code_lines
-                stats[lang_name]['comment'] += cached_file.comment_lines
-                stats[lang_name]['empty'] += cached_file.empty_lines
-            return stats
-        
-        # Repository has changed, update it
-        print(f"  🔄 Repository changed, updating {repo_info['name']}")
-        db_repo.repo_hash = current_hash
-        
-        stats = {}
-        
-        try:
-            items = project.repository_tree(recursive=True, all=True)
-            for item in items:
-                if item['type'] == 'blob':
-                    process_gitlab_file(db_repo, project, item, stats)
-        except Exception as e:
-            print(f"Error processing repo {repo_info['name']}: {e}")
-        
-        db_repo.last_updated = datetime.utcnow()
-        db.session.commit()
+            tail = body + b'(?:(' + re.escape(closer) + rb')|\Z)'
         
-        return stats
-        
-    except Exception as e:
-        print(f"Error with GitLab repo {repo_info['name']}: {e}")
-        return {}
-
-def process_gitlab_file(db_repo, project, item, stats):
-    language = get_language(item['path'])
-    if not language:
-        return
+        delimiter = re.escape(opener)
+        scan = None
+        if role == 'comment':
+            scan = b'(?<=\n' + delimiter + b')'
+        elif role == 'docstring':
+            # One after more than two empty lines is left to the exact path, which looks further back
+            continuation = b'[' + re.escape(self.CONTINUATION) + b']'
+            scan = (b'(?<=\n' + delimiter + b')' + b''.join(b'(?<!' + continuation + b'\n' * lines + delimiter + b')'
+                                                             for lines in (1, 2, 3))
+                    + b'(?<!\n\n\n\n' + delimiter + b')')
+        if scan:
+            # Code after the closer adds its first byte, unless that repeats the closer's last one
+            after = b'(?:(?=' + self.no_code + rb')|[^\n' + re.escape(closer[-1:]) + b'])'
+            scan = re.compile(delimiter + b'(?:' + scan + body + b'(?:' + re.escape(closer) + after + rb'|\Z))?')
+        return TokenKind(opener, closer, role, escapes, scan, re.compile(delimiter + tail), re.compile(tail))
     
-    cached_file = db.session.query(FileCache).filter_by(
-        repo_id=db_repo.id,
-        file_path=item['path']
-    ).first()
+    @staticmethod
+    def _closed_string(delimiter):
+        """Unrolled pattern of a single-line string literal with backslash escapes"""
+        head = re.escape(delimiter[:1])
+        other = b'[^' + head + rb'\\\n]*'
+        return re.escape(delimiter) + other + rb'(?:\\.' + other + b')*' + re.escape(delimiter)
     
-    file_id = item['id']
+    @staticmethod
+    def parse_comment_regex(pattern):
+        """Split 'X.*$|Y.*?Z' style patterns into line prefixes and block delimiters"""
+        line_prefixes = []
+        block_pairs = []
+        for part in re.split(r'(?<!\\)\|', pattern):
+            part = part.lstrip('^')
+            if '.*?' in part:
+                opener, closer = part.split('.*?', 1)
+                block_pairs.append((re.sub(r'\\(.)', r'\1', opener), re.sub(r'\\(.)', r'\1', closer)))
+            elif part.endswith('.*$') or part.endswith('.*'):
+                prefix = re.sub(r'\\(.)', r'\1', part.rsplit('.*', 1)[0])
+                if prefix:
+                    line_prefixes.append(prefix)
+        return line_prefixes, block_pairs
     
-    if cached_file and cached_file.file_hash == file_id:
-        lang_name = language['name'].upper()
-        if lang_name not in stats:
-            stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
+    def line_starts(self, text):
+        """(lines, empty lines, lines starting with a comment marker) of text without whitespace
         
-        stats[lang_name]['files'] += 1
-        stats[lang_name]['total'] += cached_file.total_lines
-        stats[lang_name]['code'] += cached_file.code_lines
-        stats[lang_name]['comment'] += cached_file.comment_lines
-        stats[lang_name]['empty'] += cached_file.empty_lines
-        return
+        Every line of text starts after a newline, so an empty line is a
+        newline followed by another or by the end of text. bytes.count()
+        finds those and the markers faster than a regex, which sre tries at
+        every newline.
+        """
+        lines = text.count(b'\n')
+        if not lines:
+            return 0, 0, 0
+        # count() skips every other pair in a run of newlines, and runs of
+        # more than two are rare enough to find with a regex
+        empty = (text.count(b'\n\n') + sum((len(run) - 1) // 2 for run in self.NEWLINE_RUN.findall(text))
+                 + text.endswith(b'\n'))
+        return lines, empty, sum(text.count(marker) for marker in self.line_markers)
     
-    try:
-        file_content = project.files.get(file_path=item['path'], ref='main')
-        raw_content = file_content.decode()
-        content = decode_content(raw_content)
+    def correct(self, text):
+        """How many more lines of text are comments than line_starts() says
         
-        if is_binary_content(content):
-            return
+        Returns that with the (kind, comment) of a token still open at the
+        end of text, or None.
+        """
+        # sre finds a literal faster than bytes.find()
+        kinds = [kind for kind in self.kinds if kind.token.search(text)]
+        if not kinds:
+            return 0, None
+        if all(kind.scan for kind in kinds):
+            corrected = self._correct_scan(kinds, text)
+            if corrected:
+                return corrected
+        return self._correct_tokens(kinds, text)
+    
+    def _correct_scan(self, kinds, text):
+        """correct() for a window where every token opens its line, or None"""
+        if b'\0' in text:
+            return None
+        delta = 0
+        opened = None
+        for kind in kinds:
+            tokens = kind.scan.findall(text)
+            # A bare opener is not at a line start
+            if kind.opener in tokens:
+                return None
+            joined = b'\0' + b'\0'.join(tokens) + b'\0'
+            literals = [self.openers[other.opener] for other in kinds if other is not kind]
+            if kind.escapes:
+                literals.append(self.escaped[kind.opener])
+            if any(literal.search(joined) for literal in literals):
+                return None
+            open_at_end = kind.token.match(tokens[-1]).group(1) is None
+            if open_at_end:
+                opened = (kind, True)
+            delta += self._token_lines(kind, tokens, joined, open_at_end)
+        return delta, opened
+    
+    def _token_lines(self, kind, tokens, joined, opened):
+        """Comment lines of scanned tokens that line_starts() counted as code or empty, less those ending in code
         
-        total, code, comment, empty = count_lines_from_content(content, language)
+        joined holds the tokens between NUL bytes, so line_starts() counts
+        their lines in one pass instead of a pass per token.
+        """
+        lines, empty, starts = self.line_starts(joined)
+        closer = kind.closer
+        # Tokens not followed by code end with their closer
+        code_after = (len(tokens) - opened - joined.count(closer + b'\0')
+                      + (opened and tokens[-1].endswith(closer)))
+        first_lines = 0 if kind.opener.startswith(self.starts) else len(tokens)
+        return first_lines + lines - empty - starts - code_after
+    
+    def _find(self, kind, text, position):
+        """(start, scan match or None) of the next opener of kind from position, or (-1, None)"""
+        if not kind.scan:
+            return text.find(kind.opener, position), None
+        match = kind.scan.search(text, position)
+        return (match.start(), match) if match else (-1, None)
+    
+    def _correct_tokens(self, kinds, text):
+        """correct() token by token, checking the code ahead of tokens that do not open their line
         
+        Tokens the scans match whole are collected and counted per kind like
+        in _correct_scan().
+        """
+        scanned = {kind: [] for kind in kinds}
+        comments = []
+        strings = []
+        code_after = 0
+        run = None
+        opened = None
+        open_scanned = None
+        # text[0] may be the byte before the window
+        position = 1
+        found = [self._find(kind, text, position) for kind in kinds]
+        while True:
+            index = -1
+            for i, kind in enumerate(kinds):
+                if -1 < found[i][0] < position:
+                    found[i] = self._find(kind, text, position)
+                if found[i][0] != -1 and (index == -1 or found[i][0] < found[index][0]):
+                    index = i
+            if index == -1:
+                break
+            kind = kinds[index]
+            start, match = found[index]
+            token = match and match.group()
+            if token and len(token) > len(kind.opener) and not (kind.escapes and b'\\' + kind.closer[:1] in token):
+                scanned[kind].append(token)
+                if match.end() == len(text) and kind.token.match(token).group(1) is None:
+                    opened = (kind, True)
+                    open_scanned = kind
+                    break
+                # The code byte after it may open the next token
+                position = match.end() - (not token.endswith(kind.closer))
+                continue
+            
+            line = text.rfind(b'\n', 0, start) + 1
+            at_line_start = start == line or (kind.role == 'docstring' and start == line + 1
+                                              and text[line] in self.DOCSTRING_PREFIXES)
+            if not at_line_start and not self.code_re.fullmatch(text, max(line, position), start):
+                # Inside a string or line comment
+                found[index] = self._find(kind, text, start + 1)
+                continue
+            
+            match = kind.token.match(text, start)
+            end = match.end()
+            comment = kind.role == 'comment' or (kind.role == 'docstring' and at_line_start
+                                                 and self._statement_start(text, line))
+            if not comment:
+                first = text.find(b'\n', start, end)
+                if first != -1:
+                    strings.append(text[first:end])
+            elif run and run[1] == start:
+                # Comments next to each other end their line as one
+                run[1] = end
+            else:
+                if run:
+                    code_after += self._end_run(text, run, comments)
+                run = [start, end, at_line_start]
+            position = end
+            if match.group(1) is None:
+                opened = (kind, comment)
+                break
+        if run:
+            code_after += self._end_run(text, run, comments)
+        
+        delta = sum(self._token_lines(kind, tokens, b'\0' + b'\0'.join(tokens) + b'\0', kind is open_scanned)
+                    for kind, tokens in scanned.items() if tokens)
+        lines, empty, starts = self.line_starts(b''.join(comments))
+        return delta + lines - empty - starts - code_after - self.line_starts(b''.join(strings))[2], opened
+    
+    def _end_run(self, text, run, comments):
+        """Add the comment lines of a run of comments to comments, returning 1 when code follows it"""
+        start, end, at_line_start = run
+        if at_line_start:
+            comments.append(b'\n' + text[start:end])
+        else:
+            # Its first line holds code
+            start = text.find(b'\n', start, end)
+            if start == -1:
+                return 0
+            comments.append(text[start:end])
+        return 0 if self.no_code_re.match(text, end) else 1
+    
+    def _statement_start(self, text, line):
+        """Whether the line starting at text[line] starts a statement rather than continuing one"""
+        last = text[max(0, line - 1024):line].rstrip(b'\n')[-1:]
+        return not last or last not in self.CONTINUATION
+
+class LineCounter:
+    """Streaming line counter that keeps comment and string state between chunks
+    
+    Work happens in windows of whole lines: translate() drops whitespace,
+    split() and count() classify every line as empty, comment or code by its
+    first bytes, and the classifier corrects the lines covered by block
+    comments and multi-line strings. Windows without such tokens need no
+    further pass, and windows where they all open their lines need one
+    findall() per token kind, so extra memory stays bounded by WINDOW
+    regardless of the file size. A token still open at the end of a window
+    is carried over.
+    """
+    
+    WINDOW = 256 * 1024
+    # A line longer than this keeps only its first and last MAX_LINE / 2
+    # bytes: it still counts as one line of the same kind, but comment and
+    # string markers in the dropped middle are missed
+    MAX_LINE = 4 * WINDOW
+    
+    def __init__(self, classifier):
+        self.classifier = classifier
+        # (kind, comment) of a token open at the end of the last window
+        self.open = None
+        # Last byte ahead of the window, which decides whether a docstring opening it continues an expression
+        self.before = b''
+        self.pending = b''
+        self.total = 0
+        self.code = 0
+        self.comment = 0
+        self.empty = 0
+    
+    def feed(self, chunk):
+        if not isinstance(chunk, (bytes, bytearray)):
+            chunk = bytes(chunk)
+        data = self.pending + chunk if self.pending else chunk
+        cut = data.rfind(b'\n')
+        if cut == -1:
+            if len(data) > self.MAX_LINE:
+                data = data[:self.MAX_LINE // 2] + data[-(self.MAX_LINE // 2):]
+            self.pending = data
+            return
+        self._count(data, 0, cut)
+        self.pending = data[cut + 1:]
+    
+    def finish(self):
+        # Like str.split('\n'), the text after the last newline is a line too
+        self._count(self.pending, 0, len(self.pending))
+        self.pending = b''
+        return (self.total, self.code, self.comment, self.empty)
+    
+    def _count(self, buf, start, end):
+        """Count the lines in [start, end), where end is a line end"""
+        while True:
+            stop = buf.find(b'\n', start + self.WINDOW, end) if end - start > self.WINDOW else -1
+            self._count_window(buf[start:end if stop == -1 else stop])
+            if stop == -1:
+                return
+            start = stop + 1
+    
+    def _count_window(self, text):
+        classifier = self.classifier
+        text = text.translate(None, classifier.WHITESPACE)
+        if self.open:
+            text = self._close(text)
+            if text is None:
+                return
+        
+        text = self.before + b'\n' + text
+        lines, empty, comment = classifier.line_starts(text)
+        if classifier.kinds:
+            delta, self.open = classifier.correct(text)
+            comment += delta
+        self._add(lines, empty, comment)
+        self.before = text[-1024:].rstrip(b'\n')[-1:] or self.before
+    
+    def _close(self, text):
+        """Count the lines of text inside the token left open, returning the rest of text or None"""
+        kind, comment = self.open
+        match = kind.tail.match(text)
+        if match.group(1) is None:
+            lines, empty, _ = self.classifier.line_starts(b'\n' + text)
+            self._add(lines, empty, lines - empty if comment else 0)
+            self.before = text[-1024:].rstrip(b'\n')[-1:] or self.before
+            return None
+        
+        self.open = None
+        head = text.rfind(b'\n', 0, match.start(1))
+        if head != -1:
+            lines, empty, _ = self.classifier.line_starts(b'\n' + text[:head])
+            self._add(lines, empty, lines - empty if comment else 0)
+        # The line of the closer starts with a whole token of the same kind instead
+        self.before = b''
+        return (kind.opener + kind.closer if comment else b'0') + text[match.end():]
+    
+    def _add(self, lines, empty, comment):
+        self.total += lines
+        self.empty += empty
+        self.comment += comment
+        self.code += lines - empty - comment
+
+language_registry = LanguageRegistry(LANGUAGES)
+
+# Bytes read from a download at a time
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Bytes at the start of a file that decide its encoding and whether it is binary
+SNIFF_BYTES = 8 * 1024
+
+# Checked in order: the UTF-32 LE mark starts with the UTF-16 LE one
+BYTE_ORDER_MARKS = (
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+)
+
+# GitHub's compare API lists at most this many files
+GITHUB_COMPARE_MAX_FILES = 300
+
+# ProgressTrackers of the jobs running in this process, by job id
+progress_trackers = {}
+progress_trackers_lock = threading.Lock()
+
+# Process pool counting downloaded files for every scan in this process
+counting_pools = {}
+counting_pools_lock = threading.Lock()
+
+# Per-host download slots shared by every scan in this process
+host_limits = {}
+host_limits_lock = threading.Lock()
+
+# RateLimiters by (host, credential digest), shared by every account and scan
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# A file that needs downloading: source is the platform object to fetch it from
+FileJob = namedtuple('FileJob', ['path', 'sha', 'language', 'source'])
+
+# FileJob source for the threaded GitHub scanner; ref is only used by the contents API
+# and headers authenticate raw blob downloads
+GitHubSource = namedtuple('GitHubSource', ['repo', 'limiter', 'ref', 'headers'])
+
+# A path touched between two commits; sha is the new blob id when the platform reports it
+FileChange = namedtuple('FileChange', ['path', 'sha', 'removed'])
+
+@login_manager.user_loader
+def load_user(user_id):
+    return db.session.get(User, int(user_id))
+
+# Database connections
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Put every new SQLite connection in WAL mode with a busy timeout"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    
+    cursor = dbapi_connection.cursor()
+    # WAL lets readers and one writer work at once; NORMAL sync is still
+    # crash-safe in WAL mode and skips an fsync per commit
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(app.config['DB_BUSY_TIMEOUT'] * 1000)}")
+    cursor.close()
+
+def make_read_only(dbapi_connection, connection_record):
+    """Refuse writes on SQLite connections of the read engine"""
+    # Other databases enforce it with a read-only role or replica in DATABASE_READ_URL
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.execute('PRAGMA query_only=ON')
+
+with app.app_context():
+    for engine in db.engines.values():
+        event.listen(engine, 'connect', configure_sqlite_connection)
+    event.listen(db.engines['read'], 'connect', make_read_only)
+
+def read_session():
+    """Session on the read engine for the current request.
+    
+    Pages and read-only APIs use it, so they never wait on db.session
+    connections held by scan workers; it is closed with the app context.
+    """
+    if 'read_session' not in g:
+        g.read_session = Session(db.engines['read'])
+    return g.read_session
+
+@app.teardown_appcontext
+def close_read_session(exception=None):
+    read = g.pop('read_session', None)
+    if read is not None:
+        read.close()
+
+# Helper Functions
+def get_language(filepath):
+    return language_registry.lookup(filepath)
+
+def classify_paths(paths):
+    return language_registry.classify_paths(paths)
+
+def count_lines_from_content(content, language):
+    """Count (total, code, comment, empty) lines of a str or bytes-like buffer"""
+    try:
+        if isinstance(content, str):
+            content = content.encode('utf-8', errors='surrogatepass')
+        counter = LineCounter(language_registry.get_classifier(language))
+        counter.feed(content)
+        return counter.finish()
+    except Exception as e:
+        print(f"Error counting lines: {e}")
+        return (0, 0, 0, 0)
+
+def count_raw_content(raw_content, language):
+    """Count downloaded bytes in one pass, or None for binary/empty files"""
+    stream = StreamingCount(language)
+    stream.feed(raw_content)
+    return stream.finish()
+
+class CountingPool:
+    """Counts downloaded files on worker processes, a batch at a time
+    
+    Counting is pure-Python CPU work, so on the fetch threads it is bound by
+    the GIL. submit() collects files into batches and sends each batch to a
+    worker process as (raw bytes, language name) pairs; the worker counts
+    them with its own compiled LineClassifiers and sends back one
+    (total, code, comment, empty) tuple or None per file. A partial batch is
+    sent after delay seconds, or at once by flush().
+    
+    Workers are spawned rather than forked, so they never inherit locks held
+    by the scan and fetch threads of this process.
+    """
+    
+    def __init__(self, workers, batch_files=None, batch_bytes=None, delay=None):
+        self.workers = workers
+        self.batch_files = batch_files or app.config['COUNT_BATCH_FILES']
+        self.batch_bytes = batch_bytes or app.config['COUNT_BATCH_BYTES']
+        self.delay = app.config['COUNT_BATCH_DELAY'] if delay is None else delay
+        self.executor = self._executor()
+        self.lock = threading.Lock()
+        self.batch = []
+        self.size = 0
+        self.timer = None
+    
+    def _executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+    
+    def submit(self, raw_content, language):
+        """Future of count_raw_content(raw_content, language)"""
+        future = Future()
+        with self.lock:
+            self.batch.append((raw_content, language['name'], future))
+            self.size += len(raw_content)
+            if len(self.batch) >= self.batch_files or self.size >= self.batch_bytes:
+                self._send()
+            elif not self.timer:
+                self.timer = threading.Timer(self.delay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+        return future
+    
+    def flush(self):
+        with self.lock:
+            self._send()
+    
+    def result(self, future):
+        """Wait for a submitted file, sending its batch off first if it is still collecting"""
+        if not future.done():
+            self.flush()
+        return future.result()
+    
+    def shutdown(self):
+        self.flush()
+        self.executor.shutdown()
+    
+    def _send(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if not self.batch:
+            return
+        
+        batch, self.batch, self.size = self.batch, [], 0
+        items = [(raw_content, name) for raw_content, name, _ in batch]
+        futures = [future for _, _, future in batch]
+        try:
+            done = self.executor.submit(count_batch, items)
+        except BrokenProcessPool:
+            # A worker died (e.g. killed for memory); start a fresh pool
+            print("Counting pool broke, restarting it")
+            self.executor = self._executor()
+            done = self.executor.submit(count_batch, items)
+        done.add_done_callback(lambda done: self._deliver(done, futures))
+    
+    @staticmethod
+    def _deliver(done, futures):
+        try:
+            results = done.result()
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future, counts in zip(futures, results):
+            future.set_result(counts)
+
+def count_batch(items):
+    """Counting pool worker: count (raw bytes, language name) pairs into compact tuples"""
+    return [count_raw_content(raw_content, language_registry.by_name[name]) for raw_content, name in items]
+
+def counting_pool():
+    """The process-wide CountingPool, or None when COUNT_WORKERS is 0"""
+    workers = app.config['COUNT_WORKERS']
+    if workers <= 0:
+        return None
+    with counting_pools_lock:
+        if workers not in counting_pools:
+            counting_pools[workers] = CountingPool(workers)
+        return counting_pools[workers]
+
+def count_blob(raw_content, language):
+    """Hand downloaded bytes to the counting stage; returns a Future of their counts"""
+    pool = counting_pool()
+    if pool:
+        return pool.submit(raw_content, language)
+    future = Future()
+    future.set_result(count_raw_content(raw_content, language))
+    return future
+
+def counted(future):
+    """The counts of a count_blob() future, once the counting stage has them"""
+    pool = counting_pool()
+    return pool.result(future) if pool else future.result()
+
+class FileTooLarge(Exception):
+    """A download grew past MAX_FILE_SIZE"""
+
+def sniff_encoding(sample):
+    """Encoding of a file from its first bytes, or None if it is binary
+    
+    A BOM names the encoding; otherwise a NUL byte means binary, and the
+    sample is checked to be valid UTF-8 (a character cut off at its end
+    still counts), falling back to latin-1. Every encoding but UTF-16 and
+    UTF-32 keeps ASCII as single bytes, so the counter reads those as is.
+    """
+    for bom, encoding in BYTE_ORDER_MARKS:
+        if sample.startswith(bom):
+            return encoding
+    if b'\x00' in sample:
+        return None
+    try:
+        codecs.utf_8_decode(sample, 'strict', False)
+    except UnicodeDecodeError:
+        return 'latin-1'
+    return 'utf-8'
+
+class StreamingCount:
+    """Counts one file from chunks of its raw bytes without holding the whole file
+    
+    The first SNIFF_BYTES decide the encoding; after that chunks go to the
+    LineCounter untouched, apart from a memchr for NUL bytes, instead of
+    being decoded to str and encoded back. UTF-16 and UTF-32 files are
+    transcoded to UTF-8 as they stream.
+    """
+    
+    def __init__(self, language):
+        self.counter = LineCounter(language_registry.get_classifier(language))
+        self.head = b''
+        self.encoding = None
+        self.decoder = None
+        self.size = 0
+        self.binary = False
+    
+    def feed(self, chunk):
+        if self.binary:
+            return
+        if self.encoding:
+            self._feed(chunk)
+            return
+        self.head = self.head + chunk if self.head else chunk
+        if len(self.head) >= SNIFF_BYTES:
+            self._sniff()
+    
+    def finish(self):
+        """Counts like count_raw_content(): None for an empty or binary file"""
+        if not self.encoding and not self.binary:
+            self._sniff()
+        if self.decoder and not self.binary:
+            self._feed(b'', final=True)
+        if self.binary or not self.size:
+            return None
+        return self.counter.finish()
+    
+    def _sniff(self):
+        head, self.head = self.head, b''
+        self.encoding = sniff_encoding(head[:SNIFF_BYTES])
+        if not self.encoding:
+            self.binary = True
+            return
+        if self.encoding == 'utf-8-sig':
+            head = head[len(codecs.BOM_UTF8):]
+        elif self.encoding in ('utf-16', 'utf-32'):
+            self.decoder = codecs.getincrementaldecoder(self.encoding)(errors='replace')
+        self._feed(head)
+    
+    def _feed(self, chunk, final=False):
+        if self.decoder:
+            chunk = self.decoder.decode(chunk, final).encode('utf-8', errors='surrogatepass')
+        if b'\x00' in chunk:
+            self.binary = True
+            return
+        self.size += len(chunk)
+        self.counter.feed(chunk)
+
+class BlobIngest:
+    """Receives one download chunk by chunk and turns it into a counts Future
+    
+    Files up to STREAM_FILE_SIZE are buffered and handed to count_blob()
+    whole. A larger file switches to a StreamingCount on the fetching thread,
+    so memory per download stays at about STREAM_FILE_SIZE however big the
+    file is; past MAX_FILE_SIZE the download is abandoned with FileTooLarge.
+    """
+    
+    def __init__(self, job):
+        self.job = job
+        self.chunks = []
+        self.size = 0
+        self.streaming = None
+    
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.size > app.config['MAX_FILE_SIZE']:
+            raise FileTooLarge(f"Skipping large file (>{app.config['MAX_FILE_SIZE']} bytes): {self.job.path}")
+        
+        if self.streaming is None:
+            self.chunks.append(chunk)
+            if self.size <= app.config['STREAM_FILE_SIZE']:
+                return
+            self.streaming = StreamingCount(self.job.language)
+            chunk = b''.join(self.chunks)
+            self.chunks = []
+        self.streaming.feed(chunk)
+    
+    def result(self):
+        if self.streaming is None:
+            return count_blob(b''.join(self.chunks), self.job.language)
+        future = Future()
+        future.set_result(self.streaming.finish())
+        return future
+
+def stream_download(url, headers, ingest, params=None):
+    """GET url on http_session and feed the body to ingest in chunks; returns the response headers"""
+    with http_session.get(url, headers=headers, params=params, timeout=30, stream=True) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+            ingest.feed(chunk)
+        return response.headers
+
+class RateLimitDeferred(Exception):
+    """The rate limit would block a request for longer than RATE_LIMIT_MAX_WAIT"""
+
+class ScanIncomplete(Exception):
+    """Some files of a scan could not be fetched, counted or saved"""
+
+class RateLimiter:
+    """Request pacing for one credential on one API host
+    
+    The quota is read from X-RateLimit-* (GitHub) and RateLimit-* (GitLab)
+    response headers. While plenty is left requests go out unthrottled;
+    below the reserve they are spaced so the rest lasts until the window
+    resets. Retry-After blocks every user of the credential, not just the
+    request that got it. reserve() only computes the wait, so threads sleep
+    with time.sleep and the async engine with asyncio.sleep.
+    """
+    
+    def __init__(self, host):
+        self.host = host
+        self.lock = threading.Lock()
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0
+        self.blocked_until = 0
+        self.next_slot = 0
+    
+    @staticmethod
+    def header(headers, *names):
+        for name in names:
+            value = headers.get(name)
+            if value is not None:
+                try:
+                    return float(value)
+                except ValueError:
+                    return None
+        return None
+    
+    def update(self, headers):
+        """Take the quota and any Retry-After from a response's headers"""
+        remaining = self.header(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        limit = self.header(headers, 'X-RateLimit-Limit', 'RateLimit-Limit')
+        reset_at = self.header(headers, 'X-RateLimit-Reset', 'RateLimit-Reset')
+        retry_after = self.header(headers, 'Retry-After')
+        
+        with self.lock:
+            if remaining is not None:
+                self.remaining = remaining
+                self.limit = limit or self.limit
+                self.reset_at = reset_at or self.reset_at
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+    
+    def reserve(self):
+        """Claim the next request slot and return how many seconds to wait for it"""
+        with self.lock:
+            now = time.time()
+            start = max(now, self.blocked_until, self.next_slot)
+            
+            if self.remaining is not None and self.reset_at <= now:
+                # The window has reset; the next response reports the new quota
+                self.remaining = None
+            
+            if self.remaining is not None:
+                if self.remaining < 1:
+                    start = max(start, self.reset_at)
+                else:
+                    self.remaining -= 1
+                    reserve = (self.limit or 0) * app.config['RATE_LIMIT_RESERVE']
+                    if self.remaining < reserve:
+                        self.next_slot = start + (self.reset_at - now) / (self.remaining + 1)
+            
+            delay = start - now
+            if delay > app.config['RATE_LIMIT_MAX_WAIT']:
+                raise RateLimitDeferred(f"{self.host} rate limit resets in {int(delay)}s")
+            return delay
+    
+    def retry_delay(self, status, headers, attempt):
+        """Backoff before retrying a response, or None if it should not be retried
+        
+        status None stands for a connection error. Rate-limit responses that
+        run out of retries raise RateLimitDeferred so callers can tell
+        deferred work from failed work.
+        """
+        remaining = self.header(headers, 'X-RateLimit-Remaining', 'RateLimit-Remaining')
+        rate_limited = status == 429 or (status == 403 and (remaining == 0 or 'Retry-After' in headers))
+        if not rate_limited and status is not None and status < 500:
+            return None
+        
+        if attempt >= app.config['RATE_LIMIT_RETRIES']:
+            if rate_limited:
+                raise RateLimitDeferred(f"{self.host} is still rate limited after {attempt} retries")
+            return None
+        
+        retry_after = self.header(headers, 'Retry-After')
+        delay = retry_after if retry_after else min(2 ** attempt, 60)
+        if rate_limited and remaining == 0:
+            reset_at = self.header(headers, 'X-RateLimit-Reset', 'RateLimit-Reset')
+            if reset_at:
+                delay = max(delay, reset_at - time.time())
+        # Jitter keeps workers that failed together from retrying together
+        delay *= random.uniform(1, 1.5)
+        
+        if delay > app.config['RATE_LIMIT_MAX_WAIT']:
+            raise RateLimitDeferred(f"{self.host} rate limit resets in {int(delay)}s")
+        return delay
+    
+    def call(self, func, *args, **kwargs):
+        """Run one PyGithub call paced by this limiter, retrying rate-limit and server errors"""
+        attempt = 0
+        while True:
+            time.sleep(self.reserve())
+            try:
+                result = func(*args, **kwargs)
+            except GithubException as e:
+                headers = e.headers or {}
+                self.update(headers)
+                delay = self.retry_delay(e.status, headers, attempt)
+                if delay is None:
+                    raise
+            except requests.ConnectionError:
+                delay = self.retry_delay(None, {}, attempt)
+                if delay is None:
+                    raise
+            else:
+                self.update(getattr(result, 'raw_headers', None) or {})
+                return result
+            attempt += 1
+            time.sleep(delay)
+
+def rate_limiter(host, credential=''):
+    key = (host, hashlib.sha256(credential.encode('utf-8')).hexdigest())
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = RateLimiter(host)
+        return rate_limiters[key]
+
+def request_rate_limiter(url, headers):
+    """RateLimiter of the host and credential a request is sent with"""
+    credential = headers.get('Authorization') or headers.get('PRIVATE-TOKEN') or ''
+    # 'token <token>' shares the limiter account_rate_limiter() keys by the bare token
+    return rate_limiter(urlparse(url).netloc, credential.split(' ')[-1])
+
+def account_rate_limiter(account):
+    return rate_limiter(account_host(account), account.access_token)
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """requests transport that sends every request through its credential's RateLimiter"""
+    
+    def send(self, request, **kwargs):
+        limiter = request_rate_limiter(request.url, request.headers)
+        attempt = 0
+        while True:
+            time.sleep(limiter.reserve())
+            try:
+                response = super().send(request, **kwargs)
+            except requests.ConnectionError:
+                delay = limiter.retry_delay(None, {}, attempt)
+                if delay is None:
+                    raise
+            else:
+                limiter.update(response.headers)
+                delay = limiter.retry_delay(response.status_code, response.headers, attempt)
+                if delay is None:
+                    return response
+                response.close()
+            attempt += 1
+            time.sleep(delay)
+
+def rate_limited_session(session=None):
+    """Mount RateLimitedAdapter on a requests session"""
+    session = session or requests.Session()
+    adapter = RateLimitedAdapter(pool_connections=app.config['FETCH_WORKERS'],
+                                 pool_maxsize=app.config['FETCH_WORKERS'])
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+# Keep-alive connections for head lookups and raw downloads of the threaded scanners
+http_session = rate_limited_session()
+
+def account_host(account):
+    """Host name an account's API requests go to"""
+    if account.base_url:
+        return urlparse(account.base_url).netloc or account.base_url
+    return 'api.github.com' if account.platform == 'github' else 'gitlab.com'
+
+def host_semaphore(host, setting='FETCH_PER_HOST_LIMIT'):
+    """Process-wide slots for one host, as many as the app.config setting allows"""
+    with host_limits_lock:
+        if (setting, host) not in host_limits:
+            host_limits[setting, host] = threading.BoundedSemaphore(app.config[setting])
+        return host_limits[setting, host]
+
+class FetchPipeline:
+    """Download files on a bounded worker pool and hand them to a single writer
+    
+    Workers only fetch, handing the bytes to the counting stage; every result
+    goes through a bounded queue to write(), which runs on the calling thread
+    and is therefore the only user of db.session. Results that are count_blob()
+    futures are waited for there. Once workers + queue_size jobs are in flight the
+    submitter writes results before fetching more, so a slow writer throttles
+    downloads instead of piling content up in memory. Failed files are
+    counted, and run() raises ScanIncomplete at the end so the caller does
+    not record the head as scanned.
+    """
+    
+    def __init__(self, host, workers=None, queue_size=None):
+        self.host = host
+        self.workers = workers or app.config['FETCH_WORKERS']
+        self.queue_size = queue_size or app.config['FETCH_QUEUE_SIZE']
+        self.deferred = 0
+        self.failed = 0
+    
+    def run(self, jobs, fetch, write):
+        results = queue.Queue(maxsize=self.queue_size)
+        in_flight = 0
+        self.progress = current_progress.get()
+        
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            try:
+                for job in jobs:
+                    if in_flight >= self.workers + self.queue_size:
+                        self._write_next(results, write)
+                        in_flight -= 1
+                    pool.submit(self._fetch, job, fetch, results)
+                    self.progress.add_files()
+                    in_flight += 1
+            finally:
+                # Always drain, otherwise workers blocked on a full queue
+                # would keep the pool from shutting down
+                while in_flight:
+                    self._write_next(results, write)
+                    in_flight -= 1
+        
+        if self.deferred:
+            raise RateLimitDeferred(f"{self.deferred} files deferred to the next sync by rate limits")
+        if self.failed:
+            raise ScanIncomplete(f"{self.failed} files failed and are retried on the next sync")
+    
+    def _fetch(self, job, fetch, results):
+        try:
+            with host_semaphore(self.host):
+                result = fetch(job)
+        except RateLimitDeferred as e:
+            print(f"Deferred {job.path}: {e}")
+            result = RateLimitDeferred
+        except Exception as e:
+            print(f"Error fetching {job.path}: {e}")
+            result = ScanIncomplete
+        results.put((job, result))
+    
+    def _write_next(self, results, write):
+        job, result = results.get()
+        self.progress.file_done()
+        # Counted on the writer thread, so no lock is needed
+        if result is RateLimitDeferred:
+            self.deferred += 1
+            return
+        if result is ScanIncomplete:
+            self.failed += 1
+            return
+        if isinstance(result, Future):
+            try:
+                result = counted(result)
+            except Exception as e:
+                print(f"Error counting {job.path}: {e}")
+                self.failed += 1
+                return
+        try:
+            write(job, result)
+        except Exception as e:
+            print(f"Error saving {job.path}: {e}")
+            self.failed += 1
+
+def head_request(account, repo_info, db_repo=None):
+    """URL and headers of the default-branch head lookup, conditional on the stored ETag"""
+    branch = quote(repo_info.get('default_branch') or 'main', safe='')
+    
+    if account.platform == 'github':
+        api_url = (account.base_url or 'https://api.github.com').rstrip('/')
+        full_name = repo_info.get('full_name') or f"{account.username}/{repo_info['name']}"
+        url = f"{api_url}/repos/{full_name}/commits/{branch}"
+        # The sha media type answers with the bare commit SHA
+        headers = {'Authorization': f'token {account.access_token}', 'Accept': 'application/vnd.github.sha'}
+    else:
+        api_url = (account.base_url or 'https://gitlab.com').rstrip('/') + '/api/v4'
+        url = f"{api_url}/projects/{repo_info['id']}/repository/branches/{branch}"
+        headers = {'PRIVATE-TOKEN': account.access_token}
+    
+    # The ETag is only valid together with the repo_hash it was stored with
+    if db_repo and db_repo.repo_hash and db_repo.head_etag:
+        headers['If-None-Match'] = db_repo.head_etag
+    return url, headers
+
+def parse_head_sha(platform, body):
+    if platform == 'github':
+        return body.decode('ascii').strip()
+    return json.loads(body)['commit']['id']
+
+def get_repo_hash(account, repo_info, db_repo=None):
+    """Head commit of the default branch and its ETag, from one conditional request
+    
+    A 304 means the head has not moved since db_repo was last scanned, so the
+    stored repo_hash is returned as is; GitHub does not count 304 responses
+    against the rate limit. A lookup deferred by the rate limit also returns
+    the stored head, so the repository is served from cache until the next
+    sync. Returns (None, None) when the lookup fails.
+    """
+    url, headers = head_request(account, repo_info, db_repo)
+    try:
+        response = http_session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304:
+            return db_repo.repo_hash, db_repo.head_etag
+        response.raise_for_status()
+        return parse_head_sha(account.platform, response.content), response.headers.get('ETag')
+    except RateLimitDeferred as e:
+        print(f"  ⏸ Head lookup of {repo_info['name']} deferred: {e}")
+        current_progress.get().defer(repo_info['name'])
+        return (db_repo.repo_hash, db_repo.head_etag) if db_repo else (None, None)
+    except Exception as e:
+        print(f"Error reading head of {repo_info['name']}: {e}")
+        return None, None
+
+def fetch_github_repos(account):
+    g = github_client(account)
+    repos_data = []
+    
+    try:
+        repos = account_rate_limiter(account).call(list, g.get_user().get_repos(affiliation='owner'))
+        for repo in repos:
+            repos_data.append({
+                'name': repo.name,
+                'id': str(repo.id),
+                'private': repo.private,
+                'url': repo.html_url,
+                'default_branch': repo.default_branch or 'main',
+                'full_name': repo.full_name,
+                'repo_obj': repo
+            })
+    except Exception as e:
+        print(f"Error fetching repos: {e}")
+    
+    return repos_data
+
+def fetch_gitlab_repos(account):
+    try:
+        gl = gitlab_client(account)
+        repos_data = []
+        
+        for project in gl.projects.list(owned=True, all=True):
+            repos_data.append({
+                'name': project.name,
+                'id': str(project.id),
+                'private': project.visibility == 'private',
+                'url': project.web_url,
+                'default_branch': project.default_branch or 'main',
+                'repo_obj': project
+            })
+        
+        return repos_data
+    except Exception as e:
+        print(f"Error fetching GitLab repos: {e}")
+        return []
+
+def get_setting(user_id, key, default=None):
+    setting = db.session.query(Settings).filter_by(user_id=user_id, key=key).first()
+    return setting.value if setting and setting.value else default
+
+def find_repository(account, repo_info):
+    return db.session.query(Repository).filter_by(
+        account_id=account.id,
+        repo_id=repo_info['id']
+    ).first()
+
+def load_repository(account, repo_info, current_hash, force=False, db_repo=None, etag=None):
+    """Return the Repository row for repo_info and whether it needs scanning
+    
+    repo_hash is only set by finish_scan, so a new repository whose first
+    scan fails is scanned again next time.
+    """
+    db_repo = db_repo or find_repository(account, repo_info)
+    
+    if not db_repo:
+        db_repo = Repository(
+            account_id=account.id,
+            repo_name=repo_info['name'],
+            repo_id=repo_info['id'],
+            is_private=repo_info['private']
+        )
+        db.session.add(db_repo)
+        db.session.commit()
+        return db_repo, True
+    
+    if db_repo.repo_hash == current_hash and etag and db_repo.head_etag != etag:
+        # Remember the validator so the next lookup can be answered with a 304
+        db_repo.head_etag = etag
+        db.session.commit()
+    
+    return db_repo, force or db_repo.repo_hash != current_hash
+
+def finish_scan(db_repo, current_hash, etag):
+    """Record the head a scan got through, together with the ETag it was read with"""
+    db_repo.repo_hash = current_hash
+    db_repo.head_etag = etag
+
+def cached_repo_stats(db_repo):
+    """Per-language stats of an unchanged repository, read from its rollup rows"""
+    rows = db.session.execute(db.select(RepositoryLanguageStats).filter_by(repo_id=db_repo.id)).scalars()
+    return {
+        row.language: {
+            'files': row.files,
+            'total': row.total_lines,
+            'code': row.code_lines,
+            'comment': row.comment_lines,
+            'empty': row.empty_lines
+        }
+        for row in rows
+    }
+
+class FileCacheStore:
+    """FileCache rows of one repository, loaded in one query and written back in batches
+    
+    Every path the scan still sees is marked; prune() deletes the rows of
+    files that are gone from the repository. Each row change is also applied
+    as a delta to the repository's RepositoryLanguageStats, which are written
+    in the same transaction as the rows.
+    """
+    
+    COLUMNS = (FileCache.id, FileCache.file_path, FileCache.file_hash, FileCache.language,
+               FileCache.total_lines, FileCache.code_lines, FileCache.comment_lines, FileCache.empty_lines)
+    ROLLUP_COLUMNS = ('files', 'total_lines', 'code_lines', 'comment_lines', 'empty_lines')
+    
+    def __init__(self, db_repo, batch_size=None, paths=None):
+        self.db_repo = db_repo
+        self.batch_size = batch_size or app.config['FILE_CACHE_BATCH_SIZE']
+        query = db.select(*self.COLUMNS).filter_by(repo_id=db_repo.id)
+        if paths is not None:
+            # Incremental scans only need the rows of the paths that changed
+            query = query.where(FileCache.file_path.in_(list(paths)))
+        self.rows = {row.file_path: row for row in db.session.execute(query)}
+        self.rollup = {
+            row.language: {column: getattr(row, column) for column in self.ROLLUP_COLUMNS}
+            for row in db.session.execute(db.select(RepositoryLanguageStats).filter_by(repo_id=db_repo.id)).scalars()
+        }
+        self.seen = set()
+        self.inserts = []
+        self.updates = []
+        self.deletes = []
+        self.changed_languages = set()
+    
+    def lookup(self, path, file_hash):
+        """Mark path as present and return its cached row if file_hash is unchanged"""
+        self.seen.add(path)
+        row = self.rows.get(path)
+        if row and row.file_hash == file_hash:
+            return row
+        return None
+    
+    def put(self, path, file_hash, language, counts):
+        total, code, comment, empty = counts
+        now = datetime.utcnow()
+        values = {
+            'file_hash': file_hash,
+            'language': language['name'].upper(),
+            'total_lines': total,
+            'code_lines': code,
+            'comment_lines': comment,
+            'empty_lines': empty,
+            'last_modified': now,
+            'cached_at': now
+        }
+        
+        row = self.rows.get(path)
+        if row:
+            self.remove_from_rollup(row)
+            values['id'] = row.id
+            self.updates.append(values)
+        else:
+            values['repo_id'] = self.db_repo.id
+            values['file_path'] = path
+            self.inserts.append(values)
+        self.add_to_rollup(values['language'], (1, total, code, comment, empty))
+        
+        if len(self.inserts) + len(self.updates) >= self.batch_size:
+            self.flush()
+    
+    def add_to_rollup(self, language, counts):
+        totals = self.rollup.setdefault(language, dict.fromkeys(self.ROLLUP_COLUMNS, 0))
+        for column, count in zip(self.ROLLUP_COLUMNS, counts):
+            totals[column] += count or 0
+        self.changed_languages.add(language)
+    
+    def remove_from_rollup(self, row):
+        if row.language:
+            self.add_to_rollup(row.language, (-1, -(row.total_lines or 0), -(row.code_lines or 0),
+                                              -(row.comment_lines or 0), -(row.empty_lines or 0)))
+    
+    def remove(self, path):
+        """Queue the row of a deleted file for removal"""
+        row = self.rows.pop(path, None)
+        if row:
+            self.remove_from_rollup(row)
+            self.deletes.append(row.id)
+    
+    def flush(self):
+        """Write pending rows with one executemany per statement and commit"""
+        if self.updates:
+            db.session.execute(db.update(FileCache), self.updates)
+        if self.inserts:
+            db.session.execute(db.insert(FileCache), self.inserts)
+        for start in range(0, len(self.deletes), self.batch_size):
+            db.session.execute(db.delete(FileCache).where(
+                FileCache.id.in_(self.deletes[start:start + self.batch_size])))
+        self.flush_rollup()
+        self.updates = []
+        self.inserts = []
+        self.deletes = []
+        db.session.commit()
+    
+    def flush_rollup(self):
+        """Rewrite the rollup rows of languages whose totals changed since the last flush"""
+        if not self.changed_languages:
+            return
+        
+        languages = list(self.changed_languages)
+        db.session.execute(db.delete(RepositoryLanguageStats).where(
+            RepositoryLanguageStats.repo_id == self.db_repo.id,
+            RepositoryLanguageStats.language.in_(languages)
+        ))
+        rows = [
+            dict(self.rollup[language], repo_id=self.db_repo.id, language=language)
+            for language in languages
+            if self.rollup[language]['files'] > 0
+        ]
+        if rows:
+            db.session.execute(db.insert(RepositoryLanguageStats), rows)
+        self.changed_languages.clear()
+    
+    def prune(self):
+        """Delete rows for files the scan no longer saw, then flush"""
+        stale = [path for path in self.rows if path not in self.seen]
+        for path in stale:
+            self.remove(path)
+        if stale:
+            print(f"  Removed {len(stale)} deleted files from cache")
+        self.flush()
+
+# Linguist-style rules for third-party code, searched in repository paths
+VENDORED_PATHS = (
+    r'(?:^|/)(?:node_modules|bower_components|jspm_packages|vendor|vendors|third[-_]?party|Pods|Carthage|\.yarn'
+    r'|\.?venv|site-packages|dist)/',
+    r'\.min\.(?:js|css)$',
+    r'\.bundle\.js$',
+    r'(?:^|/)(?:jquery|bootstrap)[^/]*\.(?:js|css)$',
+)
+
+# Lockfiles and the output of code generators
+GENERATED_PATHS = (
+    r'(?:^|/)(?:package-lock\.json|npm-shrinkwrap\.json|yarn\.lock|pnpm-lock\.yaml|composer\.lock|Gemfile\.lock'
+    r'|Cargo\.lock|poetry\.lock|Pipfile\.lock|Podfile\.lock|go\.sum|flake\.lock)$',
+    r'\.pb\.(?:go|cc|h|swift)$',
+    r'\.pb\.gw\.go$',
+    r'_pb2(?:_grpc)?\.pyi?$',
+    r'_(?:grpc_)?pb\.(?:js|d\.ts)$',
+    r'(?:^|/)zz_generated[^/]*\.go$',
+    r'\.(?:[Dd]esigner|g|g\.i)\.cs$',
+    r'\.(?:js|css)\.map$',
+)
+
+# Settings key of a user's path globs; 'exclude_paths:<account id>' only applies to one account
+EXCLUDE_PATHS_SETTING = 'exclude_paths'
+
+def glob_to_regex(glob):
+    """Regex source for a gitignore-style glob
+    
+    A glob without a slash matches a file or directory name at any depth, one
+    with a slash is anchored at the repository root; both also match every
+    path under a matched directory. '**' crosses directories, '*' and '?'
+    do not.
+    """
+    anchored = '/' in glob.rstrip('/')
+    glob = glob.strip('/')
+    parts = []
+    i = 0
+    while i < len(glob):
+        if glob.startswith('**/', i):
+            parts.append('(?:[^/]*/)*')
+            i += 3
+        elif glob.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif glob[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif glob[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif glob[i] == '[' and glob.find(']', i + 2) != -1:
+            end = glob.find(']', i + 2)
+            members = glob[i + 1:end]
+            if members.startswith(('!', '^')):
+                # Like '*' and '?', a negated class does not match the '/' between names
+                members = '^/' + members[1:]
+            parts.append('[' + members.replace('\\', '\\\\') + ']')
+            i = end + 1
+        else:
+            parts.append(re.escape(glob[i]))
+            i += 1
+    return ('^' if anchored else '(?:^|/)') + ''.join(parts) + '(?:/|$)'
+
+class PathFilter:
+    """Decides which tree paths are not worth downloading
+    
+    The built-in rules and the user's globs are compiled into one regex, so a
+    path costs a single search however many rules there are; globs starting
+    with '!' keep paths the other rules would skip. Blobs larger than
+    max_size are dropped by the size the tree listing reports.
+    """
+    
+    def __init__(self, globs=(), max_size=None, vendored=True):
+        exclude = list(VENDORED_PATHS + GENERATED_PATHS) if vendored else []
+        keep = []
+        for glob in globs:
+            if glob.startswith('!'):
+                keep.append(glob_to_regex(glob[1:]))
+            else:
+                exclude.append(glob_to_regex(glob))
+        self.exclude = re.compile('|'.join(exclude)) if exclude else None
+        self.keep = re.compile('|'.join(keep)) if keep else None
+        self.max_size = max_size
+    
+    def skip(self, path, size=None):
+        if size and self.max_size and size > self.max_size:
+            return True
+        if not self.exclude or not self.exclude.search(path):
+            return False
+        return not (self.keep and self.keep.search(path))
+    
+    def skip_dir(self, path):
+        """Whether nothing under a directory can be kept, so it need not be listed"""
+        return bool(self.exclude and not self.keep and self.exclude.search(path + '/'))
+
+@lru_cache(maxsize=256)
+def compile_path_filter(globs, max_size, vendored):
+    return PathFilter(globs, max_size, vendored)
+
+def exclude_path_globs(values, repo_name):
+    """Globs of exclude_paths setting values that apply to repo_name
+    
+    Values hold one glob per line; a 'repo: glob' line only applies to that
+    repository and lines starting with '#' are comments.
+    """
+    globs = set()
+    for value in values:
+        for line in value.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            repo, separator, glob = line.partition(':')
+            if separator:
+                if repo.strip() != repo_name:
+                    continue
+                line = glob.strip()
+            if line and line != '!':
+                globs.add(line)
+    return tuple(sorted(globs))
+
+def repository_path_filter(account, repo_info):
+    """The PathFilter of one repository from its owner's exclude_paths settings"""
+    keys = [EXCLUDE_PATHS_SETTING, f"{EXCLUDE_PATHS_SETTING}:{account.id}"]
+    values = db.session.scalars(db.select(Settings.value).where(
+        Settings.user_id == account.user_id, Settings.key.in_(keys)
+    )).all()
+    globs = exclude_path_globs([value for value in values if value], repo_info['name'])
+    return compile_path_filter(globs, app.config['MAX_FILE_SIZE'], app.config['SKIP_VENDORED'])
+
+def plan_file_jobs(cache, blobs, source, stats, path_filter):
+    """Count unchanged blobs from FileCache and return FileJobs for the rest
+    
+    blobs are (path, sha, size) tuples from a tree listing; size may be None.
+    Paths the filter skips are never looked up, so prune() drops any cached
+    rows they still have.
+    """
+    listed = list(blobs)
+    blobs = [(path, sha, size) for path, sha, size in listed if not path_filter.skip(path, size)]
+    if len(blobs) < len(listed):
+        print(f"  Skipping {len(listed) - len(blobs)} vendored, generated, excluded or oversized files")
+    languages = classify_paths(path for path, sha, size in blobs)
+    
+    jobs = []
+    for path, sha, size in blobs:
+        language = languages.get(path)
+        if not language:
+            continue
+        
+        cached_file = cache.lookup(path, sha)
         if cached_file:
-            cached_file.file_hash = file_id
-            cached_file.total_lines = total
-            cached_file.code_lines = code
-            cached_file.comment_lines = comment
-            cached_file.empty_lines = empty
-            cached_file.last_modified = datetime.utcnow()
-            cached_file.cached_at = datetime.utcnow()
+            add_file_stats(stats, language['name'].upper(), cached_file.total_lines, cached_file.code_lines,
+                           cached_file.comment_lines, cached_file.empty_lines)
+            continue
+        
+        jobs.append(FileJob(path, sha, language, source))
+    
+    return jobs
+
+def plan_changed_jobs(cache, changes, source, path_filter):
+    """Queue removed paths for deletion and return FileJobs for added and modified files"""
+    changes = list(changes)
+    languages = classify_paths(change.path for change in changes if not change.removed)
+    
+    jobs = []
+    for change in changes:
+        # A file that now matches an exclude rule leaves the counts like a deleted one
+        if change.removed or path_filter.skip(change.path):
+            cache.remove(change.path)
+            continue
+        
+        language = languages.get(change.path)
+        if not language:
+            continue
+        
+        # Reverted or touched-but-identical files keep their cached counts
+        if change.sha and cache.lookup(change.path, change.sha):
+            continue
+        
+        jobs.append(FileJob(change.path, change.sha, language, source))
+    
+    return jobs
+
+def can_scan_incrementally(previous_hash, current_hash, force=False):
+    return bool(not force and previous_hash and current_hash and previous_hash != current_hash)
+
+def scan_changes(db_repo, changes, source, fetch, host, path_filter, store=None):
+    """Recount only the changed files and return the repository's stats from its rollups"""
+    cache = FileCacheStore(db_repo, paths={change.path for change in changes})
+    jobs = plan_changed_jobs(cache, changes, source, path_filter)
+    store = store or store_file_counts
+    print(f"  Incremental scan: {len(changes)} changed paths, {len(jobs)} to download")
+    
+    try:
+        FetchPipeline(host).run(
+            jobs,
+            fetch,
+            # Totals come from the rollups afterwards, so per-file stats are not needed
+            lambda job, result: store(cache, job, result, {})
+        )
+    finally:
+        cache.flush()
+    return cached_repo_stats(db_repo)
+
+def merge_stats(all_stats, repo_stats):
+    for lang, data in repo_stats.items():
+        if lang not in all_stats:
+            all_stats[lang] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
+        all_stats[lang]['files'] += data['files']
+        all_stats[lang]['total'] += data['total']
+        all_stats[lang]['code'] += data['code']
+        all_stats[lang]['comment'] += data['comment']
+        all_stats[lang]['empty'] += data['empty']
+
+def github_client(account):
+    # Retries are left to RateLimiter.call, so PyGithub's own GithubRetry is turned off
+    if account.base_url:
+        return Github(account.access_token, base_url=account.base_url, pool_size=app.config['FETCH_WORKERS'],
+                      retry=0)
+    return Github(account.access_token, pool_size=app.config['FETCH_WORKERS'], retry=0)
+
+def gitlab_client(account):
+    gl = gitlab.Gitlab(account.base_url or 'https://gitlab.com', private_token=account.access_token,
+                       session=rate_limited_session())
+    gl.auth()
+    return gl
+
+def analyze_github_repo(account, repo_info, force=False):
+    """Analyze GitHub repository with smart caching"""
+    # Check if repository has changed
+    db_repo = find_repository(account, repo_info)
+    current_hash, etag = get_repo_hash(account, repo_info, db_repo)
+    
+    db_repo, changed = load_repository(account, repo_info, current_hash, force, db_repo, etag)
+    if not changed:
+        # Repository hasn't changed, use cached data
+        print(f"  ⚡ Using cached data for {repo_info['name']} (no changes)")
+        return cached_repo_stats(db_repo)
+    
+    # Repository has changed, update it
+    print(f"  🔄 Repository changed, updating {repo_info['name']}")
+    previous_hash = db_repo.repo_hash
+    
+    stats = {}
+    
+    try:
+        limiter = account_rate_limiter(account)
+        repo = repo_info.get('repo_obj') or limiter.call(
+            github_client(account).get_repo, f"{account.username}/{repo_info['name']}")
+        headers = {'Authorization': f'token {account.access_token}', 'Accept': 'application/vnd.github.raw'}
+        source = GitHubSource(repo, limiter, None, headers)
+        path_filter = repository_path_filter(account, repo_info)
+        
+        changes = None
+        if can_scan_incrementally(previous_hash, current_hash, force):
+            changes = github_changes(source, previous_hash, current_hash)
+        
+        if changes is not None:
+            stats = scan_changes(db_repo, changes, source, fetch_github_blob, account_host(account), path_filter)
+        else:
+            tree = None
+            if app.config['GITHUB_SCAN_MODE'] == 'tree':
+                tree = fetch_github_tree(source, repo_info, current_hash)
+            
+            if tree is not None:
+                scan_github_tree(db_repo, source, tree, stats, account_host(account), path_filter)
+            else:
+                walk_github_contents(db_repo, source, repo_info, stats, account_host(account), path_filter)
+        
+        # Only move the stored head once every file got through, so failed
+        # files are retried from the same base next time
+        finish_scan(db_repo, current_hash, etag)
+    
+    except (RateLimitDeferred, ScanIncomplete) as e:
+        # Finished files are already in FileCache; the rest keeps its old counts
+        print(f"  ⏸ {repo_info['name']}: {e}")
+        current_progress.get().defer(repo_info['name'])
+        stats = cached_repo_stats(db_repo)
+    except Exception as e:
+        print(f"Error processing repo {repo_info['name']}: {e}")
+    
+    db_repo.last_updated = datetime.utcnow()
+    db.session.commit()
+    
+    return stats
+
+def github_changes(source, base, head):
+    """Files changed between two commits, or None when a full scan is needed"""
+    try:
+        comparison = source.limiter.call(source.repo.compare, base, head).raw_data
+    except RateLimitDeferred:
+        raise
+    except Exception as e:
+        print(f"  Could not compare {base[:7]}...{head[:7]}: {e}")
+        return None
+    
+    return github_compare_changes(comparison, base)
+
+def github_compare_changes(comparison, base):
+    """FileChanges from a GitHub compare response, or None when a full scan is needed"""
+    if comparison['status'] == 'identical':
+        return []
+    if comparison['status'] != 'ahead':
+        # base is no longer an ancestor of head, e.g. after a force push
+        print(f"  History changed since {base[:7]}, scanning the full tree")
+        return None
+    
+    files = comparison.get('files', [])
+    if len(files) >= GITHUB_COMPARE_MAX_FILES or len(files) > app.config['INCREMENTAL_MAX_FILES']:
+        return None
+    
+    changes = []
+    for changed_file in files:
+        if changed_file['status'] == 'removed':
+            changes.append(FileChange(changed_file['filename'], None, True))
+            continue
+        if changed_file['status'] == 'renamed' and changed_file.get('previous_filename'):
+            changes.append(FileChange(changed_file['previous_filename'], None, True))
+        changes.append(FileChange(changed_file['filename'], changed_file['sha'], False))
+    return changes
+
+def fetch_github_tree(source, repo_info, commit_sha=None):
+    """Fetch the whole recursive tree in one request, or None if it is unavailable or truncated"""
+    refs = [commit_sha, repo_info.get('default_branch', 'main'), 'master', 'main']
+    
+    for ref in dict.fromkeys(ref for ref in refs if ref):
+        try:
+            tree = source.limiter.call(source.repo.get_git_tree, ref, recursive=True)
+        except RateLimitDeferred:
+            raise
+        except:
+            continue
+        
+        if tree.raw_data.get('truncated'):
+            print(f"  Tree listing truncated for {repo_info['name']}, walking directories instead")
+            return None
+        return tree.tree
+    
+    return None
+
+def scan_github_tree(db_repo, source, tree, stats, host, path_filter):
+    """Diff tree blob SHAs against FileCache and only download blobs that changed"""
+    cache = FileCacheStore(db_repo)
+    blobs = ((entry.path, entry.sha, entry.size) for entry in tree if entry.type == 'blob')
+    jobs = plan_file_jobs(cache, blobs, source, stats, path_filter)
+    
+    try:
+        FetchPipeline(host).run(
+            jobs,
+            fetch_github_blob,
+            lambda job, counts: store_file_counts(cache, job, counts, stats)
+        )
+    finally:
+        cache.flush()
+    cache.prune()
+
+def fetch_github_blob(job):
+    """Download one blob by SHA for counting; runs on a fetch worker"""
+    try:
+        # The raw media type streams the blob itself instead of base64 inside JSON
+        ingest = BlobIngest(job)
+        stream_download(f"{job.source.repo.url}/git/blobs/{job.sha}", job.source.headers, ingest)
+        return ingest.result()
+        
+    except FileTooLarge as e:
+        print(e)
+        return None
+
+def store_file_counts(cache, job, counts, stats):
+    """Writer stage: queue a fetched file's counts for FileCache and add them to the repo stats"""
+    if not counts:
+        # Grown past MAX_FILE_SIZE, binary or empty: its old counts no longer apply
+        cache.remove(job.path)
+        return
+    
+    cache.put(job.path, job.sha, job.language, counts)
+    add_file_stats(stats, job.language['name'].upper(), *counts)
+
+def walk_github_contents(db_repo, source, repo_info, stats, host, path_filter):
+    """Walk the repository one directory listing at a time through the contents API"""
+    branches_to_try = [repo_info.get('default_branch', 'main'), 'master', 'main']
+    contents = None
+    
+    for branch in branches_to_try:
+        try:
+            contents = source.limiter.call(source.repo.get_contents, "", ref=branch)
+            break
+        except RateLimitDeferred:
+            raise
+        except:
+            continue
+    
+    if not contents:
+        print(f"Could not access any branch for {repo_info['name']}")
+        return
+    
+    cache = FileCacheStore(db_repo)
+    complete = True
+    
+    def changed_files():
+        nonlocal complete
+        pending = deque(contents)
+        while pending:
+            file_content = pending.popleft()
+            if file_content.type == "dir":
+                # Excluded directories such as node_modules are never listed
+                if path_filter.skip_dir(file_content.path):
+                    continue
+                try:
+                    pending.extend(source.limiter.call(source.repo.get_contents, file_content.path, ref=branch))
+                except RateLimitDeferred:
+                    raise
+                except:
+                    # Files under an unreadable directory were not seen, so nothing can be pruned
+                    complete = False
+                    continue
+            else:
+                job = github_file_job(cache, source._replace(ref=branch), file_content, stats, path_filter)
+                if job:
+                    yield job
+    
+    try:
+        FetchPipeline(host).run(
+            changed_files(),
+            fetch_github_file,
+            lambda job, counts: store_file_counts(cache, job, counts, stats)
+        )
+    finally:
+        cache.flush()
+    if complete:
+        cache.prune()
+
+def add_file_stats(stats, lang_name, total, code, comment, empty):
+    if lang_name not in stats:
+        stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
+    
+    stats[lang_name]['files'] += 1
+    stats[lang_name]['total'] += total
+    stats[lang_name]['code'] += code
+    stats[lang_name]['comment'] += comment
+    stats[lang_name]['empty'] += empty
+
+def github_file_job(cache, source, file_content, stats, path_filter):
+    """Count a cached file straight away, or return the FileJob to download it"""
+    if path_filter.skip(file_content.path, file_content.size):
+        return None
+    language = get_language(file_content.path)
+    if not language:
+        return None
+    
+    file_sha = file_content.sha
+    
+    cached_file = cache.lookup(file_content.path, file_sha)
+    if cached_file:
+        add_file_stats(stats, language['name'].upper(), cached_file.total_lines, cached_file.code_lines,
+                       cached_file.comment_lines, cached_file.empty_lines)
+        return None
+    
+    return FileJob(file_content.path, file_sha, language, source)
+
+def fetch_github_file(job):
+    """Download one file through the contents API for counting; runs on a fetch worker"""
+    repo, limiter, branch, _ = job.source
+    
+    try:
+        file_obj = limiter.call(repo.get_contents, job.path, ref=branch)
+        
+        if file_obj.size > app.config['MAX_FILE_SIZE']:
+            print(f"Skipping large file (>{file_obj.size} bytes): {job.path}")
+            return None
+        
+        # Files up to 1 MB come base64-encoded in the response; larger ones
+        # come without content and are streamed from their raw URL
+        if file_obj.encoding == 'base64' and file_obj.content:
+            return count_blob(file_obj.decoded_content, job.language)
+        if not file_obj.download_url:
+            return None
+        
+        ingest = BlobIngest(job)
+        stream_download(file_obj.download_url, {}, ingest)
+        return ingest.result()
+        
+    except FileTooLarge as e:
+        print(e)
+        return None
+
+def analyze_gitlab_repo(account, repo_info, force=False):
+    """Analyze GitLab repository with smart caching"""
+    try:
+        gl = gitlab_client(account)
+        project = repo_info.get('repo_obj') or gl.projects.get(repo_info['id'])
+        
+        # Check if repository has changed
+        db_repo = find_repository(account, repo_info)
+        current_hash, etag = get_repo_hash(account, repo_info, db_repo)
+        
+        db_repo, changed = load_repository(account, repo_info, current_hash, force, db_repo, etag)
+        if not changed:
+            # Repository hasn't changed, use cached data
+            print(f"  ⚡ Using cached data for {repo_info['name']} (no changes)")
+            return cached_repo_stats(db_repo)
+        
+        # Repository has changed, update it
+        print(f"  🔄 Repository changed, updating {repo_info['name']}")
+        previous_hash = db_repo.repo_hash
+        
+        stats = {}
+        
+        try:
+            path_filter = repository_path_filter(account, repo_info)
+            changes = None
+            if can_scan_incrementally(previous_hash, current_hash, force):
+                changes = gitlab_changes(project, previous_hash, current_hash)
+            
+            if changes is not None:
+                stats = scan_changes(db_repo, changes, (project, current_hash), fetch_gitlab_file,
+                                     account_host(account), path_filter, store=store_fetched_file)
+            else:
+                items = project.repository_tree(recursive=True, all=True)
+                scan_gitlab_tree(db_repo, project, items, stats, account_host(account), path_filter)
+            
+            finish_scan(db_repo, current_hash, etag)
+        except (RateLimitDeferred, ScanIncomplete) as e:
+            print(f"  ⏸ {repo_info['name']}: {e}")
+            current_progress.get().defer(repo_info['name'])
+            stats = cached_repo_stats(db_repo)
+        except Exception as e:
+            print(f"Error processing repo {repo_info['name']}: {e}")
+        
+        db_repo.last_updated = datetime.utcnow()
+        db.session.commit()
+        
+        return stats
+        
+    except Exception as e:
+        print(f"Error with GitLab repo {repo_info['name']}: {e}")
+        return {}
+
+def gitlab_changes(project, base, head):
+    """Files changed between two commits, or None when a full scan is needed"""
+    try:
+        merge_base = project.repository_merge_base([base, head])['id']
+        comparison = None if merge_base != base else project.repository_compare(base, head)
+    except RateLimitDeferred:
+        raise
+    except Exception as e:
+        print(f"  Could not compare {base[:7]}...{head[:7]}: {e}")
+        return None
+    
+    return gitlab_compare_changes(merge_base, comparison, base)
+
+def gitlab_compare_changes(merge_base, comparison, base):
+    """FileChanges from a GitLab compare response, or None when a full scan is needed
+    
+    Compare diffs carry no blob ids, so every FileChange has sha None.
+    """
+    if merge_base != base:
+        # base is no longer an ancestor of head, e.g. after a force push
+        print(f"  History changed since {base[:7]}, scanning the full tree")
+        return None
+    
+    diffs = comparison.get('diffs', [])
+    if comparison.get('compare_timeout') or len(diffs) > app.config['INCREMENTAL_MAX_FILES']:
+        return None
+    
+    changes = []
+    for diff in diffs:
+        if diff.get('deleted_file') or diff.get('renamed_file'):
+            changes.append(FileChange(diff['old_path'], None, True))
+        if not diff.get('deleted_file'):
+            changes.append(FileChange(diff['new_path'], None, False))
+    return changes
+
+def fetch_gitlab_file(job):
+    """Download one file by path at a commit; returns (blob id, counts future) since compare has no blob ids"""
+    project, ref = job.source
+    
+    try:
+        # The raw endpoint streams the file and reports its blob id in a header
+        ingest = BlobIngest(job)
+        response = project.manager.gitlab.http_request(
+            'get', f"/projects/{project.encoded_id}/repository/files/{quote(job.path, safe='')}/raw",
+            query_data={'ref': ref}, streamed=True)
+        with response:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                ingest.feed(chunk)
+        if not response.headers.get('X-Gitlab-Blob-Id'):
+            raise ValueError("response has no X-Gitlab-Blob-Id header")
+        return response.headers['X-Gitlab-Blob-Id'], ingest.result()
+        
+    except FileTooLarge as e:
+        print(e)
+        return None
+
+def store_fetched_file(cache, job, result, stats):
+    """Writer stage for fetches that learn the blob id together with the content"""
+    if result:
+        sha, counts = result
+        store_file_counts(cache, job._replace(sha=sha), counted(counts), stats)
+    else:
+        store_file_counts(cache, job, None, stats)
+
+def scan_gitlab_tree(db_repo, project, items, stats, host, path_filter):
+    """Diff tree blob ids against FileCache and only download blobs that changed"""
+    cache = FileCacheStore(db_repo)
+    # GitLab tree listings carry no sizes; large files are stopped by BlobIngest
+    blobs = ((item['path'], item['id'], None) for item in items if item['type'] == 'blob')
+    jobs = plan_file_jobs(cache, blobs, project, stats, path_filter)
+    
+    try:
+        FetchPipeline(host).run(
+            jobs,
+            fetch_gitlab_blob,
+            lambda job, counts: store_file_counts(cache, job, counts, stats)
+        )
+    finally:
+        cache.flush()
+    cache.prune()
+
+def fetch_gitlab_blob(job):
+    """Download one blob by id for counting; runs on a fetch worker"""
+    try:
+        ingest = BlobIngest(job)
+        job.source.repository_raw_blob(job.sha, streamed=True, action=ingest.feed, chunk_size=DOWNLOAD_CHUNK_SIZE)
+        return ingest.result()
+        
+    except FileTooLarge as e:
+        print(e)
+        return None
+
+class AsyncScanEngine:
+    """asyncio scanner that shares one keep-alive connection pool per API host
+    
+    Repository listing, tree listing, blob downloads and counting run as
+    tasks on one event loop. Database reads and writes happen on the loop's
+    own thread, so db.session is never shared between threads.
+    """
+    
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or app.config['ASYNC_CONCURRENCY']
+        self.sessions = {}
+        self.repo_slots = asyncio.Semaphore(self.concurrency)
+    
+    def session(self, base_url):
+        host = urlparse(base_url).netloc
+        if host not in self.sessions:
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency,
+                                             keepalive_timeout=60)
+            self.sessions[host] = aiohttp.ClientSession(connector=connector,
+                                                        timeout=aiohttp.ClientTimeout(total=60))
+        return self.sessions[host]
+    
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        self.sessions.clear()
+    
+    async def send(self, url, headers, params=None, sink=None):
+        """GET url paced by its credential's RateLimiter; returns (status, body, response headers)
+        
+        Rate-limit and server errors are retried with jittered backoff; other
+        error statuses raise aiohttp.ClientResponseError. With a sink, the body
+        is fed to sink.feed() in chunks and None is returned in its place.
+        """
+        limiter = request_rate_limiter(url, headers)
+        attempt = 0
+        while True:
+            await asyncio.sleep(limiter.reserve())
+            try:
+                async with self.session(url).get(url, headers=headers, params=params) as response:
+                    limiter.update(response.headers)
+                    delay = limiter.retry_delay(response.status, response.headers, attempt)
+                    if delay is None:
+                        response.raise_for_status()
+                        if sink is None:
+                            return response.status, await response.read(), response.headers
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            sink.feed(chunk)
+                        return response.status, None, response.headers
+            except aiohttp.ClientConnectionError:
+                delay = limiter.retry_delay(None, {}, attempt)
+                # A retry would feed the sink the start of the body again
+                if delay is None or (sink is not None and sink.size):
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+    
+    async def request(self, url, headers, params=None):
+        """GET url on its host's pooled session; returns (decoded JSON body, response headers)"""
+        _, body, response_headers = await self.send(url, headers, params)
+        return json.loads(body), response_headers
+    
+    async def head(self, account, repo_info, db_repo=None):
+        """Async get_repo_hash: (sha, etag) from one conditional head lookup"""
+        url, headers = head_request(account, repo_info, db_repo)
+        try:
+            status, body, response_headers = await self.send(url, headers)
+            if status == 304:
+                return db_repo.repo_hash, db_repo.head_etag
+            return parse_head_sha(account.platform, body), response_headers.get('ETag')
+        except RateLimitDeferred as e:
+            print(f"  ⏸ Head lookup of {repo_info['name']} deferred: {e}")
+            current_progress.get().defer(repo_info['name'])
+            return (db_repo.repo_hash, db_repo.head_etag) if db_repo else (None, None)
+        except Exception as e:
+            print(f"Error reading head of {repo_info['name']}: {e}")
+            return None, None
+    
+    def client(self, account):
+        if account.platform == 'github':
+            return AsyncGitHubClient(self, account)
+        if account.platform == 'gitlab':
+            return AsyncGitLabClient(self, account)
+        raise ValueError(f"Unsupported platform: {account.platform}")
+    
+    async def scan_account(self, account, force=False, checkpoint=None):
+        client = self.client(account)
+        repos = await client.list_repos()
+        print(f"Found {len(repos)} repositories")
+        
+        checkpoint = checkpoint or ScanCheckpoint()
+        current_progress.get().set_repos(len(repos))
+        results = await asyncio.gather(*(self.scan_checkpointed(client, account, repo, force, checkpoint)
+                                         for repo in repos))
+        
+        all_stats = {}
+        for repo_stats in results:
+            merge_stats(all_stats, repo_stats)
+        return all_stats
+    
+    async def scan_checkpointed(self, client, account, repo_info, force, checkpoint):
+        progress = current_progress.get()
+        repo_stats = checkpoint.cached(account, repo_info)
+        if repo_stats is None:
+            progress.start_repo(repo_info['name'])
+            try:
+                repo_stats = await self.scan_repo(client, account, repo_info, force)
+            finally:
+                progress.finish_repo(repo_info['name'])
+            checkpoint.mark(repo_info)
         else:
-            cached_file = FileCache(
-                repo_id=db_repo.id,
-                file_path=item['path'],
-                file_hash=file_id,
-                language=language['name'].upper(),
-                total_lines=total,
-                code_lines=code,
-                comment_lines=comment,
-                empty_lines=empty,
-                last_modified=datetime.utcnow()
-            )
-            db.session.add(cached_file)
+            progress.finish_repo(repo_info['name'])
+        return repo_stats
+    
+    async def scan_repo(self, client, account, repo_info, force=False):
+        async with self.repo_slots:
+            db_repo = find_repository(account, repo_info)
+            current_hash, etag = await self.head(account, repo_info, db_repo)
+            
+            db_repo, changed = load_repository(account, repo_info, current_hash, force, db_repo, etag)
+            if not changed:
+                print(f"  ⚡ Using cached data for {repo_info['name']} (no changes)")
+                return cached_repo_stats(db_repo)
+            
+            print(f"  🔄 Repository changed, updating {repo_info['name']}")
+            previous_hash = db_repo.repo_hash
+            
+            stats = {}
+            
+            try:
+                path_filter = repository_path_filter(account, repo_info)
+                changes = None
+                if can_scan_incrementally(previous_hash, current_hash, force):
+                    changes = await client.list_changes(repo_info, previous_hash, current_hash)
+                
+                if changes is not None:
+                    stats = await self.scan_changes(client, db_repo, repo_info, changes, current_hash, path_filter)
+                else:
+                    cache = FileCacheStore(db_repo)
+                    blobs, complete = await client.list_tree(repo_info, current_hash)
+                    jobs = plan_file_jobs(cache, blobs, repo_info, stats, path_filter)
+                    try:
+                        await self.fetch_files(client, cache, jobs, stats)
+                    finally:
+                        cache.flush()
+                    if complete:
+                        cache.prune()
+                
+                finish_scan(db_repo, current_hash, etag)
+            except (RateLimitDeferred, ScanIncomplete) as e:
+                # Finished files are already in FileCache; the rest keeps its old counts
+                print(f"  ⏸ {repo_info['name']}: {e}")
+                current_progress.get().defer(repo_info['name'])
+                stats = cached_repo_stats(db_repo)
+            except Exception as e:
+                print(f"Error processing repo {repo_info['name']}: {e}")
+            
+            db_repo.last_updated = datetime.utcnow()
+            db.session.commit()
+            
+            total_lines = sum(data['total'] for data in stats.values())
+            total_files = sum(data['files'] for data in stats.values())
+            print(f"  ✓ {repo_info['name']}: Files: {total_files}, Lines: {total_lines:,}")
+            
+            return stats
+    
+    async def scan_changes(self, client, db_repo, repo_info, changes, head, path_filter):
+        """Recount only the changed files and return the repository's stats from its rollups"""
+        cache = FileCacheStore(db_repo, paths={change.path for change in changes})
+        jobs = plan_changed_jobs(cache, changes, repo_info, path_filter)
+        print(f"  Incremental scan: {len(changes)} changed paths, {len(jobs)} to download")
         
-        lang_name = language['name'].upper()
-        if lang_name not in stats:
-            stats[lang_name] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
+        try:
+            await self.fetch_files(client, cache, jobs, {}, ref=head)
+        finally:
+            cache.flush()
+        return cached_repo_stats(db_repo)
+    
+    async def fetch_files(self, client, cache, jobs, stats, ref=None):
+        """Fetch all jobs concurrently; raise afterwards if any were deferred or failed"""
+        current_progress.get().add_files(len(jobs))
+        results = await asyncio.gather(*(self.fetch_file(client, cache, job, stats, ref) for job in jobs),
+                                       return_exceptions=True)
+        deferred = sum(isinstance(result, RateLimitDeferred) for result in results)
+        failed = sum(isinstance(result, Exception) for result in results) - deferred
+        if deferred:
+            raise RateLimitDeferred(f"{deferred} files deferred to the next sync by rate limits")
+        if failed:
+            raise ScanIncomplete(f"{failed} files failed and are retried on the next sync")
+    
+    async def fetch_file(self, client, cache, job, stats, ref=None):
+        try:
+            ingest = BlobIngest(job)
+            if job.sha:
+                await client.fetch_blob(job.source, job.sha, ingest)
+            else:
+                sha = await client.fetch_file(job.source, job.path, ref, ingest)
+                job = job._replace(sha=sha)
+            # Counting is CPU work: buffered files are counted off the event
+            # loop, on the counting pool or else on a thread of the loop's
+            # executor; only files past STREAM_FILE_SIZE were counted as they arrived
+            if counting_pool():
+                future = ingest.result()
+            else:
+                future = await asyncio.get_running_loop().run_in_executor(None, ingest.result)
+            counts = await asyncio.wrap_future(future)
+        except RateLimitDeferred:
+            raise
+        except FileTooLarge as e:
+            print(e)
+            counts = None
+        except Exception as e:
+            print(f"Error processing file {job.path}: {e}")
+            raise
+        finally:
+            current_progress.get().file_done()
         
-        stats[lang_name]['files'] += 1
-        stats[lang_name]['total'] += total
-        stats[lang_name]['code'] += code
-        stats[lang_name]['comment'] += comment
-        stats[lang_name]['empty'] += empty
+        store_file_counts(cache, job, counts, stats)
+
+class AsyncGitHubClient:
+    """GitHub REST endpoints used by AsyncScanEngine"""
+    
+    def __init__(self, engine, account):
+        self.engine = engine
+        self.api_url = (account.base_url or 'https://api.github.com').rstrip('/')
+        self.headers = {
+            'Authorization': f'token {account.access_token}',
+            'Accept': 'application/vnd.github+json'
+        }
+    
+    async def list_repos(self):
+        repos = []
+        url = f"{self.api_url}/user/repos"
+        params = {'affiliation': 'owner', 'per_page': 100}
         
-        db.session.commit()
+        while url:
+            data, headers = await self.engine.request(url, self.headers, params=params)
+            for repo in data:
+                repos.append({
+                    'name': repo['name'],
+                    'id': str(repo['id']),
+                    'private': repo['private'],
+                    'url': repo.get('html_url'),
+                    'default_branch': repo.get('default_branch') or 'main',
+                    'full_name': repo['full_name']
+                })
+            links = requests.utils.parse_header_links(headers.get('Link', ''))
+            url = next((link['url'] for link in links if link.get('rel') == 'next'), None)
+            params = None
         
-    except Exception as e:
-        print(f"Error processing file {item['path']}: {e}")
+        return repos
+    
+    async def list_tree(self, repo_info, sha):
+        """Return the (path, sha, size) blobs of the tree and whether the listing is complete"""
+        data, _ = await self.engine.request(
+            f"{self.api_url}/repos/{repo_info['full_name']}/git/trees/{sha}", self.headers,
+            params={'recursive': 1})
+        if data.get('truncated'):
+            print(f"  Tree listing truncated for {repo_info['name']}, some files were not counted")
+        blobs = [(entry['path'], entry['sha'], entry.get('size')) for entry in data['tree'] if entry['type'] == 'blob']
+        return blobs, not data.get('truncated')
+    
+    async def list_changes(self, repo_info, base, head):
+        try:
+            data, _ = await self.engine.request(
+                f"{self.api_url}/repos/{repo_info['full_name']}/compare/{base}...{head}", self.headers)
+        except RateLimitDeferred:
+            raise
+        except Exception as e:
+            print(f"  Could not compare {base[:7]}...{head[:7]}: {e}")
+            return None
+        return github_compare_changes(data, base)
+    
+    async def fetch_blob(self, repo_info, sha, sink):
+        headers = dict(self.headers, Accept='application/vnd.github.raw')
+        await self.engine.send(f"{self.api_url}/repos/{repo_info['full_name']}/git/blobs/{sha}", headers, sink=sink)
+
+class AsyncGitLabClient:
+    """GitLab REST endpoints used by AsyncScanEngine"""
+    
+    def __init__(self, engine, account):
+        self.engine = engine
+        self.api_url = (account.base_url or 'https://gitlab.com').rstrip('/') + '/api/v4'
+        self.headers = {'PRIVATE-TOKEN': account.access_token}
+    
+    async def paginate(self, url, params):
+        items = []
+        page = '1'
+        while page:
+            data, headers = await self.engine.request(url, self.headers, params=dict(params, page=page))
+            items.extend(data)
+            page = headers.get('X-Next-Page')
+        return items
+    
+    async def list_repos(self):
+        projects = await self.paginate(f"{self.api_url}/projects", {'owned': 'true', 'per_page': 100})
+        return [{
+            'name': project['name'],
+            'id': str(project['id']),
+            'private': project.get('visibility') == 'private',
+            'url': project.get('web_url'),
+            'default_branch': project.get('default_branch') or 'main'
+        } for project in projects]
+    
+    async def list_tree(self, repo_info, sha):
+        items = await self.paginate(
+            f"{self.api_url}/projects/{repo_info['id']}/repository/tree",
+            {'recursive': 'true', 'per_page': 100, 'ref': sha or repo_info['default_branch']})
+        return [(item['path'], item['id'], None) for item in items if item['type'] == 'blob'], True
+    
+    async def list_changes(self, repo_info, base, head):
+        project_url = f"{self.api_url}/projects/{repo_info['id']}/repository"
+        try:
+            merge_base, _ = await self.engine.request(
+                f"{project_url}/merge_base", self.headers, params=[('refs[]', base), ('refs[]', head)])
+            comparison = None
+            if merge_base['id'] == base:
+                comparison, _ = await self.engine.request(
+                    f"{project_url}/compare", self.headers, params={'from': base, 'to': head})
+        except RateLimitDeferred:
+            raise
+        except Exception as e:
+            print(f"  Could not compare {base[:7]}...{head[:7]}: {e}")
+            return None
+        return gitlab_compare_changes(merge_base['id'], comparison, base)
+    
+    async def fetch_file(self, repo_info, path, ref, sink):
+        """Stream a file at ref into sink and return its blob id"""
+        _, _, headers = await self.engine.send(
+            f"{self.api_url}/projects/{repo_info['id']}/repository/files/{quote(path, safe='')}/raw",
+            self.headers, params={'ref': ref}, sink=sink)
+        if not headers.get('X-Gitlab-Blob-Id'):
+            raise ValueError("response has no X-Gitlab-Blob-Id header")
+        return headers['X-Gitlab-Blob-Id']
+    
+    async def fetch_blob(self, repo_info, sha, sink):
+        await self.engine.send(f"{self.api_url}/projects/{repo_info['id']}/repository/blobs/{sha}/raw",
+                               self.headers, sink=sink)
+
+def run_async_scan(account, force=False, checkpoint=None):
+    """Scan one account with AsyncScanEngine on a private event loop"""
+    async def scan():
+        engine = AsyncScanEngine()
+        try:
+            return await engine.scan_account(account, force, checkpoint)
+        finally:
+            await engine.close()
+    
+    return asyncio.run(scan())
+
+# Rollup periods, longest first, and the Statistics columns they sum
+ROLLUP_PERIODS = ('month', 'week', 'day')
+ROLLUP_COLUMNS = ('files', 'total_lines', 'code_lines', 'comment_lines', 'empty_lines')
+
+def rollup_start(period, day):
+    """First day of the period containing day"""
+    if period == 'month':
+        return day.replace(day=1)
+    if period == 'week':
+        return day - timedelta(days=day.weekday())
+    return day
+
+def rollup_end(period, start):
+    """Last day of the period starting at start"""
+    if period == 'month':
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    if period == 'week':
+        return start + timedelta(days=6)
+    return start
+
+def rollup_buckets(start_date, end_date):
+    """Cover start_date..end_date with as few whole months, weeks and days as possible
+    
+    Weeks stop short of a month that fits the range whole, so a year comes
+    out as at most 31 buckets instead of 365 days.
+    """
+    buckets = []
+    day = start_date
+    while day <= end_date:
+        next_month = rollup_end('month', rollup_start('month', day)) + timedelta(days=1)
+        for period in ROLLUP_PERIODS:
+            end = rollup_end(period, day)
+            if rollup_start(period, day) != day or end > end_date:
+                continue
+            if period == 'week' and next_month <= end and rollup_end('month', next_month) <= end_date:
+                continue
+            buckets.append((period, day))
+            day = end + timedelta(days=1)
+            break
+    return buckets
+
+def period_statistics_query(user_id, start_date, end_date, language=None):
+    """Per-language sums of a user's Statistics between two dates, read from the rollups"""
+    starts = defaultdict(list)
+    for period, start in rollup_buckets(start_date, end_date):
+        starts[period].append(start)
+    
+    query = db.select(
+        StatisticsRollup.language,
+        *(db.func.sum(getattr(StatisticsRollup, column)).label(column) for column in ROLLUP_COLUMNS)
+    ).where(
+        StatisticsRollup.user_id == user_id,
+        db.or_(db.false(), *(db.and_(StatisticsRollup.period == period, StatisticsRollup.start.in_(days))
+                             for period, days in starts.items()))
+    ).group_by(StatisticsRollup.language)
+    
+    if language:
+        query = query.where(StatisticsRollup.language == language.upper())
+    return query
+
+def period_statistics(session, user_id, start_date, end_date, language=None):
+    return session.execute(period_statistics_query(user_id, start_date, end_date, language)).all()
+
+def update_statistics_rollups(connection, user_id, day):
+    """Recompute the day, week and month rollups containing day from the Statistics rows"""
+    for period in ROLLUP_PERIODS:
+        start = rollup_start(period, day)
+        connection.execute(db.delete(StatisticsRollup).filter_by(user_id=user_id, period=period, start=start))
+        connection.execute(db.insert(StatisticsRollup).from_select(
+            ['user_id', 'period', 'start', 'language', *ROLLUP_COLUMNS],
+            db.select(
+                db.literal(user_id),
+                db.literal(period),
+                db.literal(start, db.Date),
+                Statistics.language,
+                *(db.func.coalesce(db.func.sum(getattr(Statistics, column)), 0) for column in ROLLUP_COLUMNS)
+            ).where(
+                Statistics.user_id == user_id,
+                Statistics.date >= start,
+                Statistics.date <= rollup_end(period, start)
+            ).group_by(Statistics.language)
+        ))
+
+def expected_statistics_rollups(connection, user_id=None):
+    """Rollup totals by (user_id, period, start, language), computed from the Statistics rows"""
+    query = db.select(
+        Statistics.user_id, Statistics.date, Statistics.language,
+        *(db.func.sum(getattr(Statistics, column)) for column in ROLLUP_COLUMNS)
+    ).group_by(Statistics.user_id, Statistics.date, Statistics.language)
+    if user_id is not None:
+        query = query.where(Statistics.user_id == user_id)
+    
+    expected = defaultdict(lambda: [0] * len(ROLLUP_COLUMNS))
+    for row in connection.execute(query):
+        for period in ROLLUP_PERIODS:
+            totals = expected[(row.user_id, period, rollup_start(period, row.date), row.language)]
+            for index, value in enumerate(row[3:]):
+                totals[index] += value or 0
+    return expected
+
+def stored_statistics_rollups(connection, user_id=None):
+    query = db.select(StatisticsRollup.user_id, StatisticsRollup.period, StatisticsRollup.start,
+                      StatisticsRollup.language, *(getattr(StatisticsRollup, column) for column in ROLLUP_COLUMNS))
+    if user_id is not None:
+        query = query.where(StatisticsRollup.user_id == user_id)
+    return {tuple(row[:4]): [value or 0 for value in row[4:]] for row in connection.execute(query)}
+
+def check_statistics_rollups(connection, user_id=None):
+    """(user_id, period, start) of every rollup that disagrees with the Statistics rows"""
+    expected = expected_statistics_rollups(connection, user_id)
+    stored = stored_statistics_rollups(connection, user_id)
+    return sorted({key[:3] for key in expected.keys() | stored.keys() if expected.get(key) != stored.get(key)})
+
+def rebuild_statistics_rollups(connection, user_id=None):
+    """Replace the rollups of one user, or of everyone, with totals from the Statistics rows"""
+    query = db.delete(StatisticsRollup)
+    if user_id is not None:
+        query = query.where(StatisticsRollup.user_id == user_id)
+    connection.execute(query)
+    
+    rows = [dict(zip(('user_id', 'period', 'start', 'language', *ROLLUP_COLUMNS), (*key, *totals)))
+            for key, totals in expected_statistics_rollups(connection, user_id).items()]
+    if rows:
+        connection.execute(db.insert(StatisticsRollup), rows)
+
+def current_statistics_query(user_id=None):
+    """Per-user, per-language sums of the latest snapshot of every existing account"""
+    latest = db.select(Statistics.account_id, db.func.max(Statistics.date).label('date')).group_by(Statistics.account_id)
+    if user_id is not None:
+        latest = latest.where(Statistics.user_id == user_id)
+    latest = latest.subquery()
+    
+    query = db.select(
+        Statistics.user_id,
+        Statistics.language,
+        *(db.func.coalesce(db.func.sum(getattr(Statistics, column)), 0) for column in ROLLUP_COLUMNS)
+    ).join(
+        latest, db.and_(Statistics.account_id == latest.c.account_id, Statistics.date == latest.c.date)
+    ).join(
+        Account, Account.id == Statistics.account_id
+    ).group_by(Statistics.user_id, Statistics.language)
+    if user_id is not None:
+        query = query.where(Statistics.user_id == user_id)
+    return query
+
+def refresh_current_statistics(connection, user_id=None):
+    """Replace the CurrentStatistics rows of one user, or of everyone
+    
+    Run inside the transaction that changed the snapshots, so readers see
+    either the old rows or the new ones, never a mix.
+    """
+    query = db.delete(CurrentStatistics)
+    if user_id is not None:
+        query = query.where(CurrentStatistics.user_id == user_id)
+    connection.execute(query)
+    connection.execute(db.insert(CurrentStatistics).from_select(
+        ['user_id', 'language', *ROLLUP_COLUMNS], current_statistics_query(user_id)))
+
+def current_statistics(session, user_id, language=None):
+    query = db.select(CurrentStatistics).filter_by(user_id=user_id)
+    if language:
+        query = query.filter_by(language=language.upper())
+    return session.execute(query).scalars().all()
+
+@app.cli.command('check-rollups')
+@click.option('--rebuild', is_flag=True, help='Rebuild the rollups that disagree with the raw rows')
+def check_rollups_command(rebuild):
+    """Compare the statistics rollups with the raw Statistics rows"""
+    stale = check_statistics_rollups(db.session)
+    for user_id, period, start in stale:
+        print(f"✗ user {user_id}: {period} from {start} is out of date")
+    
+    if stale and rebuild:
+        for user_id in sorted({user_id for user_id, _, _ in stale}):
+            rebuild_statistics_rollups(db.session, user_id)
+        db.session.commit()
+        print(f"✓ Rebuilt rollups of {len({user_id for user_id, _, _ in stale})} users")
+    elif not stale:
+        print("✓ Statistics rollups are consistent")
 
 def save_statistics(user_id, account_id, stats, target_date=None):
     """Save statistics for a specific date"""
@@ -595,158 +3079,765 @@ def save_statistics(user_id, account_id, stats, target_date=None):
     total_files = 0
     languages_count = len(stats)
     
-    for language, data in stats.items():
-        stat = Statistics(
-            user_id=user_id,
-            account_id=account_id,
-            date=target_date,
-            language=language,
-            files=data['files'],
-            total_lines=data['total'],
-            code_lines=data['code'],
-            comment_lines=data['comment'],
-            empty_lines=data['empty']
-        )
-        db.session.add(stat)
-        total_lines += data['total']
-        total_files += data['files']
+    for language, data in stats.items():
+        stat = Statistics(
+            user_id=user_id,
+            account_id=account_id,
+            date=target_date,
+            language=language,
+            files=data['files'],
+            total_lines=data['total'],
+            code_lines=data['code'],
+            comment_lines=data['comment'],
+            empty_lines=data['empty']
+        )
+        db.session.add(stat)
+        total_lines += data['total']
+        total_files += data['files']
+    
+    # Update daily activity
+    daily = db.session.query(DailyActivity).filter_by(
+        user_id=user_id,
+        date=target_date
+    ).first()
+    
+    if daily:
+        daily.total_lines = total_lines
+        daily.code_lines = int(total_lines * 0.7)
+        daily.files_modified = total_files
+        daily.languages_used = languages_count
+    else:
+        daily = DailyActivity(
+            user_id=user_id,
+            date=target_date,
+            total_lines=total_lines,
+            code_lines=int(total_lines * 0.7),
+            files_modified=total_files,
+            languages_used=languages_count
+        )
+        db.session.add(daily)
+    
+    db.session.flush()
+    update_statistics_rollups(db.session, user_id, target_date)
+    refresh_current_statistics(db.session, user_id)
+    db.session.commit()
+    invalidate_response_caches(user_id)
+
+def analyze_account(account_id, user_id, force=False, checkpoint=None):
+    """Analyze single account with smart caching
+    
+    checkpoint skips the repositories a resumed ScanJob already finished.
+    """
+    account = db.session.get(Account, account_id)
+    if not account or not account.is_active:
+        return
+    
+    print(f"\n{'='*60}")
+    print(f"Analyzing account: {account.username} ({account.platform})")
+    print(f"{'='*60}")
+    
+    all_stats = {}
+    checkpoint = checkpoint or ScanCheckpoint()
+    
+    engine = get_setting(user_id, 'scan_engine', app.config['SCAN_ENGINE'])
+    if engine == 'async' and aiohttp is None:
+        print("aiohttp is not installed, using the threaded scanner")
+        engine = 'threaded'
+    
+    if engine == 'async':
+        all_stats = run_async_scan(account, force=force, checkpoint=checkpoint)
+    
+    elif account.platform in ('github', 'gitlab'):
+        if account.platform == 'github':
+            repos = fetch_github_repos(account)
+            analyze_repo = analyze_github_repo
+        else:
+            repos = fetch_gitlab_repos(account)
+            analyze_repo = analyze_gitlab_repo
+        print(f"Found {len(repos)} repositories")
+        
+        host = account_host(account)
+        progress = current_progress.get()
+        progress.set_repos(len(repos))
+        
+        def scan_repo(repo_idx, repo):
+            # Each repository thread has its own app context and db.session
+            with app.app_context(), host_semaphore(host, 'SCAN_REPOS_PER_HOST'):
+                print(f"\n[{repo_idx}/{len(repos)}] Analyzing repo: {repo['name']}...")
+                progress.start_repo(repo['name'])
+                try:
+                    repo_stats = analyze_repo(db.session.get(Account, account_id), repo, force=force)
+                finally:
+                    progress.finish_repo(repo['name'])
+                checkpoint.mark(repo)
+                return repo_stats
+        
+        with ThreadPoolExecutor(max_workers=app.config['SCAN_REPO_CONCURRENCY']) as pool:
+            scans = {}
+            for repo_idx, repo in enumerate(repos, 1):
+                repo_stats = checkpoint.cached(account, repo)
+                if repo_stats is not None:
+                    print(f"\n[{repo_idx}/{len(repos)}] ⏭ {repo['name']} already scanned by this job")
+                    progress.finish_repo(repo['name'])
+                    merge_stats(all_stats, repo_stats)
+                else:
+                    # Copy the context so the repository thread reports to this job's tracker
+                    scans[pool.submit(contextvars.copy_context().run, scan_repo, repo_idx, repo)] = repo
+            
+            # Results are merged here, on the account's thread, as repositories finish
+            for scan in as_completed(scans):
+                repo_stats = scan.result()
+                total_lines = sum(data['total'] for data in repo_stats.values())
+                total_files = sum(data['files'] for data in repo_stats.values())
+                print(f"  ✓ {scans[scan]['name']}: Files: {total_files}, Lines: {total_lines:,}")
+                
+                merge_stats(all_stats, repo_stats)
+    
+    save_statistics(user_id, account.id, all_stats)
+    account.last_sync = datetime.utcnow()
+    db.session.commit()
+    
+    print(f"\n{'='*60}")
+    print(f"✓ Completed analysis for {account.username}")
+    print(f"{'='*60}\n")
+
+def analyze_user_accounts(user_id, force=False, priority=SCAN_PRIORITY_MANUAL):
+    """Queue a scan of every active account of a user"""
+    accounts = db.session.query(Account).filter_by(
+        user_id=user_id,
+        is_active=True
+    ).all()
+    
+    summary = {
+        'is_active': bool(accounts),
+        'percentage': 10 if accounts else 100,
+        'status': 'Starting analysis...' if accounts else 'Analysis completed!',
+        'details': f'Found {len(accounts)} active accounts',
+        'total_accounts': len(accounts),
+        'accounts_done': 0,
+        'job_ids': []
+    }
+    progress_store.save(user_id, 'summary', summary)
+    
+    jobs = [enqueue_scan(account, force=force, priority=priority) for account in accounts]
+    
+    summary['job_ids'] = [job.id for job in jobs]
+    progress_store.save(user_id, 'summary', summary)
+    return jobs
+
+class ProgressStore(ABC):
+    """Backend for published scan progress: JSON records by (user_id, key)"""
+    
+    @abstractmethod
+    def save(self, user_id, key, record):
+        """Store record under (user_id, key), replacing the one before"""
+    
+    @abstractmethod
+    def load(self, user_id):
+        """All records of a user as {key: record}"""
+    
+    @abstractmethod
+    def prune(self, before):
+        """Drop records not updated since before"""
+
+class MemoryProgressStore(ProgressStore):
+    """Records in this process only; enough for a single-process deployment"""
+    
+    def __init__(self):
+        self.records = defaultdict(dict)
+        self.lock = threading.Lock()
+    
+    def save(self, user_id, key, record):
+        with self.lock:
+            self.records[user_id][key] = (json.loads(json.dumps(record)), datetime.utcnow())
+    
+    def load(self, user_id):
+        with self.lock:
+            return {key: record for key, (record, _) in self.records.get(user_id, {}).items()}
+    
+    def prune(self, before):
+        with self.lock:
+            for records in self.records.values():
+                for key in [key for key, (_, updated_at) in records.items() if updated_at < before]:
+                    del records[key]
+
+class DatabaseProgressStore(ProgressStore):
+    """Records in the scan_progress table, shared by every process using the database
+    
+    Each call runs on its own connection and transaction, so publishing
+    progress never commits or waits on the caller's db.session.
+    """
+    
+    def save(self, user_id, key, record):
+        values = {'data': json.dumps(record), 'updated_at': datetime.utcnow()}
+        update = db.update(ScanProgress).filter_by(user_id=user_id, key=key).values(**values)
+        try:
+            with db.engine.begin() as connection:
+                if not connection.execute(update).rowcount:
+                    connection.execute(db.insert(ScanProgress).values(user_id=user_id, key=key, **values))
+        except IntegrityError:
+            # Another process inserted the record first
+            with db.engine.begin() as connection:
+                connection.execute(update)
+    
+    def load(self, user_id):
+        with db.engine.connect() as connection:
+            rows = connection.execute(db.select(ScanProgress.key, ScanProgress.data).filter_by(user_id=user_id))
+            return {key: json.loads(data) for key, data in rows}
+    
+    def prune(self, before):
+        with db.engine.begin() as connection:
+            connection.execute(db.delete(ScanProgress).where(ScanProgress.updated_at < before))
+
+PROGRESS_BACKENDS = {
+    'database': DatabaseProgressStore,
+    'memory': MemoryProgressStore,
+}
+
+progress_store = PROGRESS_BACKENDS[app.config['PROGRESS_BACKEND']]()
+
+class ProgressTracker:
+    """Live progress of one ScanJob: repositories and files done, throughput and ETA
+    
+    Scan code reaches the tracker of its job through current_progress, from
+    any thread. Trackers only change in memory; the scan worker pool
+    publishes the changed ones to progress_store every PROGRESS_INTERVAL
+    seconds. Without a job (the default tracker) nothing is published.
+    """
+    
+    def __init__(self, job=None, account=''):
+        self.job_id = job.id if job else None
+        self.user_id = job.user_id if job else None
+        self.account = account
+        self.state = 'running'
+        self.started = time.monotonic()
+        self.repos_total = 0
+        self.repos_done = 0
+        self.files_total = 0
+        self.files_done = 0
+        self.current = []
+        self.deferred = []  # repositories left for the next sync by rate limits or failed files
+        self.lock = threading.Lock()
+        self.dirty = True
+    
+    def set_repos(self, total):
+        with self.lock:
+            self.repos_total = total
+            self.dirty = True
+    
+    def start_repo(self, name):
+        with self.lock:
+            self.current.append(name)
+            self.dirty = True
+    
+    def finish_repo(self, name):
+        with self.lock:
+            if name in self.current:
+                self.current.remove(name)
+            self.repos_done += 1
+            self.dirty = True
+    
+    def defer(self, name):
+        # The default tracker lives as long as the process, so it keeps no names
+        if not self.job_id:
+            return
+        with self.lock:
+            if name not in self.deferred:
+                self.deferred.append(name)
+            self.dirty = True
+    
+    def add_files(self, count=1):
+        with self.lock:
+            self.files_total += count
+            self.dirty = True
+    
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+            self.dirty = True
+    
+    def finish(self, state):
+        with self.lock:
+            self.state = state
+            self.current = []
+            self.dirty = True
+    
+    def record(self):
+        with self.lock:
+            elapsed = max(time.monotonic() - self.started, 0.001)
+            files_per_second = self.files_done / elapsed
+            fraction = self.repos_done / self.repos_total if self.repos_total else 0
+            if self.state != 'running':
+                fraction = 1
+            
+            eta = None
+            if 0 < fraction < 1:
+                eta = elapsed * (1 - fraction) / fraction
+            elif self.state == 'running' and files_per_second and self.files_total > self.files_done:
+                eta = (self.files_total - self.files_done) / files_per_second
+            
+            return {
+                'job_id': self.job_id,
+                'account': self.account,
+                'state': self.state,
+                'repos_total': self.repos_total,
+                'repos_done': self.repos_done,
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'current_repos': list(self.current),
+                'deferred_repos': list(self.deferred),
+                'elapsed_seconds': round(elapsed, 1),
+                'files_per_second': round(files_per_second, 1),
+                'eta_seconds': round(eta) if eta is not None else None,
+                'percentage': round(fraction * 100, 1)
+            }
+    
+    def publish(self):
+        """Save the record if it changed since the last publish"""
+        if not self.job_id or not self.dirty:
+            return
+        self.dirty = False
+        progress_store.save(self.user_id, f'job-{self.job_id}', self.record())
+
+# ProgressTracker of the scan job running in this thread or task
+current_progress = contextvars.ContextVar('current_progress', default=ProgressTracker())
+
+def publish_progress():
+    with progress_trackers_lock:
+        trackers = list(progress_trackers.values())
+    for tracker in trackers:
+        tracker.publish()
+
+def scan_progress(user_id):
+    """The user's progress as the dashboard shows it: summary plus live job records"""
+    records = progress_store.load(user_id)
+    progress = records.pop('summary', None) or {
+        'is_active': False,
+        'percentage': 0,
+        'status': 'Ready',
+        'details': ''
+    }
+    
+    job_ids = set(progress.get('job_ids', []))
+    jobs = sorted((record for record in records.values() if record['job_id'] in job_ids),
+                  key=lambda record: record['job_id'])
+    progress['accounts'] = jobs
+    
+    running = [job for job in jobs if job['state'] == 'running']
+    if progress.get('is_active') and running:
+        total = progress.get('total_accounts') or len(jobs)
+        done = progress.get('accounts_done', 0) + sum(job['percentage'] for job in running) / 100
+        etas = [job['eta_seconds'] for job in running if job['eta_seconds'] is not None]
+        files_per_second = sum(job['files_per_second'] for job in running)
+        repos = [repo for job in running for repo in job['current_repos']]
+        
+        progress.update({
+            'percentage': round(10 + (done / total) * 80, 1),
+            'status': f"Analyzing {', '.join(job['account'] for job in running)}...",
+            'details': ' · '.join(filter(None, [
+                f"{progress.get('accounts_done', 0)} of {total} accounts done",
+                f"{', '.join(repos[:3])}" if repos else '',
+                f"{sum(job['files_done'] for job in running)}/{sum(job['files_total'] for job in running)} files",
+                f"{files_per_second:.1f} files/s" if files_per_second else '',
+                f"about {format_duration(max(etas))} left" if etas else ''
+            ])),
+            'files_per_second': round(files_per_second, 1),
+            'eta_seconds': max(etas) if etas else None
+        })
+    return progress
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s" if minutes else f"{seconds}s"
+
+class ScanCheckpoint:
+    """Repositories a ScanJob has finished, recorded as it goes
+    
+    Without a job nothing is recorded and every repository is scanned.
+    """
+    
+    def __init__(self, job=None):
+        self.job_id = job.id if job else None
+        self.done = set()
+        if self.job_id:
+            self.done = set(db.session.execute(
+                db.select(ScanJobRepository.repo_id).filter_by(job_id=self.job_id)).scalars())
+    
+    def cached(self, account, repo_info):
+        """Stats of a repository this job already finished, None if it still needs scanning"""
+        if str(repo_info['id']) not in self.done:
+            return None
+        db_repo = find_repository(account, repo_info)
+        return cached_repo_stats(db_repo) if db_repo else {}
+    
+    def mark(self, repo_info):
+        if not self.job_id:
+            return
+        repo_id = str(repo_info['id'])
+        db.session.add(ScanJobRepository(job_id=self.job_id, repo_id=repo_id))
+        db.session.commit()
+        self.done.add(repo_id)
+
+def active_scan_job(account_id):
+    return db.session.query(ScanJob).filter(
+        ScanJob.account_id == account_id,
+        ScanJob.status.in_(SCAN_JOB_ACTIVE)
+    ).first()
+
+def enqueue_scan(account, force=False, priority=SCAN_PRIORITY_MANUAL):
+    """Queue a scan of one account, or merge the request into its queued or running job
+    
+    A queued job takes the more urgent priority and force of the two; a
+    running one is left alone.
+    """
+    job = active_scan_job(account.id)
+    
+    if not job:
+        job = ScanJob(user_id=account.user_id, account_id=account.id, host=account_host(account),
+                      priority=priority, force=force)
+        db.session.add(job)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another request queued this account first
+            db.session.rollback()
+            return enqueue_scan(account, force, priority)
+        print(f"📥 Queued scan job {job.id} for {account.username} (priority {priority})")
+    
+    elif job.status == 'queued' and (priority < job.priority or (force and not job.force)):
+        db.session.execute(db.update(ScanJob).filter_by(id=job.id, status='queued').values(
+            priority=min(priority, job.priority),
+            force=force or job.force
+        ))
+        db.session.commit()
+    
+    scan_workers.wake()
+    return job
+
+def claim_scan_job():
+    """Take the most urgent queued job, or None; safe across threads and processes
+    
+    Jobs for a host that already has SCAN_ACCOUNTS_PER_HOST running jobs
+    wait, so a free worker picks up an account on another host instead.
+    """
+    while True:
+        query = db.select(ScanJob.id).filter_by(status='queued')
+        if app.config['SCAN_ACCOUNTS_PER_HOST'] > 0:
+            # A NULL in the list would make NOT IN match nothing
+            busy_hosts = db.select(ScanJob.host).where(
+                ScanJob.status == 'running', ScanJob.host.is_not(None)
+            ).group_by(ScanJob.host).having(db.func.count() >= app.config['SCAN_ACCOUNTS_PER_HOST'])
+            query = query.where(db.or_(ScanJob.host.is_(None), ScanJob.host.not_in(busy_hosts)))
+        
+        job_id = db.session.execute(query.order_by(ScanJob.priority, ScanJob.id).limit(1)).scalar()
+        if job_id is None:
+            return None
+        
+        now = datetime.utcnow()
+        claimed = db.session.execute(db.update(ScanJob).filter_by(id=job_id, status='queued').values(
+            status='running',
+            attempts=ScanJob.attempts + 1,
+            started_at=now,
+            heartbeat_at=now
+        )).rowcount
+        db.session.commit()
+        if claimed:
+            return db.session.get(ScanJob, job_id)
+
+def finish_scan_job(job, status, error=None):
+    """Close a job as done, deferred or failed, or hand it back to the queue to be retried"""
+    job.status = status
+    job.error = error
+    if status != 'queued':
+        job.finished_at = datetime.utcnow()
+        db.session.execute(db.delete(ScanJobRepository).filter_by(job_id=job.id))
+    db.session.commit()
+
+def run_scan_job(job):
+    """Run a claimed job, resuming after the repositories it already finished"""
+    print(f"▶ Scan job {job.id}: account {job.account_id}, attempt {job.attempts}")
+    account = db.session.get(Account, job.account_id)
+    tracker = ProgressTracker(job, account.username if account else str(job.account_id))
+    with progress_trackers_lock:
+        progress_trackers[job.id] = tracker
+    report_scan_progress(job.user_id, job.id)
+    
+    token = current_progress.set(tracker)
+    try:
+        analyze_account(job.account_id, job.user_id, force=job.force, checkpoint=ScanCheckpoint(job))
+    except Exception as e:
+        db.session.rollback()
+        print(f"Error in scan job {job.id}: {e}")
+        retry = job.attempts < app.config['SCAN_JOB_MAX_ATTEMPTS']
+        finish_scan_job(job, 'queued' if retry else 'failed', str(e))
+        tracker.finish('queued' if retry else 'failed')
+    else:
+        # Deferred repositories keep their cached counts until the next sync scans them
+        if tracker.deferred:
+            finish_scan_job(job, 'deferred', f"{len(tracker.deferred)} repositories deferred to the next sync: "
+                                             f"{', '.join(tracker.deferred)}")
+            tracker.finish('deferred')
+        else:
+            finish_scan_job(job, 'done')
+            tracker.finish('done')
+    finally:
+        current_progress.reset(token)
+        with progress_trackers_lock:
+            progress_trackers.pop(job.id, None)
+    
+    tracker.publish()
+    report_scan_progress(job.user_id)
+
+def report_scan_progress(user_id, job_id=None):
+    """Update the user's progress summary from their jobs still in the queue"""
+    pending = db.session.query(ScanJob).filter(
+        ScanJob.user_id == user_id,
+        ScanJob.status.in_(SCAN_JOB_ACTIVE)
+    ).count()
     
-    # Update daily activity
-    daily = db.session.query(DailyActivity).filter_by(
-        user_id=user_id,
-        date=target_date
-    ).first()
+    progress = progress_store.load(user_id).get('summary', {})
+    total = max(progress.get('total_accounts') or 0, pending)
+    job_ids = progress.get('job_ids', [])
+    if job_id and job_id not in job_ids:
+        # A job queued by an earlier request that this summary did not see
+        job_ids.append(job_id)
     
-    if daily:
-        daily.total_lines = total_lines
-        daily.code_lines = int(total_lines * 0.7)
-        daily.files_modified = total_files
-        daily.languages_used = languages_count
+    if pending:
+        done = total - pending
+        progress.update({
+            'is_active': True,
+            'percentage': round(10 + (done / total) * 80, 1),
+            'status': 'Analyzing accounts...',
+            'details': f'{done} of {total} accounts done',
+            'total_accounts': total,
+            'accounts_done': done,
+            'job_ids': job_ids
+        })
     else:
-        daily = DailyActivity(
-            user_id=user_id,
-            date=target_date,
-            total_lines=total_lines,
-            code_lines=int(total_lines * 0.7),
-            files_modified=total_files,
-            languages_used=languages_count
-        )
-        db.session.add(daily)
+        progress.update({
+            'is_active': False,
+            'percentage': 100,
+            'status': 'Analysis completed!',
+            'details': 'All accounts processed',
+            'accounts_done': total,
+            'job_ids': job_ids
+        })
+    progress_store.save(user_id, 'summary', progress)
+
+def heartbeat_scan_jobs(job_ids):
+    if job_ids:
+        db.session.execute(db.update(ScanJob).where(
+            ScanJob.id.in_(job_ids), ScanJob.status == 'running'
+        ).values(heartbeat_at=datetime.utcnow()))
+    db.session.commit()
+
+def requeue_stale_scan_jobs():
+    """Queue again the running jobs of processes that stopped heartbeating, and drop old finished jobs"""
+    now = datetime.utcnow()
+    stale = db.session.execute(db.update(ScanJob).where(
+        ScanJob.status == 'running',
+        ScanJob.heartbeat_at < now - timedelta(seconds=app.config['SCAN_JOB_STALE_AFTER'])
+    ).values(status='queued')).rowcount
     
+    finished = db.select(ScanJob.id).where(
+        ScanJob.status.in_(('done', 'deferred', 'failed')),
+        ScanJob.finished_at < now - timedelta(days=app.config['SCAN_JOB_RETENTION_DAYS'])
+    )
+    db.session.execute(db.delete(ScanJobRepository).where(ScanJobRepository.job_id.in_(finished)))
+    db.session.execute(db.delete(ScanJob).where(ScanJob.id.in_(finished)))
     db.session.commit()
+    progress_store.prune(now - timedelta(days=app.config['SCAN_JOB_RETENTION_DAYS']))
+    
+    if stale:
+        print(f"♻ Requeued {stale} scan jobs left running by a stopped worker")
+    return stale
 
-def analyze_account(account_id, user_id, force=False):
-    """Analyze single account with smart caching"""
-    global scanning_progress
+class ScanWorkerPool:
+    """Fixed-size pool of threads running ScanJob rows from the database queue
     
-    account = db.session.get(Account, account_id)
-    if not account or not account.is_active:
-        return
+    The queue lives in the database, so jobs survive restarts and every
+    process sharing the database can run a pool: claim_scan_job() hands each
+    job to exactly one worker. A supervisor thread heartbeats this pool's
+    running jobs and requeues jobs whose process stopped heartbeating, and a
+    publisher thread saves the progress of running jobs.
+    """
     
-    print(f"\n{'='*60}")
-    print(f"Analyzing account: {account.username} ({account.platform})")
-    print(f"{'='*60}")
+    def __init__(self, workers=None):
+        self.workers = workers
+        self.threads = []
+        self.running = set()
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition()
     
-    all_stats = {}
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            count = self.workers or app.config['SCAN_WORKERS']
+            self.threads = [threading.Thread(target=self._work, name=f'scan-worker-{n}', daemon=True)
+                            for n in range(count)]
+            self.threads.append(threading.Thread(target=self._supervise, name='scan-supervisor', daemon=True))
+            self.threads.append(threading.Thread(target=self._publish, name='scan-progress', daemon=True))
+            for thread in self.threads:
+                thread.start()
+            print(f"Started {count} scan workers")
     
-    if account.platform == 'github':
-        repos = fetch_github_repos(account)
-        print(f"Found {len(repos)} repositories")
-        
-        for repo_idx, repo in enumerate(repos, 1):
-            print(f"\n[{repo_idx}/{len(repos)}] Analyzing repo: {repo['name']}...")
-            repo_stats = analyze_github_repo(account, repo, force=force)
-            
-            total_lines = sum(data['total'] for data in repo_stats.values())
-            total_files = sum(data['files'] for data in repo_stats.values())
-            print(f"  ✓ Files: {total_files}, Lines: {total_lines:,}")
-            
-            for lang, data in repo_stats.items():
-                if lang not in all_stats:
-                    all_stats[lang] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
-                all_stats[lang]['files'] += data['files']
-                all_stats[lang]['total'] += data['total']
-                all_stats[lang]['code'] += data['code']
-                all_stats[lang]['comment'] += data['comment']
-                all_stats[lang]['empty'] += data['empty']
-    
-    elif account.platform == 'gitlab':
-        repos = fetch_gitlab_repos(account)
-        print(f"Found {len(repos)} repositories")
-        
-        for repo_idx, repo in enumerate(repos, 1):
-            print(f"\n[{repo_idx}/{len(repos)}] Analyzing repo: {repo['name']}...")
-            repo_stats = analyze_gitlab_repo(account, repo, force=force)
-            
-            total_lines = sum(data['total'] for data in repo_stats.values())
-            total_files = sum(data['files'] for data in repo_stats.values())
-            print(f"  ✓ Files: {total_files}, Lines: {total_lines:,}")
+    def wake(self):
+        """Start the pool if needed and let idle workers look for new jobs"""
+        self.start()
+        with self.wakeup:
+            self.wakeup.notify_all()
+    
+    def _work(self):
+        while True:
+            job_id = None
+            try:
+                with app.app_context():
+                    job = claim_scan_job()
+                    if job:
+                        job_id = job.id
+                        self.running.add(job_id)
+                        run_scan_job(job)
+            except Exception as e:
+                print(f"Scan worker error: {e}")
+            finally:
+                self.running.discard(job_id)
             
-            for lang, data in repo_stats.items():
-                if lang not in all_stats:
-                    all_stats[lang] = {'files': 0, 'total': 0, 'code': 0, 'comment': 0, 'empty': 0}
-                all_stats[lang]['files'] += data['files']
-                all_stats[lang]['total'] += data['total']
-                all_stats[lang]['code'] += data['code']
-                all_stats[lang]['comment'] += data['comment']
-                all_stats[lang]['empty'] += data['empty']
+            if job_id is None:
+                with self.wakeup:
+                    self.wakeup.wait(app.config['SCAN_POLL_INTERVAL'])
     
-    save_statistics(user_id, account.id, all_stats)
-    account.last_sync = datetime.utcnow()
-    db.session.commit()
+    def _supervise(self):
+        while True:
+            try:
+                with app.app_context():
+                    requeue_stale_scan_jobs()
+                    heartbeat_scan_jobs(list(self.running))
+            except Exception as e:
+                print(f"Scan supervisor error: {e}")
+            time.sleep(app.config['SCAN_POLL_INTERVAL'])
     
-    print(f"\n{'='*60}")
-    print(f"✓ Completed analysis for {account.username}")
-    print(f"{'='*60}\n")
+    def _publish(self):
+        while True:
+            time.sleep(app.config['PROGRESS_INTERVAL'])
+            try:
+                with app.app_context():
+                    publish_progress()
+            except Exception as e:
+                print(f"Progress publisher error: {e}")
 
-def analyze_user_accounts(user_id, force=False):
-    """Analyze all accounts for a user"""
-    global scanning_progress
+# Scan workers of this process, started by the first request or queued job
+scan_workers = ScanWorkerPool()
+
+# Periodic sync
+SYNC_JOB_PREFIX = 'sync-user-'
+MAX_SYNC_INTERVAL = 168
+
+def sync_interval(value):
+    """Hours between automatic syncs for an auto_update_interval value"""
+    try:
+        hours = int(value)
+    except (TypeError, ValueError):
+        return app.config['SYNC_DEFAULT_INTERVAL']
+    return min(max(hours, 1), MAX_SYNC_INTERVAL)
+
+def sync_start(user_id, hours, now=None):
+    """Next run of a user's sync: the user's fixed phase within the interval
     
+    The phase comes from a hash of the user id, so it survives restarts and
+    users sharing an interval are spread evenly over it.
+    """
+    period = hours * 3600
+    phase = int.from_bytes(hashlib.sha256(f'sync:{user_id}'.encode()).digest()[:8], 'big') % period
+    now = now or datetime.utcnow()
+    elapsed = (now - datetime(1970, 1, 1)).total_seconds()
+    return now + timedelta(seconds=(phase - elapsed) % period)
+
+def scheduled_sync(user_id):
+    """Scheduler job: queue a scheduled scan of every active account of the user
+    
+    Accounts whose previous scan is still queued or running are not queued
+    again, so slow syncs never overlap.
+    """
     with app.app_context():
         try:
-            accounts = db.session.query(Account).filter_by(
-                user_id=user_id,
-                is_active=True
-            ).all()
-            
-            scanning_progress[user_id] = {
-                'is_active': True,
-                'percentage': 10,
-                'status': 'Starting analysis...',
-                'details': f'Found {len(accounts)} active accounts',
-                'total_accounts': len(accounts),
-                'current_account': 0
-            }
-            
-            for account_idx, account in enumerate(accounts, 1):
-                try:
-                    scanning_progress[user_id].update({
-                        'current_account': account_idx,
-                        'percentage': 10 + (account_idx / len(accounts)) * 80,
-                        'status': f'Analyzing {account.username}...',
-                        'details': f'Account {account_idx} of {len(accounts)}'
-                    })
-                    
-                    analyze_account(account.id, user_id, force=force)
-                except Exception as e:
-                    print(f"Error analyzing account {account.username}: {e}")
+            jobs = analyze_user_accounts(user_id, priority=SCAN_PRIORITY_SCHEDULED)
+            print(f"⏰ Scheduled sync for user {user_id}: {len(jobs)} accounts")
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error in scheduled sync for user {user_id}: {e}")
+
+def schedule_user_sync(user_id, interval=None):
+    """Register or re-plan a user's periodic sync; an unchanged schedule is left as it is"""
+    if not scheduler.running:
+        return None
+    
+    if interval is None:
+        interval = get_setting(user_id, 'auto_update_interval')
+    hours = sync_interval(interval)
+    
+    job_id = f'{SYNC_JOB_PREFIX}{user_id}'
+    job = scheduler.get_job(job_id)
+    if job and job.trigger.interval == timedelta(hours=hours):
+        return job
+    
+    print(f"⏰ Syncing user {user_id} every {hours}h")
+    return scheduler.add_job(
+        id=job_id,
+        func=scheduled_sync,
+        args=[user_id],
+        trigger='interval',
+        hours=hours,
+        start_date=sync_start(user_id, hours),
+        jitter=app.config['SYNC_JITTER'],
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=None,
+        replace_existing=True
+    )
+
+def plan_sync_schedules():
+    """Match the sync jobs to the users with active accounts and their interval settings"""
+    with app.app_context():
+        try:
+            intervals = dict(db.session.execute(
+                db.select(Settings.user_id, Settings.value).filter_by(key='auto_update_interval')
+            ).all())
+            user_ids = set(db.session.execute(
+                db.select(User.id).where(User.is_active, User.accounts.any(Account.is_active))
+            ).scalars())
             
-            scanning_progress[user_id].update({
-                'is_active': False,
-                'percentage': 100,
-                'status': 'Analysis completed!',
-                'details': 'All accounts processed successfully'
-            })
+            for user_id in user_ids:
+                schedule_user_sync(user_id, intervals.get(user_id))
             
+            for job in scheduler.get_jobs():
+                if job.id.startswith(SYNC_JOB_PREFIX) and int(job.id[len(SYNC_JOB_PREFIX):]) not in user_ids:
+                    scheduler.remove_job(job.id)
         except Exception as e:
-            print(f"Error in analyze_user_accounts: {e}")
-            scanning_progress[user_id] = {
-                'is_active': False,
-                'percentage': 0,
-                'status': 'Analysis failed',
-                'details': str(e)
-            }
+            db.session.rollback()
+            print(f"Error planning sync schedules: {e}")
+
+def start_scheduler():
+    """Start the periodic sync scheduler once per process"""
+    if not app.config['SCHEDULER_ENABLED'] or scheduler.running:
+        return
+    with scheduler_lock:
+        if scheduler.running:
+            return
+        scheduler.start()
+        scheduler.add_job(
+            id='plan-sync-schedules',
+            func=plan_sync_schedules,
+            trigger='interval',
+            seconds=app.config['SYNC_PLAN_INTERVAL'],
+            next_run_time=datetime.utcnow(),
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
 
 # SVG Badge Generator
 def format_number(number):
@@ -788,7 +3879,301 @@ def generate_svg_badge(label, value, color="#08C"):
     
     return svg
 
+def render_badge(user_id, badge_type, language, color):
+    """SVG of one badge from the user's current statistics"""
+    stats = current_statistics(read_session(), user_id, language)
+    
+    if badge_type == 'total_lines':
+        total = sum(s.total_lines for s in stats)
+        label = f"{language} Total Lines" if language else "Total Lines"
+        svg = generate_svg_badge(label, format_number(total), color)
+    
+    elif badge_type == 'code_lines':
+        total = sum(s.code_lines for s in stats)
+        label = f"{language} Code Lines" if language else "Code Lines"
+        svg = generate_svg_badge(label, format_number(total), color)
+    
+    elif badge_type == 'files':
+        total = sum(s.files for s in stats)
+        label = f"{language} Files" if language else "Files"
+        svg = generate_svg_badge(label, format_number(total), color)
+    
+    elif badge_type == 'comment_lines':
+        total = sum(s.comment_lines for s in stats)
+        label = f"{language} Comment Lines" if language else "Comment Lines"
+        svg = generate_svg_badge(label, format_number(total), color)
+    
+    elif badge_type == 'empty_lines':
+        total = sum(s.empty_lines for s in stats)
+        label = f"{language} Empty Lines" if language else "Empty Lines"
+        svg = generate_svg_badge(label, format_number(total), color)
+    
+    else:
+        svg = generate_svg_badge("Error", "Invalid Type", "#f00")
+    
+    return svg
+
+class ResponseCache:
+    """LRU cache of response bodies, holding at most max_bytes per process
+    
+    Entries are (body, etag) under keys whose first item is the user_id the
+    response was built from. invalidate() drops a user's entries and bumps
+    their generation, so a body built from data read before the invalidation
+    is not stored.
+    """
+    
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (body, etag, expires)
+        self.user_keys = defaultdict(set)
+        self.generations = defaultdict(int)
+        self.size = 0
+        self.lock = threading.Lock()
+    
+    def generation(self, user_id):
+        with self.lock:
+            return self.generations[user_id]
+    
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[2] < time.monotonic():
+                self._remove(key)
+                return None
+            self.entries.move_to_end(key)
+            return entry[:2]
+    
+    def put(self, key, body, generation):
+        etag = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            if generation == self.generations[key[0]] and len(body) <= self.max_bytes:
+                if key in self.entries:
+                    self._remove(key)
+                self.entries[key] = (body, etag, time.monotonic() + self.ttl)
+                self.user_keys[key[0]].add(key)
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    self._remove(next(iter(self.entries)))
+        return body, etag
+    
+    def invalidate(self, user_id):
+        with self.lock:
+            self.generations[user_id] += 1
+            for key in list(self.user_keys.get(user_id, ())):
+                self._remove(key)
+    
+    def _remove(self, key):
+        body, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+        keys = self.user_keys[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self.user_keys[key[0]]
+
+# Badges by (user_id, badge_type, language, color)
+badge_cache = ResponseCache(app.config['BADGE_CACHE_BYTES'], app.config['BADGE_CACHE_TTL'])
+# Custom endpoint results by (user_id, endpoint_id, parameters)
+endpoint_cache = ResponseCache(app.config['ENDPOINT_CACHE_BYTES'], app.config['ENDPOINT_CACHE_TTL'])
+
+def invalidate_response_caches(user_id):
+    """Drop the cached badges and endpoint results built from a user's data"""
+    badge_cache.invalidate(user_id)
+    endpoint_cache.invalidate(user_id)
+
+# {{name}} or {{name:type}} in a custom endpoint query
+ENDPOINT_PARAMETER = re.compile(r"\{\{\s*(\w+)\s*(?::\s*(\w+)\s*)?\}\}")
+# A single-quoted SQL string literal ('' is a quote inside it) or a parameter outside one
+ENDPOINT_TOKEN = re.compile(r"'(?:[^']|'')*'|" + ENDPOINT_PARAMETER.pattern)
+# A number as an untyped argument; one with a leading zero, like a zip code, stays text
+ENDPOINT_NUMBER = re.compile(r'-?(?:0|[1-9][0-9]*)(\.[0-9]+)?')
+
+def endpoint_auto_value(value):
+    """An untyped argument outside quotes: an int or float when it is a number, else the string"""
+    match = ENDPOINT_NUMBER.fullmatch(value)
+    if not match:
+        return value
+    return float(value) if match.group(1) else int(value)
+
+ENDPOINT_PARAMETER_TYPES = {
+    'str': (str, db.String()),
+    'int': (int, db.Integer()),
+    'float': (float, db.Float()),
+    'date': (date.fromisoformat, db.Date()),
+    # The SQL type follows the bound value
+    'auto': (endpoint_auto_value, None),
+}
+
+class EndpointQuery:
+    """A custom endpoint query parsed into one statement with typed bound parameters
+    
+    Request arguments are converted to the declared type and bound, never
+    pasted into the SQL, and the statement is reused by every call. A
+    parameter inside a string literal is concatenated with the rest of it,
+    so '%{{lang}}%' becomes '%' || :lang || '%'. An untyped parameter
+    outside quotes binds numbers as numbers, so HAVING SUM(x) > {{min}}
+    does not compare a sum with a string.
+    """
+    
+    def __init__(self, query):
+        self.params = {}  # name -> type name
+        # Untyped names used outside a string literal, and names given a type
+        self.bare = set()
+        self.typed = set()
+        sql = ENDPOINT_TOKEN.sub(self._bind_token, query)
+        for name in self.bare - self.typed:
+            self.params[name] = 'auto'
+        self.statement = db.text(sql).bindparams(*(
+            db.bindparam(name, type_=ENDPOINT_PARAMETER_TYPES[type_name][1])
+            for name, type_name in self.params.items()
+        ))
+    
+    def _bind_token(self, match):
+        token = match.group(0)
+        if not token.startswith("'"):
+            if not match.group(2):
+                self.bare.add(match.group(1))
+            return self._bind_parameter(match)
+        
+        def literal(text):
+            # text() would take :word inside the literal for a parameter as well
+            return "'" + text.replace(':', '\\:') + "'"
+        
+        parts = []
+        position = 1
+        for parameter in ENDPOINT_PARAMETER.finditer(token, 1, len(token) - 1):
+            if parameter.start() > position:
+                parts.append(literal(token[position:parameter.start()]))
+            parts.append(self._bind_parameter(parameter))
+            position = parameter.end()
+        if position < len(token) - 1 or not parts:
+            parts.append(literal(token[position:-1]))
+        return ' || '.join(parts)
+    
+    def _bind_parameter(self, match):
+        name, type_name = match.group(1), match.group(2) or 'str'
+        if type_name not in ENDPOINT_PARAMETER_TYPES:
+            raise ValueError(f"Unknown type '{type_name}' for parameter '{name}'")
+        if match.group(2):
+            self.typed.add(name)
+        if self.params.setdefault(name, type_name) != type_name:
+            raise ValueError(f"Parameter '{name}' is used with two types")
+        return f':{name}'
+    
+    def bind(self, args):
+        """Typed parameter values from request arguments"""
+        values = {}
+        for name, type_name in self.params.items():
+            if name not in args:
+                raise ValueError(f"Missing parameter '{name}'")
+            try:
+                values[name] = ENDPOINT_PARAMETER_TYPES[type_name][0](args[name])
+            except ValueError:
+                raise ValueError(f"Parameter '{name}' must be {type_name}")
+        return values
+
+@lru_cache(maxsize=1024)
+def compile_endpoint_query(query):
+    return EndpointQuery(query)
+
+# FROM/JOIN table [AS] alias, to map the names in a query plan back to tables
+ENDPOINT_TABLE_REFERENCE = re.compile(r'\b(?:FROM|JOIN)\s+["`\[]?(\w+)["`\]]?(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+QUERY_PLAN_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)')
+
+def check_endpoint_cost(connection, compiled, query):
+    """Raise ValueError when a query reads every row of a table larger than ENDPOINT_SCAN_MAX_ROWS
+    
+    The plan comes from SQLite's EXPLAIN QUERY PLAN with every parameter
+    NULL; other databases only get the run-time limits.
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+    
+    try:
+        plan = connection.execute(db.text('EXPLAIN QUERY PLAN ' + compiled.statement.text),
+                                  {name: None for name in compiled.params}).all()
+    except SQLAlchemyError as e:
+        raise ValueError(f"Invalid query: {getattr(e, 'orig', e)}")
+    
+    tables = set(db.inspect(connection).get_table_names())
+    names = {}
+    for table, alias in ENDPOINT_TABLE_REFERENCE.findall(query):
+        names[table.lower()] = table
+        if alias:
+            names[alias.lower()] = table
+    
+    for row in plan:
+        match = QUERY_PLAN_SCAN.match(row[-1])
+        table = names.get(match.group(1).lower()) if match else None
+        if table not in tables:
+            continue
+        # max(rowid) is read from the end of the table b-tree instead of counting
+        rows = connection.execute(db.text(f'SELECT max(rowid) FROM "{table}"')).scalar() or 0
+        if rows > app.config['ENDPOINT_SCAN_MAX_ROWS']:
+            raise ValueError(f"Query reads all of {table} (about {rows:,} rows); filter it by an indexed column")
+
+@contextmanager
+def statement_timeout(connection, seconds):
+    """Interrupt SQLite statements run on connection once seconds have passed"""
+    dbapi_connection = connection.connection.driver_connection
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        yield
+        return
+    
+    deadline = time.monotonic() + seconds
+    # Called every 10000 VM instructions; a true result aborts the statement
+    dbapi_connection.set_progress_handler(lambda: time.monotonic() > deadline, 10000)
+    try:
+        yield
+    finally:
+        dbapi_connection.set_progress_handler(None, 10000)
+
+def run_endpoint_query(connection, compiled, params):
+    """Rows of a custom endpoint query as dicts, at most ENDPOINT_MAX_ROWS of them"""
+    with statement_timeout(connection, app.config['ENDPOINT_TIMEOUT']):
+        result = connection.execute(compiled.statement, params)
+        columns = list(result.keys())
+        try:
+            for row in itertools.islice(result, app.config['ENDPOINT_MAX_ROWS']):
+                yield dict(zip(columns, row))
+        finally:
+            result.close()
+
+def serialize_endpoint_rows(rows, ndjson):
+    if ndjson:
+        return ''.join(app.json.dumps(row) + '\n' for row in rows)
+    return app.json.dumps(rows)
+
+def stream_endpoint_rows(first, rows, ndjson, batch_size=100):
+    """A JSON array or NDJSON lines of first followed by the rest of rows, in chunks
+    
+    The status line is already sent when a later row fails, so the error
+    becomes the last record of the stream.
+    """
+    count = 0
+    chunk = [] if ndjson else ['[']
+    try:
+        for row in itertools.chain(first, rows):
+            chunk.append(app.json.dumps(row) + '\n' if ndjson else (',' if count else '') + app.json.dumps(row))
+            count += 1
+            if len(chunk) >= batch_size:
+                yield ''.join(chunk)
+                chunk = []
+    except SQLAlchemyError as e:
+        error = app.json.dumps({'error': str(getattr(e, 'orig', e))})
+        chunk.append(error + '\n' if ndjson else (',' if count else '') + error)
+    if not ndjson:
+        chunk.append(']')
+    yield ''.join(chunk)
+
 # Routes
+@app.before_request
+def start_background_workers():
+    scan_workers.start()
+    start_scheduler()
+
 @app.route('/')
 def index():
     if current_user.is_authenticated:
@@ -881,21 +4266,10 @@ def dashboard():
         end_date = today
     
     # Get user accounts
-    accounts = db.session.query(Account).filter_by(user_id=current_user.id).all()
+    accounts = read_session().query(Account).filter_by(user_id=current_user.id).all()
     
     # Get statistics for the period
-    stats_query = db.session.query(
-        Statistics.language,
-        db.func.sum(Statistics.files).label('files'),
-        db.func.sum(Statistics.total_lines).label('total_lines'),
-        db.func.sum(Statistics.code_lines).label('code_lines'),
-        db.func.sum(Statistics.comment_lines).label('comment_lines'),
-        db.func.sum(Statistics.empty_lines).label('empty_lines')
-    ).filter(
-        Statistics.user_id == current_user.id,
-        Statistics.date >= start_date,
-        Statistics.date <= end_date
-    ).group_by(Statistics.language).all()
+    stats_query = period_statistics(read_session(), current_user.id, start_date, end_date)
     
     stats_data = []
     for row in stats_query:
@@ -909,7 +4283,7 @@ def dashboard():
         })
     
     # Get daily activity for charts
-    activity_query = db.session.query(DailyActivity).filter(
+    activity_query = read_session().query(DailyActivity).filter(
         DailyActivity.user_id == current_user.id,
         DailyActivity.date >= start_date,
         DailyActivity.date <= end_date
@@ -1024,6 +4398,7 @@ def settings():
             )
             db.session.add(account)
             db.session.commit()
+            schedule_user_sync(current_user.id)
             flash('Account added successfully!', 'success')
             return redirect(url_for('settings'))
         
@@ -1044,8 +4419,34 @@ def settings():
                 )
                 db.session.add(setting)
             db.session.commit()
+            schedule_user_sync(current_user.id, interval)
             flash('Update interval saved!', 'success')
             return redirect(url_for('settings'))
+        
+        elif action == 'update_excludes':
+            account_ids = db.select(Account.id).filter_by(user_id=current_user.id)
+            key = EXCLUDE_PATHS_SETTING
+            account_id = request.form.get('account_id', type=int)
+            if account_id:
+                account = db.session.get(Account, account_id)
+                if not account or account.user_id != current_user.id:
+                    flash('Account not found', 'error')
+                    return redirect(url_for('settings'))
+                account_ids = [account.id]
+                key = f"{EXCLUDE_PATHS_SETTING}:{account.id}"
+            
+            setting = db.session.query(Settings).filter_by(user_id=current_user.id, key=key).first()
+            if setting:
+                setting.value = request.form.get('exclude_paths', '')
+            else:
+                setting = Settings(user_id=current_user.id, key=key, value=request.form.get('exclude_paths', ''))
+                db.session.add(setting)
+            # Counts of newly excluded files are only dropped by a full tree scan
+            db.session.execute(db.update(Repository).where(Repository.account_id.in_(account_ids)).values(
+                repo_hash=None))
+            db.session.commit()
+            flash('Excluded paths saved! They apply from the next analysis.', 'success')
+            return redirect(url_for('settings'))
     
     accounts = db.session.query(Account).filter_by(user_id=current_user.id).all()
     interval_setting = db.session.query(Settings).filter_by(
@@ -1053,8 +4454,20 @@ def settings():
         key='auto_update_interval'
     ).first()
     interval = interval_setting.value if interval_setting else '24'
+    exclude_settings = {
+        setting.key: setting.value or ''
+        for setting in db.session.query(Settings).filter(
+            Settings.user_id == current_user.id,
+            Settings.key.in_([EXCLUDE_PATHS_SETTING] + [f"{EXCLUDE_PATHS_SETTING}:{account.id}" for account in accounts])
+        )
+    }
+    account_exclude_paths = {
+        account.id: exclude_settings.get(f"{EXCLUDE_PATHS_SETTING}:{account.id}", '') for account in accounts
+    }
     
-    return render_template('settings_new.html', accounts=accounts, interval=interval, user=current_user)
+    return render_template('settings_new.html', accounts=accounts, interval=interval, user=current_user,
+                           exclude_paths=exclude_settings.get(EXCLUDE_PATHS_SETTING, ''),
+                           account_exclude_paths=account_exclude_paths)
 
 @app.route('/delete_account/<int:account_id>', methods=['POST'])
 @login_required
@@ -1062,7 +4475,10 @@ def delete_account(account_id):
     account = db.session.get(Account, account_id)
     if account and account.user_id == current_user.id:
         db.session.delete(account)
+        db.session.flush()
+        refresh_current_statistics(db.session, current_user.id)
         db.session.commit()
+        invalidate_response_caches(current_user.id)
         return jsonify({'success': True})
     return jsonify({'success': False, 'error': 'Account not found'})
 
@@ -1082,23 +4498,10 @@ def analyze_all():
     try:
         force = request.json.get('force', False) if request.is_json else False
         
-        global scanning_progress
-        scanning_progress[current_user.id] = {
-            'is_active': True,
-            'percentage': 5,
-            'status': 'Starting analysis...',
-            'details': 'Initializing scanning process'
-        }
-        
-        # Run analysis in background thread
-        thread = threading.Thread(
-            target=analyze_user_accounts,
-            args=(current_user.id, force)
-        )
-        thread.daemon = True
-        thread.start()
+        # Scan jobs run on the scan worker pool
+        jobs = analyze_user_accounts(current_user.id, force=force, priority=SCAN_PRIORITY_MANUAL)
         
-        return jsonify({'success': True})
+        return jsonify({'success': True, 'jobs': [job.id for job in jobs]})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
@@ -1106,14 +4509,40 @@ def analyze_all():
 @login_required
 def get_scanning_progress():
     """Get current scanning progress for user"""
-    global scanning_progress
-    progress = scanning_progress.get(current_user.id, {
-        'is_active': False,
-        'percentage': 0,
-        'status': 'Ready',
-        'details': ''
-    })
-    return jsonify(progress)
+    return jsonify(scan_progress(current_user.id))
+
+@app.route('/api/scanning_progress/stream')
+@login_required
+def stream_scanning_progress():
+    """Server-Sent Events with the user's scanning progress, sent whenever it changes
+    
+    A 204 tells EventSource not to reconnect, so with PROGRESS_STREAM off
+    the dashboard falls back to polling.
+    """
+    if not app.config['PROGRESS_STREAM']:
+        return '', 204
+    user_id = current_user.id
+    
+    def events():
+        deadline = time.monotonic() + app.config['PROGRESS_STREAM_TIMEOUT']
+        last_payload = None
+        last_sent = 0
+        
+        yield "retry: 3000\n\n"
+        while time.monotonic() < deadline:
+            payload = json.dumps(scan_progress(user_id))
+            if payload != last_payload:
+                yield f"data: {payload}\n\n"
+                last_payload = payload
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent > 15:
+                # Comment line that keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                last_sent = time.monotonic()
+            time.sleep(app.config['PROGRESS_STREAM_INTERVAL'])
+    
+    return Response(stream_with_context(events()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 # API Routes
 @app.route('/api/stats')
@@ -1136,18 +4565,23 @@ def api_stats():
     else:
         start_date = today
     
-    query = db.session.query(Statistics).filter(
-        Statistics.user_id == current_user.id,
-        Statistics.date >= start_date
-    )
-    
     if account_id:
-        query = query.filter(Statistics.account_id == account_id)
-    
-    if language:
-        query = query.filter(Statistics.language == language.upper())
-    
-    stats = query.all()
+        # Rollups are per user, so a single account is summed from the raw rows
+        query = read_session().query(Statistics).filter(
+            Statistics.user_id == current_user.id,
+            Statistics.date >= start_date,
+            Statistics.account_id == account_id
+        )
+        
+        if language:
+            query = query.filter(Statistics.language == language.upper())
+        
+        stats = query.all()
+    elif period == 'today':
+        # The latest snapshot of every account, even before today's sync ran
+        stats = current_statistics(read_session(), current_user.id, language)
+    else:
+        stats = period_statistics(read_session(), current_user.id, start_date, today, language)
     
     result = {}
     for stat in stats:
@@ -1177,7 +4611,7 @@ def api_badge(badge_type):
             return generate_svg_badge("Error", "Authentication Required", "#f00"), 200, {'Content-Type': 'image/svg+xml'}
         user_id = current_user.id
     else:
-        user = db.session.query(User).filter_by(username=username).first()
+        user = read_session().query(User).filter_by(username=username).first()
         if not user:
             return generate_svg_badge("Error", "User Not Found", "#f00"), 200, {'Content-Type': 'image/svg+xml'}
         user_id = user.id
@@ -1185,47 +4619,24 @@ def api_badge(badge_type):
     language = request.args.get('language')
     color = request.args.get('color', '#08C')
     
-    today = datetime.utcnow().date()
-    
-    query = db.session.query(Statistics).filter(
-        Statistics.user_id == user_id,
-        Statistics.date == today
-    )
-    
-    if language:
-        query = query.filter(Statistics.language == language.upper())
-    
-    stats = query.all()
-    
-    if badge_type == 'total_lines':
-        total = sum(s.total_lines for s in stats)
-        label = f"{language} Total Lines" if language else "Total Lines"
-        svg = generate_svg_badge(label, format_number(total), color)
-    
-    elif badge_type == 'code_lines':
-        total = sum(s.code_lines for s in stats)
-        label = f"{language} Code Lines" if language else "Code Lines"
-        svg = generate_svg_badge(label, format_number(total), color)
-    
-    elif badge_type == 'files':
-        total = sum(s.files for s in stats)
-        label = f"{language} Files" if language else "Files"
-        svg = generate_svg_badge(label, format_number(total), color)
-    
-    elif badge_type == 'comment_lines':
-        total = sum(s.comment_lines for s in stats)
-        label = f"{language} Comment Lines" if language else "Comment Lines"
-        svg = generate_svg_badge(label, format_number(total), color)
+    key = (user_id, badge_type, language, color)
     
-    elif badge_type == 'empty_lines':
-        total = sum(s.empty_lines for s in stats)
-        label = f"{language} Empty Lines" if language else "Empty Lines"
-        svg = generate_svg_badge(label, format_number(total), color)
+    cached = badge_cache.get(key)
+    if cached is None:
+        generation = badge_cache.generation(user_id)
+        svg = render_badge(user_id, badge_type, language, color)
+        cached = badge_cache.put(key, svg.encode('utf-8'), generation)
+    body, etag = cached
     
+    response = Response(body, mimetype='image/svg+xml')
+    response.set_etag(etag)
+    response.cache_control.max_age = app.config['BADGE_MAX_AGE']
+    # A badge of the signed-in user without ?user= must not be shared by proxies
+    if username:
+        response.cache_control.public = True
     else:
-        svg = generate_svg_badge("Error", "Invalid Type", "#f00")
-    
-    return svg, 200, {'Content-Type': 'image/svg+xml'}
+        response.cache_control.private = True
+    return response.make_conditional(request)
 
 @app.route('/api/custom', methods=['GET', 'POST', 'PUT', 'DELETE'])
 @login_required
@@ -1256,6 +4667,10 @@ def api_custom_endpoints():
         query = data['query'].strip().upper()
         if data['method'] == 'GET' and not query.startswith('SELECT'):
             return jsonify({'success': False, 'error': 'GET endpoints can only use SELECT queries'})
+        try:
+            check_endpoint_cost(read_session().connection(), compile_endpoint_query(data['query']), data['query'])
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)})
         
         existing = db.session.query(CustomEndpoint).filter_by(
             user_id=current_user.id,
@@ -1286,6 +4701,11 @@ def api_custom_endpoints():
                 query = data['query'].strip().upper()
                 if endpoint.method == 'GET' and not query.startswith('SELECT'):
                     return jsonify({'success': False, 'error': 'GET endpoints can only use SELECT queries'})
+                try:
+                    check_endpoint_cost(read_session().connection(), compile_endpoint_query(data['query']),
+                                        data['query'])
+                except ValueError as e:
+                    return jsonify({'success': False, 'error': str(e)})
             
             endpoint.name = data['name']
             endpoint.path = data['path']
@@ -1295,6 +4715,7 @@ def api_custom_endpoints():
             endpoint.is_active = data.get('is_active', True)
             endpoint.is_public = data.get('is_public', False)
             db.session.commit()
+            endpoint_cache.invalidate(current_user.id)
             return jsonify({'success': True})
         return jsonify({'success': False, 'error': 'Endpoint not found'})
     
@@ -1304,17 +4725,18 @@ def api_custom_endpoints():
         if endpoint and endpoint.user_id == current_user.id:
             db.session.delete(endpoint)
             db.session.commit()
+            endpoint_cache.invalidate(current_user.id)
             return jsonify({'success': True})
         return jsonify({'success': False, 'error': 'Endpoint not found'})
 
 @app.route('/api/custom/<username>/<path:custom_path>')
 def execute_custom_endpoint(username, custom_path):
     """Execute custom API endpoints"""
-    user = db.session.query(User).filter_by(username=username).first()
+    user = read_session().query(User).filter_by(username=username).first()
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
-    endpoint = db.session.query(CustomEndpoint).filter_by(
+    endpoint = read_session().query(CustomEndpoint).filter_by(
         user_id=user.id,
         path=custom_path,
         is_active=True
@@ -1327,55 +4749,54 @@ def execute_custom_endpoint(username, custom_path):
     if not endpoint.is_public and (not current_user.is_authenticated or current_user.id != user.id):
         return jsonify({'error': 'Unauthorized'}), 401
     
+    if endpoint.method != 'GET':
+        return jsonify({'error': 'Method not supported yet'}), 400
+    if not endpoint.query.strip().upper().startswith('SELECT'):
+        return jsonify({'error': 'Only SELECT queries allowed for GET endpoints'}), 400
+    
     try:
-        query = endpoint.query
-        
-        # Replace placeholders
-        for key, value in request.args.items():
-            query = query.replace(f'{{{{{key}}}}}', str(value))
+        compiled = compile_endpoint_query(endpoint.query)
+        params = compiled.bind(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    ndjson = (request.args.get('format') == 'ndjson'
+              or request.accept_mimetypes.best == 'application/x-ndjson')
+    mimetype = 'application/x-ndjson' if ndjson else 'application/json'
+    
+    key = (user.id, endpoint.id, ndjson, tuple(sorted(params.items())))
+    cached = endpoint_cache.get(key)
+    if cached is None:
+        generation = endpoint_cache.generation(user.id)
+        rows = run_endpoint_query(read_session().connection(), compiled, params)
+        try:
+            first = list(itertools.islice(rows, app.config['ENDPOINT_STREAM_ROWS'] + 1))
+        except SQLAlchemyError as e:
+            rows.close()
+            read_session().rollback()
+            return jsonify({'error': str(getattr(e, 'orig', e))}), 500
         
-        if endpoint.method == 'GET':
-            if query.strip().upper().startswith('SELECT'):
-                from sqlalchemy import text
-                sql_text = text(query)
-                
-                result = db.session.execute(sql_text)
-                rows = result.fetchall()
-                
-                columns = result.keys()
-                data = [dict(zip(columns, row)) for row in rows]
-                
-                return jsonify(data)
-            else:
-                return jsonify({'error': 'Only SELECT queries allowed for GET endpoints'}), 400
-        else:
-            return jsonify({'error': 'Method not supported yet'}), 400
-            
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        if len(first) > app.config['ENDPOINT_STREAM_ROWS']:
+            return Response(stream_with_context(stream_endpoint_rows(first, rows, ndjson)), mimetype=mimetype)
+        cached = endpoint_cache.put(key, serialize_endpoint_rows(first, ndjson).encode('utf-8'), generation)
+    body, etag = cached
+    
+    response = Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 @app.route('/<username>')
 def public_profile(username):
     """Public profile page similar to WakaTime"""
-    user = db.session.query(User).filter_by(username=username).first()
+    user = read_session().query(User).filter_by(username=username).first()
     if not user:
         flash('User not found', 'error')
         return redirect(url_for('index'))
     
-    # Get statistics for the last 30 days
+    # Current statistics, with activity over the last 30 days
     start_date = datetime.utcnow().date() - timedelta(days=30)
     
-    stats_query = db.session.query(
-        Statistics.language,
-        db.func.sum(Statistics.files).label('files'),
-        db.func.sum(Statistics.total_lines).label('total_lines'),
-        db.func.sum(Statistics.code_lines).label('code_lines'),
-        db.func.sum(Statistics.comment_lines).label('comment_lines'),
-        db.func.sum(Statistics.empty_lines).label('empty_lines')
-    ).filter(
-        Statistics.user_id == user.id,
-        Statistics.date >= start_date
-    ).group_by(Statistics.language).all()
+    stats_query = current_statistics(read_session(), user.id)
     
     stats_data = []
     for row in stats_query:
@@ -1389,7 +4810,7 @@ def public_profile(username):
         })
     
     # Get daily activity for charts
-    activity_query = db.session.query(DailyActivity).filter(
+    activity_query = read_session().query(DailyActivity).filter(
         DailyActivity.user_id == user.id,
         DailyActivity.date >= start_date
     ).order_by(DailyActivity.date).all()
@@ -1438,7 +4859,7 @@ def public_profile(username):
 # Initialize database
 def init_app():
     with app.app_context():
-        db.create_all()
+        migrate_database()
 
 if __name__ == '__main__':
     init_app()
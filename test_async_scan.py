@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Async scan checks against a local stub of the GitHub and GitLab REST APIs:
+repository listing, head lookup, tree, blobs, and the 304 on an unchanged head
+"""
+
+import asyncio
+import hashlib
+import socket
+import threading
+
+import pytest
+from aiohttp import web
+
+import main
+from main import Account, Repository, run_async_scan
+
+HEAD = 'c0ffee' * 6 + 'c0ff'
+ETAG = f'"{HEAD}"'
+FILES = {
+    'app.py': b'import os\n\n# entry point\nprint(os.getcwd())\n',
+    'lib/util.py': b'VALUE = 1\n',
+    'README.md': b'# Demo\n',
+    'node_modules/dep/index.js': b'module.exports = 1\n',
+}
+
+def blob_id(content):
+    return hashlib.sha1(content).hexdigest()
+
+BLOBS = {blob_id(content): content for content in FILES.values()}
+
+class StubForge:
+    """GitHub and GitLab APIs on a local port, each with one repository named demo"""
+
+    def __init__(self):
+        self.requests = []  # (path, status)
+        app = web.Application(middlewares=[self.record])
+        app.router.add_get('/user/repos', self.github_repos)
+        app.router.add_get('/repos/octocat/demo/commits/{branch}', self.github_head)
+        app.router.add_get('/repos/octocat/demo/git/trees/{sha}', self.github_tree)
+        app.router.add_get('/repos/octocat/demo/git/blobs/{sha}', self.blob)
+        app.router.add_get('/api/v4/projects', self.gitlab_projects)
+        app.router.add_get('/api/v4/projects/7/repository/branches/{branch}', self.gitlab_head)
+        app.router.add_get('/api/v4/projects/7/repository/tree', self.gitlab_tree)
+        app.router.add_get('/api/v4/projects/7/repository/blobs/{sha}/raw', self.blob)
+        self.runner = web.AppRunner(app)
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.url = 'http://127.0.0.1:%d' % self.socket.getsockname()[1]
+        self.loop = asyncio.new_event_loop()
+
+    def start(self):
+        self.loop.run_until_complete(self.runner.setup())
+        self.loop.run_until_complete(web.SockSite(self.runner, self.socket).start())
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    @web.middleware
+    async def record(self, request, handler):
+        response = await handler(request)
+        self.requests.append((request.path, response.status))
+        return response
+
+    def head_response(self, request, body, content_type):
+        if request.headers.get('If-None-Match') == ETAG:
+            return web.Response(status=304, headers={'ETag': ETAG})
+        return web.Response(body=body, content_type=content_type, headers={'ETag': ETAG})
+
+    async def github_repos(self, request):
+        if request.query.get('page') == '2':
+            return web.json_response([])
+        repo = {'id': 42, 'name': 'demo', 'full_name': 'octocat/demo', 'private': False, 'default_branch': 'main'}
+        return web.json_response([repo], headers={'Link': f'<{self.url}/user/repos?page=2>; rel="next"'})
+
+    async def github_head(self, request):
+        assert request.headers['Accept'] == 'application/vnd.github.sha'
+        return self.head_response(request, HEAD.encode('ascii'), 'text/plain')
+
+    async def github_tree(self, request):
+        assert request.match_info['sha'] == HEAD
+        tree = [{'path': path, 'sha': blob_id(content), 'size': len(content), 'type': 'blob'}
+                for path, content in FILES.items()]
+        return web.json_response({'tree': tree + [{'path': 'lib', 'sha': 'd1', 'type': 'tree'}], 'truncated': False})
+
+    async def blob(self, request):
+        return web.Response(body=BLOBS[request.match_info['sha']])
+
+    async def gitlab_projects(self, request):
+        project = {'id': 7, 'name': 'demo', 'visibility': 'private', 'default_branch': 'main'}
+        return web.json_response([project], headers={'X-Next-Page': ''})
+
+    async def gitlab_head(self, request):
+        return self.head_response(request, b'{"commit": {"id": "%s"}}' % HEAD.encode('ascii'), 'application/json')
+
+    async def gitlab_tree(self, request):
+        assert request.query['ref'] == HEAD
+        items = [{'path': path, 'id': blob_id(content), 'type': 'blob'} for path, content in FILES.items()]
+        return web.json_response(items, headers={'X-Next-Page': ''})
+
+@pytest.fixture(scope='module')
+def forge():
+    forge = StubForge()
+    forge.start()
+    yield forge
+    forge.stop()
+
+@pytest.mark.parametrize('platform, listing, head', [
+    ('github', ['/user/repos', '/user/repos'], '/repos/octocat/demo/commits/main'),
+    ('gitlab', ['/api/v4/projects'], '/api/v4/projects/7/repository/branches/main'),
+])
+def test_scan_and_unchanged_head(forge, database, user, platform, listing, head):
+    account = Account(user_id=user.id, platform=platform, username='octocat', access_token='token',
+                      base_url=forge.url)
+    database.session.add(account)
+    database.session.commit()
+    forge.requests.clear()
+
+    stats = run_async_scan(account)
+    assert stats['PYTHON']['files'] == 2
+    assert stats['PYTHON']['code'] == 3
+    assert stats['PYTHON']['comment'] == 1
+    assert stats['MARKDOWN']['files'] == 1
+    assert 'JAVASCRIPT' not in stats
+    blobs = [path for path, status in forge.requests if '/blobs/' in path]
+    assert len(blobs) == 3 and all(status == 200 for _, status in forge.requests)
+    repo = database.session.scalars(database.select(Repository).filter_by(account_id=account.id)).one()
+    assert (repo.repo_hash, repo.head_etag) == (HEAD, ETAG)
+
+    # The head has not moved: the conditional lookup gets a 304 and nothing else is fetched
+    forge.requests.clear()
+    assert run_async_scan(account) == stats
+    assert forge.requests == [(path, 200) for path in listing] + [(head, 304)]
+
+def test_counting_runs_off_the_event_loop(forge, database, user, monkeypatch):
+    # COUNT_WORKERS=0 in the tests, so there is no counting pool
+    assert main.counting_pool() is None
+    count_raw_content = main.count_raw_content
+    on_loop = []
+
+    def count(raw_content, language):
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError:
+            on_loop.append(False)
+        return count_raw_content(raw_content, language)
+
+    monkeypatch.setattr(main, 'count_raw_content', count)
+    account = Account(user_id=user.id, platform='github', username='octocat', access_token='token',
+                      base_url=forge.url)
+    database.session.add(account)
+    database.session.commit()
+
+    assert run_async_scan(account)['PYTHON']['files'] == 2
+    assert on_loop == [False, False, False]
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Badge and response cache checks: badges carry ETags and answer 304 while the
+statistics are unchanged, and a sync invalidates what was cached before it
+"""
+
+import pytest
+
+import main
+from main import Account, CurrentStatistics, ResponseCache, save_statistics
+
+def python_stats(code):
+    return {'PYTHON': {'files': 1, 'total': code + 2, 'code': code, 'comment': 1, 'empty': 1}}
+
+@pytest.fixture
+def account(user, database):
+    account = Account(user_id=user.id, platform='github', username='octocat', access_token='token')
+    database.session.add(account)
+    database.session.commit()
+    save_statistics(user.id, account.id, python_stats(1200))
+    return account
+
+def test_badge_etag_and_304(client, account):
+    response = client.get('/api/badge/code_lines?user=octocat')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/svg+xml'
+    assert '1.2k' in response.get_data(as_text=True)
+    assert response.cache_control.public and response.cache_control.max_age == main.app.config['BADGE_MAX_AGE']
+    etag = response.headers['ETag']
+
+    response = client.get('/api/badge/code_lines?user=octocat', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+
+    # Another badge of the same user is a different entry with its own ETag
+    other = client.get('/api/badge/files?user=octocat')
+    assert other.status_code == 200 and other.headers['ETag'] != etag
+
+def test_sync_invalidates_badges(client, database, user, account):
+    etag = client.get('/api/badge/code_lines?user=octocat').headers['ETag']
+
+    # Without an invalidation the cached badge is served, even if the rows change
+    database.session.execute(database.update(CurrentStatistics).values(code_lines=5))
+    database.session.commit()
+    response = client.get('/api/badge/code_lines?user=octocat', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    save_statistics(user.id, account.id, python_stats(3400))
+    response = client.get('/api/badge/code_lines?user=octocat', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert '3.4k' in response.get_data(as_text=True)
+    assert response.headers['ETag'] != etag
+
+def test_own_badge_is_private(client, user, account):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    response = client.get('/api/badge/code_lines')
+    assert response.cache_control.private and not response.cache_control.public
+    assert '1.2k' in response.get_data(as_text=True)
+
+def test_response_cache_drops_stale_and_old_entries(monkeypatch):
+    cache = ResponseCache(max_bytes=10, ttl=60)
+    generation = cache.generation(1)
+    body, etag = cache.put((1, 'a'), b'12345', generation)
+    assert cache.get((1, 'a')) == (body, etag)
+
+    # A body built before an invalidation is returned but not stored
+    cache.invalidate(1)
+    assert cache.get((1, 'a')) is None
+    cache.put((1, 'a'), b'12345', generation)
+    assert cache.get((1, 'a')) is None
+
+    # Least recently used entries go once max_bytes is exceeded
+    generation = cache.generation(1)
+    cache.put((1, 'a'), b'12345', generation)
+    cache.put((1, 'b'), b'12345', generation)
+    cache.get((1, 'a'))
+    cache.put((2, 'c'), b'123', cache.generation(2))
+    assert cache.get((1, 'b')) is None
+    assert cache.get((1, 'a')) is not None and cache.get((2, 'c')) is not None
+    assert cache.size == 8
+
+    # Invalidating one user leaves the others' entries alone
+    cache.invalidate(2)
+    assert cache.get((2, 'c')) is None and cache.get((1, 'a')) is not None
+
+    clock = main.time.monotonic() + 61
+    monkeypatch.setattr(main.time, 'monotonic', lambda: clock)
+    assert cache.get((1, 'a')) is None
+    assert cache.size == 0
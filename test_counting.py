@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Line counting checks: comment, string and docstring edge cases are
+classified per line, encodings are sniffed from a file's first bytes, the
+counts do not depend on how a file is chunked, and the counting pool
+batches files without mixing up their results
+"""
+
+import codecs
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from main import (SNIFF_BYTES, CountingPool, LineCounter, StreamingCount, count_lines_from_content,
+                  count_raw_content, language_registry, sniff_encoding)
+
+PYTHON = language_registry.by_name['Python']
+C = language_registry.by_name['C']
+JAVASCRIPT = language_registry.by_name['JavaScript']
+GO = language_registry.by_name['Go']
+
+def count(source, language):
+    return count_lines_from_content(source.encode('utf-8'), language)
+
+def count_chunked(source, language, chunk_size=1, window=16):
+    counter = LineCounter(language_registry.get_classifier(language))
+    counter.WINDOW = window
+    raw = source.encode('utf-8')
+    for start in range(0, len(raw), chunk_size):
+        counter.feed(raw[start:start + chunk_size])
+    return counter.finish()
+
+# (source, (total, code, comment, empty))
+PYTHON_CASES = [
+    # A closing triple quote on its own line is no docstring opener
+    ('QUERY = """\n'
+     'SELECT *\n'
+     '"""\n'
+     '\n'
+     'def f():\n'
+     '    """Docstring."""\n'
+     '    return 1\n'
+     '\n'
+     'def g():\n'
+     '    # note\n'
+     '    return 2\n', (12, 7, 2, 3)),
+    ('"""Module docstring\n'
+     '\n'
+     'spanning lines\n'
+     '"""\n'
+     'import os\n', (6, 1, 3, 2)),
+    ("def f():\n"
+     "    r'''Raw docstring\n"
+     "    with a backslash \\d\n"
+     "    '''\n"
+     "    pass\n", (6, 2, 3, 1)),
+    # Strings passed as arguments or assigned stay code
+    ('x = call(\n'
+     '    """argument"""\n'
+     ')\n'
+     'y = (\n'
+     '    """text"""\n'
+     ')\n', (7, 6, 0, 1)),
+    # Comment markers and triple quotes inside strings
+    ('s = "# not a comment"\n'
+     "t = \"'''\"\n"
+     'u = 1\n'
+     '# comment\n', (5, 3, 1, 1)),
+    ('x = 1  # trailing comment\n'
+     '    # indented comment\n', (3, 1, 1, 1)),
+]
+
+C_CASES = [
+    # A block comment opened after code
+    ('int x = 1; /* start\n'
+     'more\n'
+     'end */\n'
+     'int y;\n', (5, 2, 2, 1)),
+    ('char *s = "/* not a comment";\n'
+     'int z;\n', (3, 2, 0, 1)),
+    ("char c = '\"'; /* quote */\n"
+     'int z;\n', (3, 2, 0, 1)),
+    # A line comment hides a block opener
+    ('// a /* b\n'
+     'int z;\n', (3, 1, 1, 1)),
+    ('/* a */ int x;\n'
+     'int y; /* b */\n'
+     '/* c */ /* d */\n'
+     '/* e */ // f\n', (5, 2, 2, 1)),
+    ('/*\n'
+     ' * doc\n'
+     '\n'
+     ' */\n'
+     'int x; // trailing\n', (6, 1, 3, 2)),
+    # An unclosed comment runs to the end of the file
+    ('int x;\n'
+     '/* open\n'
+     'int y;\n', (4, 1, 2, 1)),
+    ('printf("%s\\" // not a comment", s);\n', (2, 1, 0, 1)),
+]
+
+# Backquoted strings span lines and hide the comment markers in them
+BACKTICK_CASES = [
+    (JAVASCRIPT, 'const q = `\n'
+                 '/* not a comment\n'
+                 '`;\n'
+                 'let x = 1;\n', (5, 4, 0, 1)),
+    (JAVASCRIPT, 'const t = `a ${b} \\`\n'
+                 '// text\n'
+                 'c`; // real\n'
+                 '/* real */\n', (5, 3, 1, 1)),
+    (JAVASCRIPT, 'let s = "`"; /* one\n'
+                 'two */\n', (3, 1, 1, 1)),
+    # A backslash does not escape the closing quote of a Go raw string
+    (GO, 'var re = `C:\\`\n'
+         '/* real comment */\n', (3, 1, 1, 1)),
+    (GO, 'const s = `\n'
+         '// not a comment\n'
+         '`\n', (4, 3, 0, 1)),
+]
+
+def test_python_edge_cases():
+    for source, expected in PYTHON_CASES:
+        assert count(source, PYTHON) == expected, source
+
+def test_c_edge_cases():
+    for source, expected in C_CASES:
+        assert count(source, C) == expected, source
+
+def test_backquoted_strings():
+    for language, source, expected in BACKTICK_CASES:
+        assert count(source, language) == expected, source
+        for chunk_size in (1, 3, 64):
+            assert count_chunked(source, language, chunk_size) == expected, (source, chunk_size)
+
+def test_counts_do_not_depend_on_chunks():
+    for cases, language in ((PYTHON_CASES, PYTHON), (C_CASES, C)):
+        source = ''.join(source for source, _ in cases)
+        expected = count(source, language)
+        for chunk_size in (1, 3, 7, 64):
+            assert count_chunked(source, language, chunk_size) == expected, chunk_size
+
+def test_sniff_encoding():
+    assert sniff_encoding(codecs.BOM_UTF8 + b'x = 1') == 'utf-8-sig'
+    assert sniff_encoding(codecs.BOM_UTF16_LE + 'x'.encode('utf-16-le')) == 'utf-16'
+    assert sniff_encoding(codecs.BOM_UTF16_BE + 'x'.encode('utf-16-be')) == 'utf-16'
+    # The UTF-32 LE mark starts with the UTF-16 LE one
+    assert sniff_encoding(codecs.BOM_UTF32_LE + 'x'.encode('utf-32-le')) == 'utf-32'
+    assert sniff_encoding(b'x = 1\n') == 'utf-8'
+    assert sniff_encoding('s = "caf\u00e9"'.encode('utf-8')) == 'utf-8'
+    # A character cut off by the end of the sample is still UTF-8
+    assert sniff_encoding('s = "\u20ac"'.encode('utf-8')[:-2]) == 'utf-8'
+    assert sniff_encoding('s = "caf\u00e9"'.encode('latin-1')) == 'latin-1'
+    assert sniff_encoding(b'\x7fELF\x02\x01\x00\x00') is None
+    assert sniff_encoding(b'') == 'utf-8'
+
+def stream(raw, language, chunk_size):
+    counts = StreamingCount(language)
+    for start in range(0, len(raw), chunk_size):
+        counts.feed(raw[start:start + chunk_size])
+    return counts.finish()
+
+def test_streaming_count_matches_buffered_count():
+    source = ''.join(source for source, _ in PYTHON_CASES) + '# caf\u00e9 \u20ac\n' * (SNIFF_BYTES // 8)
+    expected = count_lines_from_content(source, PYTHON)
+    for encoding in ('utf-8', 'utf-8-sig', 'utf-16', 'utf-32', 'latin-1'):
+        raw = source.encode(encoding, errors='replace')
+        for chunk_size in (1, 5, 4096, len(raw)):
+            assert stream(raw, PYTHON, chunk_size) == expected, (encoding, chunk_size)
+        assert count_raw_content(raw, PYTHON) == expected, encoding
+
+def test_binary_and_empty_files_are_not_counted():
+    text = b'x = 1\n' * SNIFF_BYTES
+    assert count_raw_content(b'', PYTHON) is None
+    assert count_raw_content(b'\x89PNG\r\n\x1a\n\x00\x00', PYTHON) is None
+    # A NUL past the sniffed prefix still marks the file binary, in any chunk
+    for chunk_size in (SNIFF_BYTES, 1000, len(text) + 3):
+        assert stream(text + b'\x00\x00\x01', PYTHON, chunk_size) is None
+    assert stream(text, PYTHON, 1000) == (SNIFF_BYTES + 1, SNIFF_BYTES, 0, 1)
+
+class RecordingPool(CountingPool):
+    """CountingPool on a thread, recording the files of every batch it sends"""
+
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super().__init__(*args, **kwargs)
+
+    def _executor(self):
+        pool = self
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, func, items):
+                pool.batches.append([raw_content for raw_content, _ in items])
+                return super().submit(func, items)
+
+        return Executor(max_workers=1)
+
+FILES = [b'x = %d\n# note\n' % n for n in range(5)]
+
+def test_pool_batches_files():
+    pool = RecordingPool(1, batch_files=3, delay=60)
+    futures = [pool.submit(raw, PYTHON) for raw in FILES]
+    # A full batch goes at once; the rest waits for more files
+    assert pool.batches == [FILES[:3]]
+    assert [pool.result(future) for future in futures[:3]] == [count_raw_content(raw, PYTHON) for raw in FILES[:3]]
+    assert not futures[3].done()
+
+    # Waiting for a file sends its partial batch
+    assert pool.result(futures[4]) == count_raw_content(FILES[4], PYTHON)
+    assert pool.batches == [FILES[:3], FILES[3:]]
+    assert pool.result(futures[3]) == count_raw_content(FILES[3], PYTHON)
+    pool.shutdown()
+
+def test_pool_sends_batches_by_size_and_delay():
+    pool = RecordingPool(1, batch_files=100, batch_bytes=len(FILES[0]) * 2, delay=60)
+    for raw in FILES[:3]:
+        pool.submit(raw, PYTHON)
+    assert pool.batches == [FILES[:2]]
+    pool.shutdown()
+
+    pool = RecordingPool(1, batch_files=100, delay=0.05)
+    future = pool.submit(FILES[0], PYTHON)
+    deadline = time.monotonic() + 5
+    while not future.done() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert future.result() == count_raw_content(FILES[0], PYTHON)
+    assert pool.batches == [FILES[:1]]
+    pool.shutdown()
+
+def test_pool_shutdown_counts_pending_files():
+    pool = RecordingPool(1, batch_files=100, delay=60)
+    futures = [pool.submit(raw, PYTHON) for raw in FILES]
+    pool.shutdown()
+    assert [future.result(timeout=5) for future in futures] == [count_raw_content(raw, PYTHON) for raw in FILES]
+    assert pool.batches == [FILES]
+
+def test_pool_counts_on_worker_processes():
+    files = [(raw, PYTHON) for raw in FILES] + [(b'\x89PNG\r\n\x1a\n\x00', PYTHON), (b'int x; /* c */\n', C)]
+    pool = CountingPool(1, batch_files=3, delay=60)
+    try:
+        futures = [pool.submit(raw, language) for raw, language in files]
+        # Results come back in order, across batches, from threads waiting at once
+        results = [None] * len(futures)
+        threads = [threading.Thread(target=lambda i=i: results.__setitem__(i, pool.result(futures[i])))
+                   for i in reversed(range(len(futures)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [count_raw_content(raw, language) for raw, language in files]
+        assert results[5] is None
+    finally:
+        pool.shutdown()
+
+if __name__ == '__main__':
+    test_python_edge_cases()
+    test_c_edge_cases()
+    test_backquoted_strings()
+    test_counts_do_not_depend_on_chunks()
+    test_sniff_encoding()
+    test_streaming_count_matches_buffered_count()
+    test_binary_and_empty_files_are_not_counted()
+    test_pool_batches_files()
+    test_pool_sends_batches_by_size_and_delay()
+    test_pool_shutdown_counts_pending_files()
+    test_pool_counts_on_worker_processes()
+    print("✓ Counting checks passed")
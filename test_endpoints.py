@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Custom endpoint checks: parameters are typed and bound, also inside string
+literals, results are cached per typed parameter value, and queries are
+held to the cost, time and row limits
+"""
+
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from main import (app, CurrentStatistics, CustomEndpoint, EndpointQuery, check_endpoint_cost,
+                  compile_endpoint_query, invalidate_response_caches, run_endpoint_query, stream_endpoint_rows)
+
+LANGUAGES = {'PYTHON': 120, 'JAVASCRIPT': 80, 'C': 10}
+
+@pytest.fixture
+def statistics(user, database):
+    database.session.add_all(CurrentStatistics(user_id=user.id, language=language, code_lines=lines)
+                             for language, lines in LANGUAGES.items())
+    database.session.commit()
+
+def add_endpoint(database, user, query, path='langs'):
+    endpoint = CustomEndpoint(user_id=user.id, name=path, path=path, method='GET', query=query, is_public=True)
+    database.session.add(endpoint)
+    database.session.commit()
+    return endpoint
+
+def test_parameters_inside_string_literals():
+    query = EndpointQuery("SELECT 'a:b', '{{name}}', '%{{name}}%', 'it''s {{name}}{{count:int}}!' WHERE x = {{count:int}}")
+    assert query.statement.text == (r"SELECT 'a\:b', :name, '%' || :name || '%', "
+                                    r"'it''s ' || :name || :count || '!' WHERE x = :count")
+    assert query.params == {'name': 'str', 'count': 'int'}
+
+def test_parameter_types():
+    query = EndpointQuery("SELECT {{n:int}}, {{x:float}}, {{day:date}}, {{s}}")
+    values = query.bind({'n': '07', 'x': '1.5', 'day': '2024-01-31', 's': '07', 'unused': 'x'})
+    assert values == {'n': 7, 'x': 1.5, 'day': date(2024, 1, 31), 's': '07'}
+
+    with pytest.raises(ValueError, match="'n' must be int"):
+        query.bind({'n': 'seven', 'x': '1', 'day': '2024-01-01', 's': ''})
+    with pytest.raises(ValueError, match="Missing parameter 'x'"):
+        query.bind({'n': '1'})
+    with pytest.raises(ValueError, match="Unknown type"):
+        EndpointQuery("SELECT {{n:decimal}}")
+    with pytest.raises(ValueError, match="two types"):
+        EndpointQuery("SELECT {{n:int}}, '{{n}}'")
+
+def test_untyped_parameters_bind_numbers():
+    query = EndpointQuery("SELECT {{a}}, '{{a}}', {{b}}, '{{c}}', {{d:str}}, {{d}}")
+    assert query.params == {'a': 'auto', 'b': 'auto', 'c': 'str', 'd': 'str'}
+    values = query.bind({'a': '100', 'b': '-1.5', 'c': '100', 'd': '100'})
+    assert values == {'a': 100, 'b': -1.5, 'c': '100', 'd': '100'}
+    assert type(values['a']) is int and type(values['c']) is str
+    # Anything but a plain number stays text
+    for value in ('07', 'PYTHON', '1e3', '1_000', ' 1', 'nan', ''):
+        assert query.bind({'a': value, 'b': '0', 'c': '', 'd': ''})['a'] == value
+
+def test_untyped_parameter_compares_with_numbers(client, database, user, statistics):
+    add_endpoint(database, user, "SELECT language FROM current_statistics WHERE user_id = 1 "
+                                 "GROUP BY language HAVING SUM(code_lines) > {{min}} ORDER BY language")
+
+    assert client.get('/api/custom/octocat/langs?min=50').get_json() == [
+        {'language': 'JAVASCRIPT'}, {'language': 'PYTHON'}]
+    assert client.get('/api/custom/octocat/langs?min=100').get_json() == [{'language': 'PYTHON'}]
+
+def test_like_parameter(client, database, user, statistics):
+    add_endpoint(database, user, "SELECT language FROM current_statistics "
+                                 "WHERE user_id = 1 AND language LIKE '%{{part}}%' ORDER BY language")
+
+    assert client.get('/api/custom/octocat/langs?part=SCRIPT').get_json() == [{'language': 'JAVASCRIPT'}]
+    assert client.get('/api/custom/octocat/langs?part=%25').get_json() == [
+        {'language': language} for language in sorted(LANGUAGES)]
+    assert client.get('/api/custom/octocat/langs').status_code == 400
+
+def test_cache_key_uses_typed_values(client, database, user, statistics):
+    add_endpoint(database, user, "SELECT count(*) AS n FROM current_statistics "
+                                 "WHERE user_id = 1 AND code_lines >= {{min:int}}")
+
+    assert client.get('/api/custom/octocat/langs?min=50').get_json() == [{'n': 2}]
+    database.session.add(CurrentStatistics(user_id=user.id, language='GO', code_lines=60))
+    database.session.commit()
+
+    # 050 binds the same integer, so it is answered from the cache; other values are not
+    assert client.get('/api/custom/octocat/langs?min=050&other=1').get_json() == [{'n': 2}]
+    assert client.get('/api/custom/octocat/langs?min=60').get_json() == [{'n': 3}]
+    assert client.get('/api/custom/octocat/langs?min=5x').status_code == 400
+
+    invalidate_response_caches(user.id)
+    assert client.get('/api/custom/octocat/langs?min=50').get_json() == [{'n': 3}]
+
+def test_endpoint_etag_and_invalidation(client, database, user, statistics):
+    endpoint = add_endpoint(database, user, "SELECT language FROM current_statistics "
+                                            "WHERE user_id = 1 ORDER BY language")
+    response = client.get('/api/custom/octocat/langs')
+    etag = response.headers['ETag']
+    assert response.get_json() == [{'language': language} for language in sorted(LANGUAGES)]
+    assert client.get('/api/custom/octocat/langs', headers={'If-None-Match': etag}).status_code == 304
+
+    # Editing the endpoint drops the results cached from its old query
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    assert client.put('/api/custom', json={
+        'id': endpoint.id, 'name': 'langs', 'path': 'langs', 'method': 'GET', 'is_public': True,
+        'query': "SELECT language FROM current_statistics WHERE user_id = 1 AND language = 'C'"
+    }).get_json() == {'success': True}
+    response = client.get('/api/custom/octocat/langs', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.get_json() == [{'language': 'C'}]
+
+def test_cost_check_rejects_full_scans(client, database, user, statistics, monkeypatch):
+    monkeypatch.setitem(app.config, 'ENDPOINT_SCAN_MAX_ROWS', 2)
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+
+    def save(query, path):
+        return client.post('/api/custom', json={'name': path, 'path': path, 'method': 'GET', 'query': query}).get_json()
+
+    result = save("SELECT s.language FROM current_statistics AS s WHERE s.code_lines > 10", 'scan')
+    assert result['success'] is False
+    assert 'reads all of current_statistics' in result['error']
+    assert save("SELECT language FROM current_statistics WHERE user_id = {{user:int}}", 'seek')['success']
+    assert 'Invalid query' in save("SELECT nothing FROM nowhere", 'broken')['error']
+
+    # Small tables may be scanned
+    monkeypatch.setitem(app.config, 'ENDPOINT_SCAN_MAX_ROWS', 10)
+    query = "SELECT language FROM current_statistics WHERE code_lines > 10"
+    check_endpoint_cost(database.session.connection(), compile_endpoint_query(query), query)
+
+def test_timeout_interrupts_long_queries(database, monkeypatch):
+    monkeypatch.setitem(app.config, 'ENDPOINT_TIMEOUT', 0.2)
+    query = compile_endpoint_query("WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) "
+                                   "SELECT count(*) FROM n")
+    connection = database.session.connection()
+    with pytest.raises(OperationalError, match='interrupted'):
+        list(run_endpoint_query(connection, query, {}))
+    # The handler is removed afterwards, so later statements run normally
+    assert list(run_endpoint_query(connection, compile_endpoint_query("SELECT 1 AS one"), {})) == [{'one': 1}]
+
+def test_row_cap(client, database, user, statistics, monkeypatch):
+    monkeypatch.setitem(app.config, 'ENDPOINT_MAX_ROWS', 2)
+    add_endpoint(database, user, "SELECT language FROM current_statistics WHERE user_id = 1 ORDER BY language")
+    assert client.get('/api/custom/octocat/langs').get_json() == [{'language': 'C'}, {'language': 'JAVASCRIPT'}]
+
+@pytest.mark.parametrize('stream_rows', [1, 500])
+def test_json_and_ndjson_results(client, database, user, statistics, monkeypatch, stream_rows):
+    monkeypatch.setitem(app.config, 'ENDPOINT_STREAM_ROWS', stream_rows)
+    add_endpoint(database, user, "SELECT language, code_lines FROM current_statistics "
+                                 "WHERE user_id = 1 ORDER BY language")
+    expected = [{'language': language, 'code_lines': LANGUAGES[language]} for language in sorted(LANGUAGES)]
+
+    response = client.get('/api/custom/octocat/langs')
+    assert response.mimetype == 'application/json'
+    assert response.get_json() == expected
+
+    for query, headers in (('?format=ndjson', {}), ('', {'Accept': 'application/x-ndjson'})):
+        response = client.get('/api/custom/octocat/langs' + query, headers=headers)
+        assert response.mimetype == 'application/x-ndjson'
+        # Results past ENDPOINT_STREAM_ROWS are streamed, so they have no ETag and are not cached
+        assert ('ETag' in response.headers) == (stream_rows != 1)
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == expected
+
+def test_stream_ends_with_the_error_of_a_failing_row():
+    def rows():
+        yield {'n': 2}
+        raise OperationalError('SELECT', {}, Exception('interrupted'))
+
+    with app.app_context():
+        ndjson = ''.join(stream_endpoint_rows([{'n': 1}], rows(), True, batch_size=1))
+        array = ''.join(stream_endpoint_rows([{'n': 1}], rows(), False, batch_size=1))
+    assert [json.loads(line) for line in ndjson.splitlines()] == [{'n': 1}, {'n': 2}, {'error': 'interrupted'}]
+    assert json.loads(array) == [{'n': 1}, {'n': 2}, {'error': 'interrupted'}]
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Language lookup checks: the longest known suffix of a file name wins,
+well-known file names match without an extension, unknown files have no
+language, and classifying a tree listing matches looking up each path
+"""
+
+from main import LanguageRegistry, language_registry
+
+# Declarations come after TypeScript, so only the suffix length picks them for '.d.ts'
+REGISTRY = LanguageRegistry({
+    'typescript': {'name': 'TypeScript', 'extensions': ['.ts']},
+    'declarations': {'name': 'TypeScript Declarations', 'extensions': ['.d.ts']},
+    'make': {'name': 'Makefile', 'extensions': ['.mk'], 'filenames': ['Makefile']},
+})
+
+def name(registry, path):
+    language = registry.lookup(path)
+    return language and language['name']
+
+def test_longest_suffix_wins():
+    assert name(REGISTRY, 'src/index.ts') == 'TypeScript'
+    assert name(REGISTRY, 'types/index.d.ts') == 'TypeScript Declarations'
+    assert name(REGISTRY, 'lib/jquery.min.d.ts') == 'TypeScript Declarations'
+    assert name(REGISTRY, 'src/d.ts') == 'TypeScript'
+    assert name(REGISTRY, 'build/rules.mk') == 'Makefile'
+
+    assert name(language_registry, 'types/index.d.ts') == 'TypeScript'
+    assert name(language_registry, 'app/main.py') == 'Python'
+
+def test_file_names_without_extension():
+    for path in ('Makefile', 'src/Makefile', 'GNUmakefile'):
+        assert name(language_registry, path) == 'Makefile', path
+    for path in ('Dockerfile', 'docker/Dockerfile', 'Containerfile'):
+        assert name(language_registry, path) == 'Dockerfile', path
+    # Only the base name is matched, never a directory
+    assert name(language_registry, 'Makefile/notes') is None
+    assert name(REGISTRY, 'GNUmakefile') is None
+
+def test_unknown_files_have_no_language():
+    for path in ('notes.unknownext', 'README', 'LICENSE', 'src.py/README', 'archive.tar.gz', '.gitignore',
+                 'index.ts.orig', 'trailing.'):
+        assert language_registry.lookup(path) is None, path
+
+def test_classify_paths_matches_lookup():
+    paths = ['src/Makefile', 'README', 'docs/guide.unknownext', 'types/index.d.ts']
+    for language in language_registry.languages.values():
+        paths += [f'src/file{extension}' for extension in language.get('extensions', [])]
+        paths += [f'pkg/{filename}' for filename in language.get('filenames', [])]
+
+    classified = language_registry.classify_paths(paths)
+    assert classified == {path: language_registry.lookup(path) for path in paths
+                          if language_registry.lookup(path)}
+    assert 'README' not in classified and 'src/Makefile' in classified
+    assert REGISTRY.classify_paths(['a.d.ts', 'b.ts', 'c.txt']) == {
+        'a.d.ts': REGISTRY.by_name['TypeScript Declarations'], 'b.ts': REGISTRY.by_name['TypeScript']}
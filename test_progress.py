@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Progress checks: stores implement the ProgressStore interface, and the
+progress stream can be switched off in favour of polling
+"""
+
+import pytest
+
+from main import app, MemoryProgressStore, ProgressStore
+
+def test_progress_store_is_abstract():
+    with pytest.raises(TypeError):
+        ProgressStore()
+
+    class Incomplete(ProgressStore):
+        def save(self, user_id, key, record):
+            pass
+    with pytest.raises(TypeError):
+        Incomplete()
+
+    store = MemoryProgressStore()
+    store.save(1, 'summary', {'status': 'Ready'})
+    assert store.load(1) == {'summary': {'status': 'Ready'}}
+
+def test_progress_stream_can_be_disabled(client, user, monkeypatch):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+
+    monkeypatch.setitem(app.config, 'PROGRESS_STREAM', False)
+    assert client.get('/api/scanning_progress/stream').status_code == 204
+    assert client.get('/api/scanning_progress').get_json()['status'] == 'Ready'
+
+    monkeypatch.setitem(app.config, 'PROGRESS_STREAM', True)
+    monkeypatch.setitem(app.config, 'PROGRESS_STREAM_TIMEOUT', 0)
+    response = client.get('/api/scanning_progress/stream')
+    assert response.mimetype == 'text/event-stream'
+    assert response.get_data(as_text=True) == 'retry: 3000\n\n'
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Rate limit checks: request pacing and retry backoff from quota headers, and
+scan jobs that record the repositories deferred to the next sync
+"""
+
+import time
+
+import pytest
+
+import main
+from main import (app, Account, RateLimitDeferred, RateLimiter, ScanJob, current_progress, progress_store,
+                  run_scan_job)
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_MAX_WAIT', 120)
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_RESERVE', 0.1)
+    monkeypatch.setitem(app.config, 'RATE_LIMIT_RETRIES', 3)
+
+def quota(remaining, limit=5000, reset_in=60):
+    return {'X-RateLimit-Remaining': str(remaining), 'X-RateLimit-Limit': str(limit),
+            'X-RateLimit-Reset': str(int(time.time() + reset_in))}
+
+def test_reserve_is_free_above_the_reserve():
+    limiter = RateLimiter('api.github.com')
+    assert limiter.reserve() == 0
+    limiter.update(quota(4000))
+    assert limiter.reserve() == 0
+    assert limiter.reserve() == 0
+    assert limiter.remaining == 3998
+
+def test_reserve_spaces_requests_below_the_reserve():
+    limiter = RateLimiter('api.github.com')
+    limiter.update(quota(99, reset_in=100))
+    assert limiter.reserve() == 0
+    # The other 98 requests are spread over the 100 s left in the window
+    assert limiter.reserve() == pytest.approx(100 / 99, abs=0.05)
+    assert limiter.reserve() == pytest.approx(100 / 99 + 100 / 98, abs=0.05)
+
+def test_reserve_waits_for_reset_or_defers():
+    limiter = RateLimiter('api.github.com')
+    limiter.update(quota(0, reset_in=30))
+    assert limiter.reserve() == pytest.approx(30, abs=1.5)
+
+    limiter.update(quota(0, reset_in=3600))
+    with pytest.raises(RateLimitDeferred):
+        limiter.reserve()
+
+def test_retry_after_blocks_every_request():
+    limiter = RateLimiter('gitlab.com')
+    limiter.update({'Retry-After': '20'})
+    assert limiter.reserve() == pytest.approx(20, abs=0.5)
+    assert limiter.reserve() == pytest.approx(20, abs=0.5)
+
+def test_retry_delay():
+    limiter = RateLimiter('api.github.com')
+    assert limiter.retry_delay(404, {}, 0) is None
+    assert limiter.retry_delay(403, {}, 0) is None
+    assert 1 <= limiter.retry_delay(502, {}, 0) <= 1.5
+    assert 4 <= limiter.retry_delay(None, {}, 2) <= 6
+    assert limiter.retry_delay(502, {}, 3) is None
+
+    # Rate-limit responses wait for the reset and are deferred once out of retries or time
+    assert 30 <= limiter.retry_delay(403, quota(0, reset_in=30), 0) <= 46
+    assert 10 <= limiter.retry_delay(429, {'Retry-After': '10'}, 0) <= 15
+    with pytest.raises(RateLimitDeferred):
+        limiter.retry_delay(429, {}, 3)
+    with pytest.raises(RateLimitDeferred):
+        limiter.retry_delay(403, quota(0, reset_in=3600), 0)
+
+@pytest.mark.parametrize('deferred, status', [([], 'done'), (['demo', 'docs'], 'deferred')])
+def test_scan_job_records_deferred_repositories(database, user, monkeypatch, deferred, status):
+    account = Account(user_id=user.id, platform='github', username='octocat', access_token='token')
+    database.session.add(account)
+    database.session.commit()
+    job = ScanJob(user_id=user.id, account_id=account.id, status='running', attempts=1)
+    database.session.add(job)
+    database.session.commit()
+
+    def analyze_account(account_id, user_id, force=False, checkpoint=None):
+        for name in deferred:
+            current_progress.get().defer(name)
+    monkeypatch.setattr(main, 'analyze_account', analyze_account)
+
+    run_scan_job(job)
+    database.session.refresh(job)
+    assert job.status == status
+    record = progress_store.load(user.id)[f'job-{job.id}']
+    assert record['state'] == status
+    assert record['deferred_repos'] == deferred
+    if deferred:
+        assert job.error == '2 repositories deferred to the next sync: demo, docs'
+    else:
+        assert job.error is None
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Scan queue checks: requests for an account merge into its active job,
+workers claim manual jobs before scheduled ones and never the same job
+twice, and a retried or abandoned job resumes where it stopped
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import main
+from main import (app, Account, ScanJob, ScanJobRepository, SCAN_PRIORITY_MANUAL, SCAN_PRIORITY_SCHEDULED,
+                  claim_scan_job, enqueue_scan, heartbeat_scan_jobs, requeue_stale_scan_jobs, run_scan_job)
+
+@pytest.fixture
+def accounts(user, database, monkeypatch):
+    # Tests claim and run jobs themselves; worker threads would outlive the database
+    monkeypatch.setattr(main.scan_workers, 'start', lambda: None)
+    accounts = [Account(user_id=user.id, platform='github', username=name, access_token='token')
+                for name in ('octocat', 'hubot', 'monalisa')]
+    database.session.add_all(accounts)
+    database.session.commit()
+    return accounts
+
+def test_enqueue_merges_into_the_active_job(accounts, database):
+    account = accounts[0]
+    job = enqueue_scan(account, priority=SCAN_PRIORITY_SCHEDULED)
+    assert (job.priority, job.force) == (SCAN_PRIORITY_SCHEDULED, False)
+
+    # A manual forced request makes the queued job more urgent and forced
+    assert enqueue_scan(account, force=True, priority=SCAN_PRIORITY_MANUAL).id == job.id
+    database.session.refresh(job)
+    assert (job.priority, job.force) == (SCAN_PRIORITY_MANUAL, True)
+
+    # A later scheduled request takes nothing away
+    enqueue_scan(account, priority=SCAN_PRIORITY_SCHEDULED)
+    database.session.refresh(job)
+    assert (job.priority, job.force) == (SCAN_PRIORITY_MANUAL, True)
+    assert database.session.query(ScanJob).count() == 1
+
+    # A running job is left alone, and a finished one no longer holds the account
+    other = enqueue_scan(accounts[1], priority=SCAN_PRIORITY_SCHEDULED)
+    assert claim_scan_job().id == job.id
+    enqueue_scan(accounts[1], force=True)
+    assert enqueue_scan(account, force=True).id == job.id
+    database.session.refresh(other)
+    assert other.force
+    job.status = 'done'
+    database.session.commit()
+    assert enqueue_scan(account).id != job.id
+
+def test_manual_jobs_are_claimed_first(accounts, database, monkeypatch):
+    # All accounts share a host; the per-host cap is not under test here
+    monkeypatch.setitem(app.config, 'SCAN_ACCOUNTS_PER_HOST', 0)
+    scheduled = [enqueue_scan(account, priority=SCAN_PRIORITY_SCHEDULED) for account in accounts[:2]]
+    manual = enqueue_scan(accounts[2])
+
+    claimed = [claim_scan_job() for _ in range(3)]
+    assert [job.id for job in claimed] == [manual.id, scheduled[0].id, scheduled[1].id]
+    assert all(job.status == 'running' and job.attempts == 1 and job.heartbeat_at for job in claimed)
+    assert claim_scan_job() is None
+
+def test_claim_skips_a_job_another_worker_took(accounts, database, monkeypatch):
+    first, second = (enqueue_scan(account) for account in accounts[:2])
+    execute = database.session.execute
+    raced = []
+
+    def claim_first_elsewhere(statement, *args, **kwargs):
+        # Another worker claims the job between the select and the update
+        if getattr(statement, 'is_update', False) and not raced:
+            raced.append(True)
+            execute(database.update(ScanJob).filter_by(id=first.id).values(status='running'))
+        return execute(statement, *args, **kwargs)
+
+    monkeypatch.setattr(database.session, 'execute', claim_first_elsewhere)
+    assert claim_scan_job().id == second.id
+    database.session.refresh(first)
+    assert first.attempts == 0
+
+def test_retried_job_resumes_after_finished_repositories(accounts, database, monkeypatch):
+    account = accounts[0]
+    seen = []
+
+    def analyze_account(account_id, user_id, force=False, checkpoint=None):
+        seen.append(set(checkpoint.done))
+        if len(seen) == 1:
+            checkpoint.mark({'id': 1, 'name': 'one'})
+            raise ConnectionError('connection reset')
+        assert checkpoint.cached(account, {'id': 1, 'name': 'one'}) is not None
+        assert checkpoint.cached(account, {'id': 2, 'name': 'two'}) is None
+        checkpoint.mark({'id': 2, 'name': 'two'})
+
+    monkeypatch.setattr(main, 'analyze_account', analyze_account)
+    job = enqueue_scan(account)
+    run_scan_job(claim_scan_job())
+    database.session.refresh(job)
+    assert (job.status, job.error, job.attempts) == ('queued', 'connection reset', 1)
+
+    run_scan_job(claim_scan_job())
+    database.session.refresh(job)
+    assert seen == [set(), {'1'}]
+    assert (job.status, job.attempts) == ('done', 2)
+    # The finished job no longer needs its checkpoint
+    assert database.session.query(ScanJobRepository).count() == 0
+
+def test_retries_stop_after_max_attempts(accounts, database, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCAN_JOB_MAX_ATTEMPTS', 2)
+
+    def analyze_account(account_id, user_id, force=False, checkpoint=None):
+        raise ConnectionError('connection reset')
+
+    monkeypatch.setattr(main, 'analyze_account', analyze_account)
+    job = enqueue_scan(accounts[0])
+    run_scan_job(claim_scan_job())
+    run_scan_job(claim_scan_job())
+    database.session.refresh(job)
+    assert (job.status, job.attempts) == ('failed', 2)
+    assert claim_scan_job() is None
+
+def test_jobs_without_heartbeat_are_requeued(accounts, database):
+    stale, alive = (enqueue_scan(account) for account in accounts[:2])
+    claim_scan_job()
+    claim_scan_job()
+    missed = datetime.utcnow() - timedelta(seconds=app.config['SCAN_JOB_STALE_AFTER'] + 1)
+    database.session.execute(database.update(ScanJob).values(heartbeat_at=missed))
+    database.session.commit()
+
+    # The process running alive is still heartbeating
+    heartbeat_scan_jobs([alive.id])
+    assert requeue_stale_scan_jobs() == 1
+    database.session.refresh(stale)
+    database.session.refresh(alive)
+    assert (stale.status, alive.status) == ('queued', 'running')
+
+    # The requeued job is claimed again as its next attempt
+    assert claim_scan_job().id == stale.id
+    database.session.refresh(stale)
+    assert stale.attempts == 2
+    assert requeue_stale_scan_jobs() == 0
+
+def test_per_host_cap(accounts, database, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCAN_ACCOUNTS_PER_HOST', 2)
+    gitlab = Account(user_id=accounts[0].user_id, platform='gitlab', username='octocat', access_token='token')
+    database.session.add(gitlab)
+    database.session.commit()
+    github_jobs = [enqueue_scan(account) for account in accounts]
+    gitlab_job = enqueue_scan(gitlab, priority=SCAN_PRIORITY_SCHEDULED)
+
+    # Two GitHub accounts run at once; the third waits while a GitLab account goes ahead
+    assert [claim_scan_job().id for _ in range(3)] == [github_jobs[0].id, github_jobs[1].id, gitlab_job.id]
+    assert claim_scan_job() is None
+
+    github_jobs[0].status = 'done'
+    database.session.commit()
+    assert claim_scan_job().id == github_jobs[2].id
+
+def test_running_jobs_without_host_do_not_block_the_queue(accounts, database, monkeypatch):
+    monkeypatch.setitem(app.config, 'SCAN_ACCOUNTS_PER_HOST', 1)
+    legacy = [enqueue_scan(account) for account in accounts[:2]]
+    database.session.execute(database.update(ScanJob).where(ScanJob.id.in_([job.id for job in legacy]))
+                             .values(status='running', host=None))
+    database.session.commit()
+    job = enqueue_scan(accounts[2])
+    assert claim_scan_job().id == job.id
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Scan checks: vendored and excluded paths are skipped before download,
+files that fail to download keep the repository's head from moving, so
+they are fetched again on the next sync, and incremental scans apply
+renames, deletions and files that stopped counting to the cache and its
+language rollups, falling back to a full scan when the history changed. The file cache
+writes its rows in batches and keeps the language rollups equal to them
+"""
+
+import hashlib
+import re
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import event
+
+import main
+from main import (app, Account, FetchPipeline, FileCache, FileCacheStore, FileChange, FileJob, PathFilter,
+                  Repository, RepositoryLanguageStats, ScanIncomplete, add_file_stats, analyze_gitlab_repo, cached_repo_stats, count_raw_content,
+                  exclude_path_globs, fetch_github_blob, github_compare_changes, gitlab_compare_changes,
+                  glob_to_regex, language_registry, scan_changes)
+
+FILES = {
+    'app.py': b'import os\n\nprint(os.getcwd())\n',
+    'lib.py': b'# helper\nVALUE = 1\n',
+}
+
+def blob_id(content):
+    return hashlib.sha1(content).hexdigest()
+
+class FakeProject:
+    """python-gitlab Project serving FILES; blobs in failing raise like a dropped connection"""
+
+    def __init__(self, failing=(), merge_base=None, diffs=()):
+        self.failing = set(failing)
+        self.merge_base = merge_base
+        self.diffs = list(diffs)
+        self.trees = 0
+
+    def repository_tree(self, recursive=False, all=False):
+        self.trees += 1
+        return [{'path': path, 'id': blob_id(content), 'type': 'blob'} for path, content in FILES.items()]
+
+    def repository_merge_base(self, refs):
+        return {'id': self.merge_base}
+
+    def repository_compare(self, base, head):
+        return {'diffs': self.diffs}
+
+    def repository_raw_blob(self, sha, streamed=False, action=None, chunk_size=None):
+        path, content = next((path, content) for path, content in FILES.items() if blob_id(content) == sha)
+        if path in self.failing:
+            raise ConnectionError('connection reset')
+        action(content)
+
+@pytest.fixture
+def account(user, database, monkeypatch):
+    account = Account(user_id=user.id, platform='gitlab', username='octocat', access_token='token')
+    database.session.add(account)
+    database.session.commit()
+    monkeypatch.setattr(main, 'gitlab_client', lambda account: None)
+    monkeypatch.setattr(main, 'get_repo_hash', lambda account, repo_info, db_repo=None: ('c0ffee', None))
+    return account
+
+def repo_info(project):
+    return {'name': 'demo', 'id': '7', 'private': False, 'repo_obj': project}
+
+def test_pipeline_counts_failed_jobs():
+    written = []
+
+    def fetch(job):
+        if job.path == 'bad.py':
+            raise ConnectionError('connection reset')
+        return job.path
+
+    pipeline = FetchPipeline('example.com', workers=2, queue_size=1)
+    jobs = [FileJob(path, None, None, None) for path in ('a.py', 'bad.py', 'b.py')]
+    with pytest.raises(ScanIncomplete):
+        pipeline.run(jobs, fetch, lambda job, result: written.append(result))
+    assert pipeline.failed == 1
+    assert sorted(written) == ['a.py', 'b.py']
+
+def test_failed_file_keeps_head(account, database):
+    stats = analyze_gitlab_repo(account, repo_info(FakeProject(failing={'lib.py'})))
+
+    repo = database.session.scalars(database.select(Repository)).one()
+    assert repo.repo_hash is None
+    assert stats['PYTHON']['files'] == 1
+    assert [row.file_path for row in database.session.scalars(database.select(FileCache))] == ['app.py']
+
+    # The next sync scans again and picks up the file that failed
+    stats = analyze_gitlab_repo(account, repo_info(FakeProject()))
+    database.session.refresh(repo)
+    assert repo.repo_hash == 'c0ffee'
+    assert stats['PYTHON']['files'] == 2
+
+@pytest.mark.parametrize('glob, matches, misses', [
+    ('docs', ['docs', 'docs/a.md', 'src/docs/b.md'], ['documents/a.md', 'src/mydocs']),
+    ('/build/', ['build/out.js'], ['src/build/out.js']),
+    ('src/*.py', ['src/a.py'], ['src/a/b.py', 'lib/src/a.py']),
+    ('*.gen.ts', ['a.gen.ts', 'web/a.gen.ts'], ['a.gen.tsx', 'a/gen.ts']),
+    ('**/fixtures/**', ['fixtures/a', 'test/fixtures/b/c.json'], ['fixtures']),
+    ('a/**/b.c', ['a/b.c', 'a/x/y/b.c'], ['x/a/b.c']),
+    ('file?.py', ['file1.py'], ['file/.py', 'file12.py']),
+    ('[ab].py', ['a.py', 'x/b.py'], ['c.py']),
+    # A negated class is still confined to one name
+    ('foo[!a]bar', ['fooxbar', 'x/foo-bar'], ['fooabar', 'foo/bar']),
+    ('foo[^a]bar', ['fooxbar'], ['foo/bar']),
+])
+def test_glob_to_regex(glob, matches, misses):
+    pattern = re.compile(glob_to_regex(glob))
+    for path in matches:
+        assert pattern.search(path), (glob, path)
+    for path in misses:
+        assert not pattern.search(path), (glob, path)
+
+def test_path_filter():
+    default = PathFilter()
+    for path in ('node_modules/left-pad/index.js', 'web/dist/app.js', 'static/app.min.js', 'package-lock.json',
+                 'api/service_pb2.py', 'third_party/zlib/inflate.c', 'jquery-3.7.1.js'):
+        assert default.skip(path), path
+    for path in ('src/app.js', 'distance.py', 'docs/vendor.md', 'lib/lock.json'):
+        assert not default.skip(path), path
+    assert default.skip_dir('frontend/node_modules')
+    assert not default.skip_dir('src')
+
+    assert not PathFilter(vendored=False).skip('node_modules/left-pad/index.js')
+
+    custom = PathFilter(['docs/', '*.snap', '!vendor/our-lib'], max_size=1000)
+    assert custom.skip('docs/index.md') and custom.skip('src/__snapshots__/a.snap')
+    assert custom.skip('vendor/other/a.go')
+    assert not custom.skip('vendor/our-lib/a.go')
+    assert custom.skip('src/big.py', size=1001) and not custom.skip('src/big.py', size=1000)
+    assert not custom.skip('src/unknown.py', size=None)
+    # With keep globs a skipped directory may still hold kept files, so it is listed
+    assert not custom.skip_dir('vendor')
+
+def test_exclude_path_globs():
+    values = ['# generated\ndocs/\n\nweb: static/**\napi: *.json\n!\n', 'docs/\n!vendor/ours']
+    assert exclude_path_globs(values, 'web') == ('!vendor/ours', 'docs/', 'static/**')
+    assert exclude_path_globs(values, 'api') == ('!vendor/ours', '*.json', 'docs/')
+    assert exclude_path_globs([], 'web') == ()
+
+def test_compare_falls_back_to_a_full_scan(monkeypatch):
+    monkeypatch.setitem(app.config, 'INCREMENTAL_MAX_FILES', 2)
+    files = [{'filename': 'a.py', 'status': 'modified', 'sha': '1'}]
+    for status in ('diverged', 'behind'):
+        assert github_compare_changes({'status': status, 'files': files}, 'c0ffee') is None
+    assert github_compare_changes({'status': 'identical', 'files': []}, 'c0ffee') == []
+    assert github_compare_changes({'status': 'ahead', 'files': files * 3}, 'c0ffee') is None
+    # GitHub lists at most 300 files, so a full page may be cut short
+    monkeypatch.setitem(app.config, 'INCREMENTAL_MAX_FILES', 1000)
+    assert github_compare_changes({'status': 'ahead', 'files': files * main.GITHUB_COMPARE_MAX_FILES},
+                                  'c0ffee') is None
+
+    monkeypatch.setitem(app.config, 'INCREMENTAL_MAX_FILES', 2)
+    diffs = [{'old_path': 'a.py', 'new_path': 'a.py'}]
+    assert gitlab_compare_changes('beef', {'diffs': diffs}, 'c0ffee') is None
+    assert gitlab_compare_changes('c0ffee', {'diffs': diffs, 'compare_timeout': True}, 'c0ffee') is None
+    assert gitlab_compare_changes('c0ffee', {'diffs': diffs * 3}, 'c0ffee') is None
+
+def test_compare_lists_renames_and_deletions():
+    changes = github_compare_changes({'status': 'ahead', 'files': [
+        {'filename': 'new.py', 'previous_filename': 'old.py', 'status': 'renamed', 'sha': '1'},
+        {'filename': 'gone.py', 'status': 'removed', 'sha': '2'},
+        {'filename': 'edit.py', 'status': 'modified', 'sha': '3'},
+    ]}, 'c0ffee')
+    assert changes == [FileChange('old.py', None, True), FileChange('new.py', '1', False),
+                       FileChange('gone.py', None, True), FileChange('edit.py', '3', False)]
+
+    changes = gitlab_compare_changes('c0ffee', {'diffs': [
+        {'old_path': 'old.py', 'new_path': 'new.py', 'renamed_file': True},
+        {'old_path': 'gone.py', 'new_path': 'gone.py', 'deleted_file': True},
+        {'old_path': 'edit.py', 'new_path': 'edit.py'},
+    ]}, 'c0ffee')
+    assert changes == [FileChange('old.py', None, True), FileChange('new.py', None, False),
+                       FileChange('gone.py', None, True), FileChange('edit.py', None, False)]
+
+@pytest.mark.parametrize('merge_base, diffs', [
+    # History rewritten since the last scan
+    ('beef', []),
+    # More changed files than INCREMENTAL_MAX_FILES
+    ('c0ffee', [{'old_path': 'app.py', 'new_path': 'app.py'}] * 3),
+])
+def test_changed_history_scans_the_full_tree(account, database, monkeypatch, merge_base, diffs):
+    monkeypatch.setitem(app.config, 'INCREMENTAL_MAX_FILES', 2)
+    analyze_gitlab_repo(account, repo_info(FakeProject()))
+
+    monkeypatch.setattr(main, 'get_repo_hash', lambda account, repo_info, db_repo=None: ('d00d', None))
+    project = FakeProject(merge_base=merge_base, diffs=diffs)
+    stats = analyze_gitlab_repo(account, repo_info(project))
+    assert project.trees == 1
+    assert stats['PYTHON']['files'] == 2
+    repo = database.session.scalars(database.select(Repository)).one()
+    assert repo.repo_hash == 'd00d'
+
+def counts_by_language(files):
+    """Rollup totals of files, counted from scratch"""
+    stats = {}
+    for path, content in files.items():
+        language = language_registry.lookup(path)
+        add_file_stats(stats, language['name'].upper(), *count_raw_content(content, language))
+    return stats
+
+def test_incremental_scan_updates_cache_and_rollups(account, database, monkeypatch):
+    monkeypatch.setitem(app.config, 'MAX_FILE_SIZE', 200)
+    blobs = {}
+
+    def stream_download(url, headers, ingest, params=None):
+        ingest.feed(blobs[url.rsplit('/', 1)[-1]])
+
+    monkeypatch.setattr(main, 'stream_download', stream_download)
+    source = SimpleNamespace(repo=SimpleNamespace(url='https://api.example.com/repos/octocat/demo'), headers={})
+    db_repo = Repository(account_id=account.id, repo_name='demo', repo_id='7')
+    database.session.add(db_repo)
+    database.session.commit()
+
+    def scan(changes):
+        files = []
+        for path, content in changes:
+            if content is None:
+                files.append(FileChange(path, None, True))
+            else:
+                blobs[blob_id(content)] = content
+                files.append(FileChange(path, blob_id(content), False))
+        return scan_changes(db_repo, files, source, fetch_github_blob, 'example.com', PathFilter())
+
+    before = {
+        'app.py': b'import os\n\nprint(os.getcwd())\n',
+        'lib.py': b'# helper\nVALUE = 1\n',
+        'web/util.js': b'// util\nexport const x = 1;\n',
+        'big.py': b'x = 1\n',
+    }
+    assert scan(before.items()) == counts_by_language(before)
+
+    # app.py is deleted, lib.py moves, util.js changes and big.py grows past MAX_FILE_SIZE
+    after = {
+        'pkg/lib.py': before['lib.py'],
+        'web/util.js': b'/* util\n */\nexport const x = 2;\n\n',
+    }
+    stats = scan([('app.py', None), ('lib.py', None), ('pkg/lib.py', after['pkg/lib.py']),
+                  ('web/util.js', after['web/util.js']), ('big.py', b'x = 1\n' * 50)])
+    assert stats == counts_by_language(after)
+    assert sorted(database.session.scalars(database.select(FileCache.file_path))) == ['pkg/lib.py', 'web/util.js']
+    assert cached_repo_stats(db_repo) == stats
+
+def rollup_rows(database, db_repo):
+    return {
+        row.language: (row.files, row.total_lines, row.code_lines, row.comment_lines, row.empty_lines)
+        for row in database.session.scalars(database.select(RepositoryLanguageStats).filter_by(repo_id=db_repo.id))
+    }
+
+def file_cache_sums(database, db_repo):
+    """Rollup rows as they would be summed from scratch over the FileCache rows"""
+    rows = database.session.execute(database.select(
+        FileCache.language, database.func.count(), database.func.sum(FileCache.total_lines),
+        database.func.sum(FileCache.code_lines), database.func.sum(FileCache.comment_lines),
+        database.func.sum(FileCache.empty_lines)
+    ).where(FileCache.repo_id == db_repo.id).group_by(FileCache.language))
+    return {language: tuple(totals) for language, *totals in rows}
+
+def test_file_cache_store_batches_and_prunes(account, database):
+    db_repo = Repository(account_id=account.id, repo_name='demo', repo_id='7')
+    database.session.add(db_repo)
+    database.session.commit()
+    python, c = language_registry.by_name['Python'], language_registry.by_name['C']
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if 'file_cache' in statement and not statement.startswith('SELECT'):
+            statements.append((statement.split()[0], len(parameters) if executemany else 1))
+
+    event.listen(database.engine, 'before_cursor_execute', record)
+    try:
+        cache = FileCacheStore(db_repo, batch_size=2)
+        cache.put('a.py', 'a1', python, (3, 2, 1, 0))
+        assert statements == [] and database.session.query(FileCache).count() == 0
+        # The second row fills the batch, which goes in one statement
+        cache.put('b.py', 'b1', python, (5, 3, 0, 2))
+        assert statements == [('INSERT', 2)]
+        cache.put('c.c', 'c1', c, (4, 4, 0, 0))
+        cache.flush()
+        assert statements == [('INSERT', 2), ('INSERT', 1)]
+        assert rollup_rows(database, db_repo) == file_cache_sums(database, db_repo) == {
+            'PYTHON': (2, 8, 5, 1, 2), 'C': (1, 4, 4, 0, 0)}
+
+        # The next scan changes a.py, keeps c.c and no longer sees b.py
+        statements.clear()
+        cache = FileCacheStore(db_repo, batch_size=2)
+        assert cache.lookup('a.py', 'a2') is None
+        cache.put('a.py', 'a2', python, (10, 7, 2, 1))
+        assert cache.lookup('c.c', 'c1').code_lines == 4
+        cache.put('d.py', 'd1', python, (1, 1, 0, 0))
+        assert statements == [('UPDATE', 1), ('INSERT', 1)]
+        cache.prune()
+        assert statements[2:] == [('DELETE', 1)]
+    finally:
+        event.remove(database.engine, 'before_cursor_execute', record)
+
+    assert sorted(database.session.scalars(database.select(FileCache.file_path))) == ['a.py', 'c.c', 'd.py']
+    assert rollup_rows(database, db_repo) == file_cache_sums(database, db_repo) == {
+        'PYTHON': (2, 11, 8, 2, 1), 'C': (1, 4, 4, 0, 0)}
+
+    # Removing the last file of a language drops its rollup row
+    cache = FileCacheStore(db_repo)
+    cache.remove('c.c')
+    cache.flush()
+    assert rollup_rows(database, db_repo) == file_cache_sums(database, db_repo) == {'PYTHON': (2, 11, 8, 2, 1)}
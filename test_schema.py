@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Schema checks: migrations upgrade old databases in place and every hot-path
+query is answered through an index instead of a full table scan
+"""
+
+from datetime import date, timedelta
+
+from sqlalchemy import create_engine, inspect
+
+from main import (db, Account, Repository, FileCache, Statistics, DailyActivity, Settings, CustomEndpoint,
+                  RepositoryLanguageStats, SchemaVersion, User, ScanJob, ScanJobRepository, ScanProgress,
+                  StatisticsRollup, CurrentStatistics, SCAN_JOB_ACTIVE, FileCacheStore, migrate_database, period_statistics_query,
+                  check_statistics_rollups, current_statistics_query)
+
+TODAY = date(2024, 1, 1)
+
+# Queries the scanners, dashboard, API and badges run on every request or file
+HOT_QUERIES = {
+    'load repository': db.select(Repository).filter_by(account_id=1, repo_id='42'),
+    'load file cache': db.select(*FileCacheStore.COLUMNS).filter_by(repo_id=1),
+    'repository rollup': db.select(RepositoryLanguageStats).filter_by(repo_id=1),
+    'file cache lookup': db.select(FileCache).filter_by(repo_id=1, file_path='main.py'),
+    'replace statistics snapshot': db.delete(Statistics).filter_by(user_id=1, account_id=1, date=TODAY),
+    'dashboard statistics': db.select(Statistics.language, db.func.sum(Statistics.total_lines)).where(
+        Statistics.user_id == 1, Statistics.date >= TODAY, Statistics.date <= TODAY
+    ).group_by(Statistics.language),
+    'period statistics': period_statistics_query(1, TODAY - timedelta(days=365), TODAY),
+    'update statistics rollup': db.delete(StatisticsRollup).filter_by(user_id=1, period='week', start=TODAY),
+    'badge statistics': db.select(CurrentStatistics).filter_by(user_id=1, language='PYTHON'),
+    'refresh current statistics': current_statistics_query(1),
+    'daily activity': db.select(DailyActivity).filter_by(user_id=1, date=TODAY),
+    'activity chart': db.select(DailyActivity).where(
+        DailyActivity.user_id == 1, DailyActivity.date >= TODAY
+    ).order_by(DailyActivity.date),
+    'setting': db.select(Settings).filter_by(user_id=1, key='auto_update_interval'),
+    'exclude paths settings': db.select(Settings.value).where(
+        Settings.user_id == 1, Settings.key.in_(['exclude_paths', 'exclude_paths:1'])
+    ),
+    'custom endpoint': db.select(CustomEndpoint).filter_by(user_id=1, path='stats', is_active=True),
+    'user by name': db.select(User).filter_by(username='octocat'),
+    'active scan job': db.select(ScanJob).where(ScanJob.account_id == 1, ScanJob.status.in_(SCAN_JOB_ACTIVE)),
+    'claim scan job': db.select(ScanJob.id).filter_by(status='queued').order_by(ScanJob.priority, ScanJob.id),
+    'pending scan jobs': db.select(db.func.count()).select_from(ScanJob).where(
+        ScanJob.user_id == 1, ScanJob.status.in_(SCAN_JOB_ACTIVE)
+    ),
+    'scan job checkpoint': db.select(ScanJobRepository.repo_id).filter_by(job_id=1),
+    'scan progress': db.select(ScanProgress.key, ScanProgress.data).filter_by(user_id=1),
+    'publish scan progress': db.update(ScanProgress).filter_by(user_id=1, key='job-1').values(data='{}'),
+}
+
+def query_plan(connection, statement):
+    compiled = statement.compile(dialect=connection.dialect, compile_kwargs={'render_postcompile': True})
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    return [row[-1] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + compiled.string, params)]
+
+def test_hot_queries_use_indexes():
+    engine = create_engine('sqlite://')
+    migrate_database(engine)
+
+    with engine.connect() as connection:
+        for name, statement in HOT_QUERIES.items():
+            plan = query_plan(connection, statement)
+            scans = [step for step in plan if step.startswith('SCAN')]
+            assert not scans, f"{name} scans a table: {plan}"
+            assert any('INDEX' in step or 'PRIMARY KEY' in step for step in plan), f"{name}: {plan}"
+
+def test_migration_upgrades_existing_database():
+    engine = create_engine('sqlite://')
+    db.metadata.create_all(engine)
+
+    # Turn it back into a database created before the indexes existed
+    with engine.begin() as connection:
+        for model in (Repository, FileCache, Statistics, DailyActivity, Settings, CustomEndpoint):
+            for index in model.__table__.indexes:
+                index.drop(connection)
+        SchemaVersion.__table__.drop(connection)
+        StatisticsRollup.__table__.drop(connection)
+        CurrentStatistics.__table__.drop(connection)
+        connection.exec_driver_sql('ALTER TABLE repository DROP COLUMN head_etag')
+        connection.exec_driver_sql('ALTER TABLE scan_job DROP COLUMN host')
+
+        connection.execute(db.insert(Repository), [
+            {'account_id': 1, 'repo_name': 'repo', 'repo_id': '42', 'repo_hash': 'abc'},
+            {'account_id': 1, 'repo_name': 'repo', 'repo_id': '42', 'repo_hash': 'abc'},
+        ])
+        connection.execute(db.insert(FileCache), [
+            {'repo_id': 1, 'file_path': 'a.py', 'file_hash': 'old', 'language': 'PYTHON', 'total_lines': 1},
+            {'repo_id': 2, 'file_path': 'a.py', 'file_hash': 'old', 'language': 'PYTHON', 'total_lines': 1},
+            {'repo_id': 2, 'file_path': 'a.py', 'file_hash': 'new', 'language': 'PYTHON', 'total_lines': 5},
+            {'repo_id': 2, 'file_path': 'b.py', 'file_hash': 'new', 'language': 'PYTHON', 'total_lines': 7},
+        ])
+        connection.execute(db.insert(Statistics), [
+            {'user_id': 1, 'account_id': 1, 'date': TODAY, 'language': 'PYTHON', 'total_lines': 10},
+            {'user_id': 1, 'account_id': 2, 'date': TODAY, 'language': 'PYTHON', 'total_lines': 5},
+            {'user_id': 1, 'account_id': 1, 'date': TODAY - timedelta(days=40), 'language': 'GO', 'total_lines': 3},
+        ])
+        connection.execute(db.insert(Account), [
+            {'id': 1, 'user_id': 1, 'platform': 'github', 'username': 'a', 'access_token': 't', 'base_url': None},
+            {'id': 2, 'user_id': 1, 'platform': 'gitlab', 'username': 'a', 'access_token': 't', 'base_url': None},
+            {'id': 3, 'user_id': 1, 'platform': 'gitlab', 'username': 'a', 'access_token': 't',
+             'base_url': 'https://git.example.com'},
+        ])
+        connection.exec_driver_sql("INSERT INTO scan_job (user_id, account_id, priority, status) "
+                                   "VALUES (1, 1, 0, 'running'), (1, 2, 0, 'queued'), (1, 3, 0, 'done')")
+        connection.execute(db.insert(Settings), [
+            {'user_id': 1, 'key': 'auto_update_interval', 'value': '24'},
+            {'user_id': 1, 'key': 'auto_update_interval', 'value': '6'},
+        ])
+
+    migrate_database(engine)
+    migrate_database(engine)
+
+    indexes = {index['name'] for table in ('repository', 'file_cache', 'statistics', 'daily_activity',
+                                           'settings', 'custom_endpoint')
+               for index in inspect(engine).get_indexes(table)}
+    assert {'uq_file_cache_repo_path', 'uq_statistics_snapshot', 'ix_statistics_user_date',
+            'uq_daily_activity_user_date', 'uq_repository_account_repo', 'uq_settings_user_key',
+            'uq_custom_endpoint_user_path'} <= indexes
+
+    assert 'head_etag' in {column['name'] for column in inspect(engine).get_columns('repository')}
+    assert 'host' in {column['name'] for column in inspect(engine).get_columns('scan_job')}
+
+    with engine.connect() as connection:
+        assert connection.scalars(db.select(Repository.id)).all() == [2]
+        assert connection.scalars(db.select(Repository.repo_hash)).all() == [None]
+        assert connection.scalars(db.select(FileCache.file_hash)).all() == ['new', 'new']
+        assert connection.scalars(db.select(Settings.value)).all() == ['6']
+        assert connection.scalars(db.select(ScanJob.host).order_by(ScanJob.id)).all() == [
+            'api.github.com', 'gitlab.com', 'git.example.com']
+        assert connection.execute(db.select(
+            RepositoryLanguageStats.repo_id, RepositoryLanguageStats.language,
+            RepositoryLanguageStats.files, RepositoryLanguageStats.total_lines
+        )).all() == [(2, 'PYTHON', 2, 12)]
+        assert connection.scalars(db.select(SchemaVersion.version)).all() == [1, 2, 3, 4, 5, 6, 7, 8]
+        assert check_statistics_rollups(connection) == []
+        assert connection.execute(db.select(CurrentStatistics.language, CurrentStatistics.total_lines)).all() == [
+            ('PYTHON', 15)]
+        assert connection.execute(period_statistics_query(1, TODAY - timedelta(days=365), TODAY).with_only_columns(
+            StatisticsRollup.language, db.func.sum(StatisticsRollup.total_lines)
+        ).order_by(StatisticsRollup.language)).all() == [('GO', 3), ('PYTHON', 15)]
+
+if __name__ == '__main__':
+    test_hot_queries_use_indexes()
+    test_migration_upgrades_existing_database()
+    print("✓ Schema checks passed")
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding:utf-8
+"""
+Periodic sync checks: users sharing an interval start at their own fixed
+phase within it, interval settings are clamped, and changing the setting
+re-plans the user's job while an unchanged one is left alone
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from main import (app, Account, Settings, MAX_SYNC_INTERVAL, SYNC_JOB_PREFIX, plan_sync_schedules,
+                  schedule_user_sync, scheduler, sync_interval, sync_start)
+
+NOW = datetime(2024, 5, 1, 12, 30)
+
+@pytest.fixture
+def running_scheduler(database):
+    # Paused, so no job fires while a test runs
+    scheduler.start(paused=True)
+    yield scheduler
+    scheduler.remove_all_jobs()
+    scheduler.shutdown(wait=False)
+
+def test_sync_start_spreads_users_over_the_interval():
+    starts = [sync_start(user_id, 24, NOW) for user_id in range(1, 101)]
+    assert all(NOW <= start < NOW + timedelta(hours=24) for start in starts)
+    # A hundred users do not bunch up in any hour of the day
+    hours = [int((start - NOW).total_seconds() // 3600) for start in starts]
+    assert len(set(hours)) > 12
+    assert max(hours.count(hour) for hour in hours) < 15
+
+def test_sync_start_keeps_each_users_phase():
+    start = sync_start(7, 6, NOW)
+    # Later, or after a restart, the user's runs stay on the same phase
+    for later in (NOW + timedelta(minutes=1), start, start + timedelta(seconds=1), NOW + timedelta(days=3, hours=5)):
+        next_start = sync_start(7, 6, later)
+        assert later <= next_start < later + timedelta(hours=6)
+        assert (next_start - start).total_seconds() % (6 * 3600) == 0
+    assert sync_start(7, 6, NOW) == start
+    assert sync_start(8, 6, NOW) != start
+
+@pytest.mark.parametrize('value, hours', [
+    ('12', 12), (6, 6), ('0', 1), (-5, 1), ('1000', MAX_SYNC_INTERVAL),
+    ('abc', app.config['SYNC_DEFAULT_INTERVAL']), (None, app.config['SYNC_DEFAULT_INTERVAL']),
+])
+def test_sync_interval_is_clamped(value, hours):
+    assert sync_interval(value) == hours
+
+def test_schedule_needs_a_running_scheduler(user):
+    assert not scheduler.running
+    assert schedule_user_sync(user.id) is None
+
+def test_changed_interval_replans_the_sync(user, database, running_scheduler, monkeypatch):
+    job = schedule_user_sync(user.id)
+    assert job.id == f'{SYNC_JOB_PREFIX}{user.id}'
+    assert job.trigger.interval == timedelta(hours=app.config['SYNC_DEFAULT_INTERVAL'])
+
+    added = []
+    add_job = scheduler.add_job
+    monkeypatch.setattr(scheduler, 'add_job', lambda **kwargs: added.append(kwargs) or add_job(**kwargs))
+
+    # Planning again with the same setting keeps the job as it is
+    assert schedule_user_sync(user.id).id == job.id
+    assert added == []
+
+    database.session.add(Settings(user_id=user.id, key='auto_update_interval', value='1000'))
+    database.session.commit()
+    job = schedule_user_sync(user.id)
+    assert job.trigger.interval == timedelta(hours=MAX_SYNC_INTERVAL)
+    assert [kwargs['hours'] for kwargs in added] == [MAX_SYNC_INTERVAL]
+    assert added[0]['start_date'] - sync_start(user.id, MAX_SYNC_INTERVAL) < timedelta(seconds=5)
+    assert len(scheduler.get_jobs()) == 1
+
+def test_settings_form_replans_the_sync(user, client, running_scheduler):
+    schedule_user_sync(user.id)
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    response = client.post('/settings', data={'action': 'update_interval', 'interval': '6'})
+    assert response.status_code == 302
+    assert scheduler.get_job(f'{SYNC_JOB_PREFIX}{user.id}').trigger.interval == timedelta(hours=6)
+
+def test_plan_follows_active_accounts(user, database, running_scheduler):
+    account = Account(user_id=user.id, platform='github', username='octocat', access_token='token')
+    database.session.add_all([account, Settings(user_id=user.id, key='auto_update_interval', value='12')])
+    database.session.commit()
+    plan_sync_schedules()
+    assert [(job.id, job.trigger.interval) for job in scheduler.get_jobs()] == [
+        (f'{SYNC_JOB_PREFIX}{user.id}', timedelta(hours=12))]
+
+    # A user without active accounts has nothing to sync
+    account.is_active = False
+    database.session.commit()
+    plan_sync_schedules()
+    assert scheduler.get_jobs() == []